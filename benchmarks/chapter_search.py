@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Бенчмарк построения сниппетов для найденных глав: сколько байт текста
+уходит в Sphinx на одну страницу результатов поиска в каждом режиме
+SPHINX_CONFIG['snippets_mode'] и сколько это стоит по времени.
+
+Без аргумента --live Sphinx не нужен: запросы только собираются и
+считаются. С --live сниппеты строятся настоящим Manticore из
+SPHINX_CONFIG текущих настроек (для режима stored индекс глав должен
+быть создан с stored_fields = text).
+
+Запуск: python -m benchmarks.chapter_search [число_глав] [размер_главы_КБ] [--live]
+'''
+
+import sys
+import random
+from hashlib import md5
+
+from pony import orm
+
+from benchmarks.utils import benchmark_app, timer, create_author, create_story
+
+
+WORDS = ['единорог', 'радуга', 'дружба', 'магия', 'пони', 'яблоко', 'облако', 'замок', 'книга', 'полёт']
+
+
+class RecordingConnection:
+    # Считает, сколько байт аргументов ушло бы в Sphinx
+    def __init__(self, conn=None):
+        self.conn = conn
+        self.queries = 0
+        self.bytes_sent = 0
+
+    def _record(self, args):
+        self.queries += 1
+        self.bytes_sent += sum(len(str(x).encode('utf-8')) for x in args)
+
+    def call_snippets(self, index, texts, query, **options):
+        texts = list(texts)
+        self._record(texts + [index, query] + list(options.values()))
+        if self.conn is not None:
+            return self.conn.call_snippets(index, texts, query, **options)
+        return [''] * len(texts)
+
+    def select_highlights(self, index, ids, query, field='text', **options):
+        ids = list(ids)
+        self._record(ids + [index, query, field] + list(options.values()))
+        if self.conn is not None:
+            return self.conn.select_highlights(index, ids, query, field=field, **options)
+        return {}
+
+
+def make_text(size, rnd):
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = '<p>' + ' '.join(rnd.choice(WORDS[1:]) for _ in range(60)) + '</p>'
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    # Искомое слово где-то в середине главы
+    middle = len(paragraphs) // 2
+    paragraphs[middle] = paragraphs[middle].replace('</p>', ' единорог</p>')
+    return '\n'.join(paragraphs)
+
+
+def main():
+    args = [x for x in sys.argv[1:] if not x.startswith('--')]
+    live = '--live' in sys.argv[1:]
+    count = int(args[0]) if args else 20
+    size = int(args[1]) * 1024 if len(args) > 1 else 64 * 1024
+    repeat = 5 if live else 50
+
+    with benchmark_app() as app, orm.db_session:
+        from mini_fiction import models
+
+        rnd = random.Random(42)
+        author = create_author('bench_author')
+        story = create_story(author)
+        chapters = []
+        for i in range(count):
+            text = make_text(size, rnd)
+            chapter = models.Chapter(
+                story=story, order=i + 1, title='Глава {}'.format(i + 1),
+                text=text, text_md5=md5(text.encode('utf-8')).hexdigest(),
+                draft=False, story_published=True,
+            )
+            chapter.flush()
+            chapters.append(chapter)
+
+        cfg = app.config['SPHINX_CONFIG']
+        print('{} chapters, {} KiB each'.format(count, size // 1024))
+        for mode in ('full', 'window', 'stored'):
+            cfg['snippets_mode'] = mode
+            if live:
+                with app.sphinx as sphinx:
+                    conn = RecordingConnection(sphinx)
+                    with timer('{} (live)'.format(mode), repeat * count, 'snippets'):
+                        for _ in range(repeat):
+                            models.Chapter.bl._get_search_excerpts(conn, chapters, 'единороги')  # pylint: disable=protected-access
+            else:
+                conn = RecordingConnection()
+                with timer('{} (prepare only)'.format(mode), repeat * count, 'snippets'):
+                    for _ in range(repeat):
+                        models.Chapter.bl._get_search_excerpts(conn, chapters, 'единороги')  # pylint: disable=protected-access
+            print('    {} queries, {:.1f} KiB sent per page'.format(
+                conn.queries // repeat, conn.bytes_sent / repeat / 1024
+            ))
+
+
+if __name__ == '__main__':
+    main()
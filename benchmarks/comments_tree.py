@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Бенчмарк построения дерева комментариев (Commentable.get_comments_tree)
+на синтетических глубоких ветках.
+
+Запуск: python -m benchmarks.comments_tree [число_комментов] [глубина]
+'''
+
+import sys
+import random
+from datetime import datetime
+
+from pony import orm
+
+from benchmarks.utils import benchmark_app, timer, create_author, create_story
+
+
+def legacy_get_comments_tree(target, last_viewed_comment=None, **kw):
+    # Алгоритм до переписывания: для каждого коммента поднимается
+    # по цепочке c.parent до корня
+    tree = []
+    comments_dict = {}
+    for c in target.bl.get_comments_list(None, **kw):
+        p = c.parent
+        while p:
+            if p.id in comments_dict:
+                comments_dict[p.id][2] += 1
+                if last_viewed_comment is not None and last_viewed_comment < c.id:
+                    comments_dict[p.id][3] += 1
+            p = p.parent
+
+        item = [c, [], 0, 0]
+        comments_dict[c.id] = item
+        if c.parent is None or c.parent.id not in comments_dict:
+            tree.append(item)
+        else:
+            comments_dict[c.parent.id][1].append(item)
+    return tree
+
+
+def generate_comments(story, author, count, depth):
+    from mini_fiction.models import StoryComment
+
+    rnd = random.Random(42)
+    tm = datetime.utcnow()
+    chain = []  # текущая ветка от корня до самого глубокого коммента
+    for local_id in range(1, count + 1):
+        # С вероятностью 1/depth начинаем новую ветку, иначе отвечаем
+        # кому-то из текущей, в основном самому глубокому
+        if not chain or len(chain) >= depth or rnd.random() < 1 / depth:
+            parent = None if not chain or rnd.random() < 0.5 else chain[rnd.randrange(len(chain))]
+        else:
+            parent = chain[-1]
+        if parent is None:
+            chain = []
+        else:
+            chain = chain[:chain.index(parent) + 1]
+
+        c = StoryComment(
+            local_id=local_id, author=author, author_username=author.username,
+            story=story, text='Comment {}'.format(local_id), date=tm,
+            parent=parent, tree_depth=parent.tree_depth + 1 if parent else 0,
+            root_id=parent.root_id if parent else 0,
+            story_published=True,
+        )
+        c.flush()
+        if parent is None:
+            c.root_id = c.id
+        else:
+            parent.answers_count += 1
+        chain.append(c)
+        if local_id % 1000 == 0:
+            orm.commit()
+    story.comments_count = count
+    orm.commit()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+
+    with benchmark_app():
+        from mini_fiction.models import Story
+
+        with orm.db_session:
+            author = create_author('Bench')
+            story = create_story(author)
+            with timer('generate {} comments'.format(count), count, 'comments'):
+                generate_comments(story, author, count, depth)
+            story_id = story.id
+            roots = orm.select(c for c in story.comments if c.tree_depth == 0).count()
+            print('{} root comments, max depth {}'.format(
+                roots, orm.select(orm.max(c.tree_depth) for c in story.comments).first()
+            ))
+
+        cases = [
+            ('page 1', {'root_offset': 0, 'root_count': 25}),
+            ('whole story', {}),
+        ]
+        for title, kw in cases:
+            for name, func in (
+                ('legacy', lambda story, **kw: legacy_get_comments_tree(story, last_viewed_comment=count // 2, **kw)),
+                ('current', lambda story, **kw: story.bl.get_comments_tree(last_viewed_comment=count // 2, **kw)),
+            ):
+                # Новая сессия на каждый прогон, чтобы не было тёплого кэша Pony
+                with orm.db_session:
+                    story = Story[story_id]
+                    with timer('{}: {}'.format(title, name)):
+                        func(story, **kw)
+
+
+if __name__ == '__main__':
+    main()
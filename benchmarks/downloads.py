@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Бенчмарк рендеринга файлов для скачивания: пиковое потребление памяти
+и время рендеринга большого рассказа в каждый формат — потоковой записью
+в файл (как это делает downloads.artifacts) и прежним способом, когда весь
+файл (а для FB2 ещё и деревья всех глав) собирается в памяти.
+
+Каждый замер делается в отдельном дочернем процессе: прирост пикового RSS
+учитывает и память libxml2, которую tracemalloc не видит.
+
+Запуск: python -m benchmarks.downloads [размер_рассказа_МБ] [глав]
+'''
+
+import os
+import sys
+import time
+import json
+import random
+import resource
+import tracemalloc
+from hashlib import md5
+
+from pony import orm
+
+from benchmarks.utils import benchmark_app, create_author, create_story
+
+
+WORDS = ['единорог', 'радуга', 'дружба', 'магия', 'пони', 'яблоко', 'облако', 'замок', 'книга', 'полёт']
+
+
+def make_text(size, rnd):
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = '<p>' + ' '.join(rnd.choice(WORDS) for _ in range(60)) + '</p>'
+        paragraphs.append(paragraph)
+        length += len(paragraph.encode('utf-8'))
+    return '\n'.join(paragraphs)
+
+
+def seed(size, chapters_count, rnd):
+    from mini_fiction import models
+
+    story = create_story(create_author('bench_author'), title='Большой рассказ')
+    for i in range(chapters_count):
+        text = make_text(size // chapters_count, rnd)
+        models.Chapter(
+            story=story, order=i + 1, title='Глава {}'.format(i + 1),
+            text=text, text_md5=md5(text.encode('utf-8')).hexdigest(),
+            draft=False, story_published=True,
+        ).flush()
+    story.published_chapters_count = chapters_count
+    orm.commit()
+    return story.id
+
+
+def render_in_memory(fmt, story, path):
+    from mini_fiction.downloads.fb2 import FB2BaseDownload
+
+    if not isinstance(fmt, FB2BaseDownload):
+        data = fmt.render(story=story)
+    else:
+        # Прежний FB2: деревья всех глав в памяти и склейка через XSLT
+        import lxml.etree as etree
+        from mini_fiction.filters import fb2
+        from mini_fiction.models import Chapter
+
+        chapters = story.chapters.select(lambda x: not x.draft).order_by(Chapter.order, Chapter.id)
+        doc = fb2.join_fb2_docs(
+            [fmt._get_annotation_doc(story)] +  # pylint: disable=protected-access
+            [fb2.html_to_fb2(c.get_fb2_chapter_text(), title=c.autotitle) for c in chapters],
+            title=story.title,
+            author_name=story.authors[0].username,
+            date=(story.first_published_at or story.date).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        )
+        data = etree.tostring(doc, encoding='UTF-8', xml_declaration=True)
+        if fmt.extension.endswith('.zip'):
+            import zipfile
+            from io import BytesIO
+
+            buf = BytesIO()
+            with zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_DEFLATED) as zipobj:
+                zipobj.writestr('story.fb2', data)
+            data = buf.getvalue()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), 'wb') as fp:
+        fp.write(data)
+
+
+def render_streaming(fmt, story, path):
+    from mini_fiction.downloads.artifacts import render_artifact
+
+    render_artifact(story, fmt, path)
+
+
+def current_rss_kib():
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def measure(func, fmt, story_id, path):
+    # Замер в дочернем процессе, чтобы пики разных замеров не смешивались
+    from mini_fiction.models import Story
+    from mini_fiction.utils.misc import nonrequest_context
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            with orm.db_session, nonrequest_context():
+                story = Story[story_id]
+                rss_before = current_rss_kib()
+                tracemalloc.start()
+                tm = time.perf_counter()
+                func(fmt, story, path)
+                tm = time.perf_counter() - tm
+                py_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result = {'time': tm, 'py_peak': py_peak / 1024 / 1024, 'rss': (rss_peak - rss_before) / 1024}
+            os.write(wfd, json.dumps(result).encode('utf-8'))
+        finally:
+            os._exit(0)  # pylint: disable=protected-access
+
+    os.close(wfd)
+    with os.fdopen(rfd, 'rb') as fp:
+        data = fp.read()
+    os.waitpid(pid, 0)
+    return json.loads(data.decode('utf-8'))
+
+
+def main():
+    args = sys.argv[1:]
+    size = int(float(args[0]) * 1024 * 1024) if args else 3 * 1024 * 1024
+    chapters_count = int(args[1]) if len(args) > 1 else 30
+
+    with benchmark_app() as app, orm.db_session:
+        from mini_fiction.downloads import list_formats
+
+        story_id = seed(size, chapters_count, random.Random(42))
+
+        print('Story: {:.1f} MiB, {} chapters'.format(size / 1024 / 1024, chapters_count))
+        print('{:<14} {:<10} {:>8} {:>16} {:>12}'.format('format', 'mode', 'time, s', 'python peak, MiB', 'RSS +MiB'))
+        path = app.config['MEDIA_ROOT'] / 'download.bin'
+        for fmt in list_formats():
+            for mode, func in (('in-memory', render_in_memory), ('streaming', render_streaming)):
+                result = measure(func, fmt, story_id, path)
+                print('{:<14} {:<10} {:>8.2f} {:>16.1f} {:>12.1f}'.format(
+                    fmt.extension, mode, result['time'], result['py_peak'], result['rss'],
+                ))
+            print('{:<14} size {:.2f} MiB'.format('', path.stat().st_size / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Бенчмарк накладных расходов на манифесты фронтенда в каждом запросе:
+сравнивает старое поведение (glob и разбор всех manifest.json в каждом
+запросе) с общим для процесса реестром манифестов.
+
+Запуск: python -m benchmarks.frontend_manifests [число_запросов] [число_бандлов] [ассетов_в_бандле]
+'''
+
+import sys
+import json
+import shutil
+import tempfile
+from itertools import chain
+from pathlib import Path
+
+from flask import g
+from werkzeug.datastructures import MultiDict
+
+from benchmarks.utils import benchmark_app, timer
+from mini_fiction.logic import frontend
+
+
+def legacy_get_assets(static_root):
+    # Поведение до реестра: каждый запрос заново читает все манифесты
+    return MultiDict(chain(*(
+        frontend.get_manifest(bundle_type='static', path=manifest_path)
+        for manifest_path in Path(static_root).glob('*/manifest.json')
+    )))
+
+
+def create_manifests(static_root, bundles, assets):
+    for i in range(bundles):
+        bundle_dir = Path(static_root) / 'bundle{}'.format(i)
+        bundle_dir.mkdir()
+        manifest = {
+            'asset{}.{}'.format(j, 'css' if j % 2 else 'js'): {
+                'src': 'asset{}.{:08x}.js'.format(j, j * 7919),
+                'integrity': 'sha384-' + 'x' * 64,
+            }
+            for j in range(assets)
+        }
+        (bundle_dir / 'manifest.json').write_text(json.dumps(manifest), encoding='utf-8')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    bundles = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    assets = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    static_root = tempfile.mkdtemp(prefix='mini_fiction_bench_static_')
+    try:
+        create_manifests(static_root, bundles, assets)
+
+        with benchmark_app() as app:
+            app.settings.STATIC_ROOT = static_root
+            app.settings.FRONTEND_MANIFESTS_AUTO_RELOAD = False
+            frontend.clear_manifests_registry()
+
+            def render_page(get_assets):
+                # Один запрос: стили, скрипты и иконки, как в base.html
+                with app.test_request_context('/'):
+                    g.frontend_assets = get_assets()
+                    frontend.stylesheets()
+                    frontend.scripts()
+                    frontend.scripts(entrypoint=True)
+                    frontend.favicon_bundle()
+
+            cases = [
+                ('legacy (glob + parse per request)', lambda: legacy_get_assets(static_root)),
+                ('registry', frontend.get_assets),
+                ('registry + auto reload', lambda: frontend._get_assets(auto_reload=True)),  # pylint: disable=protected-access
+            ]
+            for title, get_assets in cases:
+                render_page(get_assets)
+                with timer(title, count, 'requests'):
+                    for _ in range(count):
+                        render_page(get_assets)
+    finally:
+        shutil.rmtree(static_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Бенчмарк загрузки дампа в пустую базу данных: генерирует дамп
+просмотров рассказов (storyview, по умолчанию миллион строк) и загружает
+его через PonyDump.bulk_load_from_files (loaddb --bulk); для сравнения
+обычный загрузчик (loaddb --only-create) загружает небольшую часть того же
+дампа.
+
+Запуск: python -m benchmarks.loaddb [число_строк] [строк_для_обычного_загрузчика]
+'''
+
+import sys
+import json
+import random
+from datetime import datetime, timedelta
+
+from pony import orm
+
+from benchmarks.utils import benchmark_app, timer, create_author, create_story
+
+
+def seed():
+    from mini_fiction import models
+
+    with orm.db_session:
+        author = create_author('bench_author')
+        story = create_story(author)
+        chapter = models.Chapter(story=story, order=1, title='Глава', text='<p>Текст</p>', draft=False, story_published=True)
+        chapter.flush()
+        return author.id, story.id, chapter.id
+
+
+def generate_dump(path, count, author_id, story_id, chapter_id, rnd):
+    date = datetime(2020, 1, 1)
+    with path.open('w', encoding='utf-8') as fp:
+        for i in range(count):
+            date += timedelta(seconds=rnd.randint(1, 60))
+            fp.write(json.dumps({
+                '_entity': 'storyview',
+                'id': i + 1,
+                'author': author_id if i % 3 == 0 else None,
+                'date': date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'story': story_id,
+                'chapter': chapter_id if i % 2 == 0 else None,
+            }, ensure_ascii=False, sort_keys=True) + '\n')
+
+
+def clear_storyviews():
+    from mini_fiction import models
+
+    with orm.db_session:
+        models.StoryView.select().delete(bulk=True)
+
+
+def count_storyviews():
+    from mini_fiction import models
+
+    with orm.db_session:
+        return models.StoryView.select().count()
+
+
+def main():
+    from mini_fiction.dumpload import MiniFictionDump
+
+    args = sys.argv[1:]
+    count = int(args[0]) if args else 1000000
+    slow_count = int(args[1]) if len(args) > 1 else 20000
+
+    with benchmark_app() as app:
+        ids = seed()
+        dumpdir = app.config['MEDIA_ROOT'] / 'dump'
+        dumpdir.mkdir(parents=True)
+        path = dumpdir / 'storyview_dump.jsonl'
+
+        with timer('generating dump', count, 'rows'):
+            generate_dump(path, count, *ids, rnd=random.Random(42))
+        print('dump size: {:.1f} MiB'.format(path.stat().st_size / 1024 / 1024))
+
+        mfd = MiniFictionDump()
+        for batch_size in (1000, 5000):
+            clear_storyviews()
+            with timer('bulk load, batch {}'.format(batch_size), count, 'rows'):
+                for _ in mfd.bulk_load_from_files(filelist={('storyview', path)}, batch_size=batch_size):
+                    pass
+            assert count_storyviews() == count
+
+        # Обычный загрузчик слишком медленный для всего дампа
+        slow_path = dumpdir / 'slice' / 'storyview_dump.jsonl'
+        slow_path.parent.mkdir()
+        with path.open('r', encoding='utf-8') as src, slow_path.open('w', encoding='utf-8') as dst:
+            for _, line in zip(range(slow_count), src):
+                dst.write(line)
+
+        clear_storyviews()
+        with timer('only-create load', slow_count, 'rows'):
+            for _ in mfd.load_from_files(filelist={('storyview', slow_path)}, only_create=True):
+                pass
+        assert count_storyviews() == slow_count
+
+
+if __name__ == '__main__':
+    main()
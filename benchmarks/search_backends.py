@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Бенчмарк поисковых бэкендов: индексирует одни и те же сгенерированные
+рассказы и главы и сравнивает время поисковых запросов (с фильтрами и
+разными сортировками) у SQLite FTS5 и, с аргументом --sphinx, у
+Manticore из SPHINX_CONFIG текущих настроек (индексы в нём будут
+очищены и заполнены заново).
+
+Запуск: python -m benchmarks.search_backends [число_рассказов] [глав_в_рассказе] [--sphinx]
+'''
+
+import os
+import sys
+import random
+import tempfile
+from hashlib import md5
+
+from pony import orm
+
+from benchmarks.utils import benchmark_app, timer, create_author, create_story
+
+
+WORDS = [
+    'единорог', 'радуга', 'дружба', 'магия', 'пони', 'яблоко', 'облако', 'замок', 'книга', 'полёт',
+    'дракон', 'рыцарь', 'принцесса', 'лес', 'река', 'гроза', 'звезда', 'луна', 'солнце', 'праздник',
+]
+
+QUERIES = [
+    ('единорог', {}, 0),
+    ('магия дружба', {}, 0),
+    ('дракон -рыцарь', {}, 1),
+    ('"белый замок"', {}, 0),
+    ('луна | звезда', {'character': [1], 'character_mode': 'any'}, 2),
+    ('', {'character': [1]}, 1),
+    ('', {'min_words': 5000}, 2),
+    ('праздник', {'original': [1]}, 4),
+]
+
+
+def seed(count, chapters_per_story, rnd):
+    from mini_fiction import models
+
+    author = create_author('bench_author')
+    character = models.Character.select().first()
+    for i in range(count):
+        story = create_story(author, title=' '.join(rnd.choice(WORDS) for _ in range(3)))
+        story.summary = ' '.join(rnd.choice(WORDS) for _ in range(30))
+        if character is not None and i % 3 == 0:
+            story.characters.add(character)
+        for j in range(chapters_per_story):
+            text = '\n'.join(
+                '<p>' + ' '.join(rnd.choice(WORDS) for _ in range(80)) + '</p>'
+                for _ in range(20)
+            )
+            models.Chapter(
+                story=story, order=j + 1, title='Глава {}'.format(j + 1),
+                text=text, text_md5=md5(text.encode('utf-8')).hexdigest(),
+                words=1600, draft=False, story_published=True,
+            ).flush()
+        story.words = 1600 * chapters_per_story
+        if i % 100 == 99:
+            orm.commit()
+    orm.commit()
+
+
+def run_backend(app, title, pool, repeat):
+    from mini_fiction import models
+
+    app.sphinx = pool
+    with app.sphinx as sphinx:
+        sphinx.delete('stories', id__gte=0)
+        sphinx.delete('chapters', id__gte=0)
+
+    stories = list(models.Story.select())
+    with timer('{}: indexing'.format(title), len(stories), 'stories'):
+        models.Story.bl.add_stories_to_search(stories, max_batch_bytes=4 * 1024 * 1024)
+
+    with timer('{}: story search'.format(title), repeat * len(QUERIES), 'queries'):
+        for _ in range(repeat):
+            for query, filters, sort_by in QUERIES:
+                models.Story.bl.search(query, 20, sort_by, **filters)
+
+    with timer('{}: chapter search'.format(title), repeat * len(QUERIES), 'queries'):
+        for _ in range(repeat):
+            for query, filters, sort_by in QUERIES:
+                models.Chapter.bl.search(query, 20, sort_by, **filters)
+
+
+def main():
+    from mini_fiction.apis import amsphinxql, fts5search
+
+    args = [x for x in sys.argv[1:] if not x.startswith('--')]
+    with_sphinx = '--sphinx' in sys.argv[1:]
+    count = int(args[0]) if args else 1000
+    chapters_per_story = int(args[1]) if len(args) > 1 else 3
+    repeat = 10
+
+    with benchmark_app() as app, orm.db_session:
+        app.config['SPHINX_DISABLED'] = False
+        app.config['SEARCH_RESULTS_CACHE_TIME'] = 0
+
+        with timer('seeding', count, 'stories'):
+            seed(count, chapters_per_story, random.Random(42))
+
+        fd, fts_path = tempfile.mkstemp(prefix='mini_fiction_bench_fts5_', suffix='.sqlite3')
+        os.close(fd)
+        try:
+            run_backend(app, 'fts5', fts5search.FTS5SearchPool({'path': fts_path}), repeat)
+            print('fts5: index size {:.1f} MiB'.format(os.path.getsize(fts_path) / 1024 / 1024))
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(fts_path + suffix):
+                    os.remove(fts_path + suffix)
+
+        if with_sphinx:
+            run_backend(app, 'sphinx', amsphinxql.SphinxPool(app.config['SPHINX_CONFIG']['connection_params']), repeat)
+
+
+if __name__ == '__main__':
+    main()
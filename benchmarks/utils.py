@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime
+
+from mini_fiction.settings import Test
+
+
+_bench_dir = tempfile.mkdtemp(prefix='mini_fiction_bench_')
+
+
+class Benchmark(Test):
+    TESTING_DIRECTORY = _bench_dir
+    DATABASE = {
+        'filename': os.path.join(_bench_dir, 'benchdb.sqlite3'),
+        'create_db': True,
+    }
+    MEDIA_ROOT = Path(_bench_dir) / 'media'
+
+
+@contextmanager
+def benchmark_app():
+    '''Создаёт приложение с пустой временной базой данных SQLite (с уже
+    загруженными фикстурами) и удаляет всё после завершения бенчмарка.
+    '''
+
+    os.environ['MINIFICTION_SETTINGS'] = 'benchmarks.utils.Benchmark'
+
+    from pony.orm import db_session
+    from mini_fiction import fixtures
+    from mini_fiction.application import create_app
+
+    app = create_app()
+    try:
+        with app.test_request_context():
+            with db_session:
+                fixtures.seed(verbosity=0)
+            yield app
+    finally:
+        shutil.rmtree(_bench_dir, ignore_errors=True)
+
+
+@contextmanager
+def timer(title, count=None, unit='items'):
+    tm = time.perf_counter()
+    yield
+    tm = time.perf_counter() - tm
+    if count:
+        print('{:<40} {:9.3f} s  ({:.0f} {}/s)'.format(title, tm, count / tm if tm else 0, unit))
+    else:
+        print('{:<40} {:9.3f} s'.format(title, tm))
+
+
+def create_author(username):
+    from mini_fiction import models
+
+    author = models.Author(
+        username=username,
+        email='{}@example.com'.format(username.lower()),
+        password='',
+        date_joined=datetime.utcnow(),
+        activated_at=datetime.utcnow(),
+        session_token='token_{}'.format(username),
+    )
+    author.flush()
+    return author
+
+
+def create_story(author, title='Story', published=True):
+    from mini_fiction import models
+
+    story = models.Story(
+        title=title,
+        rating=models.Rating.select().first(),
+        summary='Summary of {}'.format(title),
+        draft=not published,
+        approved=published,
+        first_published_at=datetime.utcnow() if published else None,
+    )
+    story.flush()
+    models.StoryContributor(story=story, user=author, is_editor=True, is_author=True, visible=True).flush()
+    return story
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Микробенчмарк XSLT-фильтров: сравнивает стоимость одного вызова
+с компиляцией таблицы на каждый вызов (старое поведение) и с использованием
+общего реестра скомпилированных таблиц.
+
+Запуск: python -m benchmarks.xslt_transform [число_итераций]
+'''
+
+import os
+import sys
+import timeit
+
+from lxml import etree
+
+from mini_fiction.filters import base
+from mini_fiction.filters.html import normalize_html
+
+
+SAMPLE = '<p>Lorem ipsum <strong>dolor</strong> sit amet.</p>\n\n' * 50 + 'foo<footnote id="1">bar</footnote>'
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    html_dir = os.path.dirname(sys.modules['mini_fiction.filters.html'].__file__)
+    xslt_path = os.path.join(html_dir, 'pre-normalize-html.xslt')
+
+    def compile_each_time():
+        doc = etree.HTML('<body>' + SAMPLE + '</body>')
+        base.load_xslt_transform(xslt_path)(doc)
+
+    def from_registry():
+        doc = etree.HTML('<body>' + SAMPLE + '</body>')
+        base.get_xslt_transform(xslt_path)(doc)
+
+    def from_registry_auto_reload():
+        doc = etree.HTML('<body>' + SAMPLE + '</body>')
+        base.get_xslt_transform(xslt_path, auto_reload=True)(doc)
+
+    results = [
+        ('compile on every call', compile_each_time),
+        ('registry', from_registry),
+        ('registry + auto reload', from_registry_auto_reload),
+        ('normalize_html (3 stylesheets)', lambda: normalize_html(SAMPLE)),
+    ]
+
+    base.clear_xslt_registry()
+    for name, func in results:
+        t = timeit.timeit(func, number=number)
+        print('{:<32} {:8.3f} ms/call'.format(name, t * 1000 / number))
+
+
+if __name__ == '__main__':
+    main()
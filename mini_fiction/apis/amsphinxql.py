@@ -1,9 +1,10 @@
-from queue import Queue
+import time
+from queue import Empty, LifoQueue, Queue
 from threading import Lock, local
 from dataclasses import dataclass
 from types import TracebackType
 import typing
-from typing import Any, Dict, List, Optional, Sequence, Tuple, Type, TypeVar, Union
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Type, TypeVar, Union
 
 if typing.TYPE_CHECKING:
     from MySQLdb.cursors import Cursor
@@ -23,6 +24,10 @@ class SphinxError(Exception):
     pass
 
 
+class SphinxPoolTimeout(Exception):
+    pass
+
+
 @dataclass
 class SphinxSearchResult:
     matches: List[Dict[str, Any]]
@@ -71,6 +76,9 @@ class SphinxConnection:
     def ping(self) -> None:
         self.mysql_conn.ping()
 
+    def close(self) -> None:
+        self.mysql_conn.close()
+
     def tables(self) -> Sequence[Tuple[str, str]]:
         return self._execute('show tables').fetchall()
 
@@ -276,6 +284,26 @@ class SphinxConnection:
         cur = self._execute(sql, args)
         return [str(x[0]) for x in cur.fetchall()]
 
+    def select_highlights(
+        self, index: str, ids: Sequence[int], query: str, field: str = 'text', **options: Any
+    ) -> Dict[int, str]:
+        # Сниппеты по сохранённому в индексе (stored_fields) тексту:
+        # сам текст при этом не передаётся в Sphinx
+        ids = list(ids)
+        if not ids:
+            return {}
+        opts = dict(options)
+        sql = "select id, highlight({%s}, %%s) from `%s` where match(%%s) and id in (%s) limit %d" % (
+            ", ".join("%s=%%s" % opt for opt in opts),
+            index,
+            ", ".join("%s" for _ in ids),
+            len(ids),
+        )
+        args: List[Any] = list(opts.values()) + [field, query] + ids
+
+        cur = self._execute(sql, args)
+        return {int(x[0]): str(x[1]) for x in cur.fetchall()}
+
     def call_keywords(
         self,
         index: str,
@@ -338,6 +366,39 @@ class SphinxConnection:
         if sql:
             self._execute(sql, args)
 
+    def add_batched(
+        self,
+        index: str,
+        items: Iterable[Dict[str, Any]],
+        max_bytes: int,
+        replace: bool = True,
+    ) -> int:
+        """То же самое, что add, но разбивает элементы на несколько
+        многострочных запросов так, чтобы размер данных в каждом из них
+        (оценочный) не превышал max_bytes. Слишком большой элемент
+        отправляется отдельным запросом. Возвращает число запросов.
+        """
+
+        statements = 0
+        batch: List[Dict[str, Any]] = []
+        batch_size = 0
+
+        for item in items:
+            item_size = estimate_item_size(item)
+            if batch and batch_size + item_size > max_bytes:
+                self.add(index, batch, replace=replace)
+                statements += 1
+                batch = []
+                batch_size = 0
+            batch.append(item)
+            batch_size += item_size
+
+        if batch:
+            self.add(index, batch, replace=replace)
+            statements += 1
+
+        return statements
+
     def build_update_sql(self, index: str, fields: Dict[str, Any], **filters: Any) -> Tuple[str, Tuple[Any, ...]]:
         sql = "update `%s` set " % index
         fields_list = tuple(fields.keys())
@@ -399,36 +460,190 @@ class SphinxPool:
         conn: Dict[str, Any],
         max_conns: int = 5,
         conn_queue: "Optional[Queue[SphinxConnection]]" = None,
+        ping_interval: float = 0,
+        idle_timeout: Optional[float] = None,
+        checkout_timeout: Optional[float] = None,
     ):
+        """Пул соединений со Sphinx.
+
+        :param ping_interval: соединения, простоявшие в пуле дольше этого
+          числа секунд, проверяются пингом перед выдачей (0 — проверять всегда)
+        :param idle_timeout: соединения, простоявшие в пуле дольше этого
+          числа секунд, закрываются (None — держать всегда)
+        :param checkout_timeout: сколько секунд ждать свободное соединение,
+          если их уже max_conns (None — ждать бесконечно)
+        """
         self.conn = conn
         self.max_conns = max_conns
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
         self.count = 0
         self.local = local()
-        self.conn_queue = conn_queue or Queue()
+        # LIFO: при малой нагрузке используются одни и те же соединения,
+        # а лишние простаивают и закрываются по idle_timeout
+        self.conn_queue = conn_queue or LifoQueue()
         self._lock = Lock()
+        # Время, когда соединение вернулось в пул; id(conn) -> time.monotonic()
+        self._released_at: Dict[int, float] = {}
+        # Не чаще раза в idle_timeout при выдаче соединения просматриваются
+        # все простаивающие: LIFO-очередь до нижних соединений не доходит
+        self._next_sweep_at = time.monotonic() + (idle_timeout or 0)
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "pings": 0,
+            "reconnects": 0,
+            "evicted": 0,
+            "created": 0,
+        }
+
+    def _create_connection(self) -> SphinxConnection:
+        return SphinxConnection(self.conn)
+
+    def copy(self) -> "SphinxPool":
+        """Новый пул с теми же настройками, но без соединений (например,
+        для дочернего процесса, которому соединения родителя не годятся).
+        """
+        return type(self)(
+            self.conn,
+            max_conns=self.max_conns,
+            ping_interval=self.ping_interval,
+            idle_timeout=self.idle_timeout,
+            checkout_timeout=self.checkout_timeout,
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["wait_time"] = round(stats["wait_time"], 6)
+            stats["total"] = self.count
+            stats["idle"] = self.conn_queue.qsize()
+            stats["in_use"] = max(0, self.count - stats["idle"])
+            stats["max_conns"] = self.max_conns
+        return stats
+
+    def _drop_connection(self, conn: SphinxConnection, stat: Optional[str] = None) -> None:
+        with self._lock:
+            self.count -= 1
+            self._released_at.pop(id(conn), None)
+            if stat is not None:
+                self._stats[stat] += 1
 
     def _get_connection_from_pool(self) -> SphinxConnection:
+        with self._lock:
+            self._stats["checkouts"] += 1
+            now = time.monotonic()
+            sweep = False
+            if self.idle_timeout is not None and now >= self._next_sweep_at:
+                self._next_sweep_at = now + self.idle_timeout
+                sweep = True
+        if sweep:
+            self.evict_idle()
+
         while True:
             with self._lock:
                 if self.conn_queue.empty() and self.count < self.max_conns:
-                    self.conn_queue.put(SphinxConnection(self.conn))
                     self.count += 1
+                    create = True
+                else:
+                    create = False
+
+            if create:
+                try:
+                    conn = self._create_connection()
+                except Exception:
+                    with self._lock:
+                        self.count -= 1
+                    raise
+                with self._lock:
+                    self._stats["created"] += 1
+                # Только что созданное соединение пинговать незачем
+                return conn
 
-            conn = self.conn_queue.get()
+            conn = self._wait_for_connection()
 
-            try:
-                conn.ping()
-            except Exception as exc:
-                # drop broken connection
-                with self._lock:
-                    self.count -= 1
+            with self._lock:
+                released_at = self._released_at.pop(id(conn), None)
+            idle_time = time.monotonic() - released_at if released_at is not None else None
 
-                if _should_reconnect(exc):
-                    continue  # connection errors are not fatal
-                raise
+            if self.idle_timeout is not None and idle_time is not None and idle_time > self.idle_timeout:
+                self._close_connection(conn)
+                self._drop_connection(conn, "evicted")
+                continue
+
+            if idle_time is None or idle_time >= self.ping_interval:
+                try:
+                    with self._lock:
+                        self._stats["pings"] += 1
+                    conn.ping()
+                except Exception as exc:
+                    # drop broken connection
+                    self._drop_connection(conn, "reconnects")
+
+                    if _should_reconnect(exc):
+                        continue  # connection errors are not fatal
+                    raise
 
             return conn
 
+    def _wait_for_connection(self) -> SphinxConnection:
+        try:
+            return self.conn_queue.get_nowait()
+        except Empty:
+            pass
+
+        tm = time.monotonic()
+        try:
+            conn = self.conn_queue.get(timeout=self.checkout_timeout)
+        except Empty:
+            raise SphinxPoolTimeout(
+                "Timed out waiting {:.1f}s for a free Sphinx connection (max_conns={})".format(
+                    time.monotonic() - tm, self.max_conns
+                )
+            ) from None
+        finally:
+            with self._lock:
+                self._stats["waits"] += 1
+                self._stats["wait_time"] += time.monotonic() - tm
+        return conn
+
+    def _close_connection(self, conn: SphinxConnection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _release_connection(self, conn: SphinxConnection) -> None:
+        with self._lock:
+            self._released_at[id(conn)] = time.monotonic()
+        self.conn_queue.put(conn)
+
+    def evict_idle(self) -> int:
+        """Закрывает соединения, простоявшие в пуле дольше idle_timeout.
+        Вызывается при выдаче соединения не чаще раза в idle_timeout.
+        Возвращает число закрытых соединений.
+        """
+        if self.idle_timeout is None:
+            return 0
+
+        now = time.monotonic()
+        stale: List[SphinxConnection] = []
+        # Очередь не опустошается, а просматривается на месте, чтобы
+        # другие потоки в это время не решили, что свободных соединений нет
+        with self._lock, self.conn_queue.mutex:
+            for conn in list(self.conn_queue.queue):
+                released_at = self._released_at.get(id(conn), now)
+                if now - released_at > self.idle_timeout:
+                    self.conn_queue.queue.remove(conn)
+                    stale.append(conn)
+
+        for conn in stale:
+            self._close_connection(conn)
+            self._drop_connection(conn, "evicted")
+        return len(stale)
+
     def __enter__(self) -> SphinxConnection:
         if not hasattr(self.local, "level") or self.local.level == 0:
             conn = self._get_connection_from_pool()
@@ -459,16 +674,39 @@ class SphinxPool:
                 conn.__exit__(exc_type, exc, exc_tb)
             except Exception:
                 # drop broken connection
-                with self._lock:
-                    self.count -= 1
+                self._drop_connection(conn, "reconnects")
                 # connection errors are fatal here due to possible data loss
                 raise
 
-            self.conn_queue.put(conn)
+            self._release_connection(conn)
+
+
+def estimate_item_size(item: Dict[str, Any]) -> int:
+    # Приблизительный размер строки в запросе REPLACE/INSERT в байтах
+    size = 2
+    for value in item.values():
+        if isinstance(value, str):
+            size += len(value.encode("utf-8")) + 4
+        elif isinstance(value, bytes):
+            size += len(value) + 4
+        elif isinstance(value, (tuple, list, set, frozenset)):
+            size += 12 * len(value) + 4
+        else:
+            size += 12
+    return size
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Ошибка связана с соединением, и запрос имеет смысл повторить позже."""
+    return isinstance(exc, SphinxPoolTimeout) or _should_reconnect(exc)
 
 
 def _should_reconnect(exc: BaseException) -> bool:
-    from MySQLdb import Error
+    try:
+        from MySQLdb import Error
+    except ImportError:
+        # Другой бэкенд (например, fts5search) без установленного MySQLdb
+        return False
 
     # 2002 - Can't connect to local MySQL server
     # 2006 - MySQL server has gone away
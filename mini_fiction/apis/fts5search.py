@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Поисковый бэкенд на SQLite FTS5 с тем же интерфейсом, что у
+SphinxConnection и SphinxPool. Предназначен для разработки, тестовых
+стендов и небольших зеркал, где нет Manticore; морфологию Sphinx он
+не повторяет, а приближает поиском по началу слова.
+"""
+
+import re
+import html
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+from mini_fiction.apis.amsphinxql import SphinxConnection, SphinxError, SphinxPool, SphinxSearchResult
+
+
+# Схема повторяет sphinx.conf: полнотекстовые поля, атрибуты и
+# многозначные атрибуты (rt_attr_multi)
+INDEXES: Dict[str, Dict[str, Tuple[str, ...]]] = {
+    "stories": {
+        "fields": ("title", "summary", "notes", "match_author", "original_title", "original_author"),
+        "attrs": (
+            "first_published_at", "words", "rating_id", "vote_total", "vote_value", "comments_count",
+            "finished", "original", "freezed", "draft", "approved",
+        ),
+        "multi": ("character", "tag", "author"),
+    },
+    "chapters": {
+        "fields": ("title", "notes", "text"),
+        "attrs": (
+            "story_id", "first_published_at", "words", "chapter_draft", "rating_id", "vote_total",
+            "vote_value", "comments_count", "finished", "original", "freezed", "draft", "approved",
+        ),
+        "multi": ("character", "tag", "author"),
+    },
+}
+
+_query_token_re = re.compile(r'([-!]?)(?:"((?:[^"\\]|\\.)*)"|(\w+)\*?)|(\|)')
+_word_re = re.compile(r"\w+")
+_tag_re = re.compile(r"<[^>]*>")
+
+
+def parse_query(query: str, min_word_len: int = 2) -> Tuple[List[List[str]], List[str], Set[str]]:
+    """Переводит запрос Sphinx в упрощённую форму: список групп (внутри
+    группы — альтернативы через «|», между группами — И), список
+    исключаемых термов и набор начал слов для подсветки.
+
+    Поддерживаются слова, фразы в кавычках, «=» перед фразой, «|» и
+    отрицание «-» или «!»; остальные операторы игнорируются.
+    """
+
+    # Экранирование из SphinxConnection.escape_match и режим exact ('="..."')
+    query = re.sub(r"\\(.)", r"\1", query.replace('="', '"'))
+
+    groups: List[List[str]] = []
+    exclude: List[str] = []
+    prefixes: Set[str] = set()
+    join_next = False
+
+    for m in _query_token_re.finditer(query):
+        negative, phrase, word, or_op = m.groups()
+        if or_op:
+            join_next = bool(groups)
+            continue
+
+        if phrase is not None:
+            words = [x.lower() for x in _word_re.findall(phrase)]
+            if not words:
+                continue
+            term = '"{}"'.format(" ".join(words))
+            prefixes.update(words)
+        else:
+            word = word.lower()
+            if len(word) < min_word_len:
+                continue
+            # Вместо стемминга ищем по началу слова: «единороги» найдёт «единорог»
+            stem = word[:max(3, len(word) - 2)]
+            term = '"{}"*'.format(stem) if len(stem) < len(word) else '"{}"'.format(word)
+            prefixes.add(stem)
+
+        if negative:
+            exclude.append(term)
+        elif join_next:
+            groups[-1].append(term)
+        else:
+            groups.append([term])
+        join_next = False
+
+    return groups, exclude, prefixes
+
+
+def build_match_query(groups: List[List[str]], exclude: List[str]) -> str:
+    sql = " AND ".join("(" + " OR ".join(x) + ")" for x in groups)
+    if exclude:
+        sql = "({}) NOT ({})".format(sql, " OR ".join(exclude))
+    return sql
+
+
+def build_snippet(
+    text: str,
+    prefixes: Iterable[str],
+    limit: int = 256,
+    around: int = 5,
+    chunk_separator: str = " ... ",
+    before_match: str = "<b>",
+    after_match: str = "</b>",
+    html_strip_mode: str = "index",
+    **options: Any
+) -> str:
+    """Строит сниппет примерно так же, как CALL SNIPPETS: куски по around
+    слов вокруг совпадений, склеенные через chunk_separator, общей длиной
+    не больше limit символов.
+    """
+
+    if html_strip_mode != "none":
+        text = html.unescape(_tag_re.sub(" ", text))
+    prefixes = tuple(x.lower() for x in prefixes if x)
+
+    tokens = [(m.start(), m.end()) for m in _word_re.finditer(text)]
+    if not tokens:
+        return ""
+    matched = [i for i, (start, end) in enumerate(tokens) if prefixes and text[start:end].lower().startswith(prefixes)]
+    if not matched:
+        # Совпадений в этом тексте нет — как и Sphinx, показываем начало
+        windows = [(0, min(len(tokens), around * 2) - 1)]
+    else:
+        windows = []
+        for i in matched:
+            lo, hi = max(0, i - around), min(len(tokens) - 1, i + around)
+            if windows and lo <= windows[-1][1] + 1:
+                windows[-1] = (windows[-1][0], hi)
+            else:
+                windows.append((lo, hi))
+
+    matched_set = set(matched)
+    chunks: List[str] = []
+    length = 0
+    for lo, hi in windows:
+        chunk = ""
+        pos = tokens[lo][0]
+        for i in range(lo, hi + 1):
+            start, end = tokens[i]
+            chunk += html.escape(text[pos:start])
+            word = html.escape(text[start:end])
+            chunk += before_match + word + after_match if i in matched_set else word
+            pos = end
+        if hi == len(tokens) - 1:
+            chunk += html.escape(text[pos:])
+        chunk = " ".join(chunk.split())
+        if chunks and length + len(chunk) > limit:
+            break
+        chunks.append(chunk)
+        length += len(chunk)
+
+    result = chunk_separator.join(chunks)
+    if windows[0][0] > 0:
+        result = chunk_separator + result
+    if windows[len(chunks) - 1][1] < len(tokens) - 1:
+        result += chunk_separator
+    return result
+
+
+class FTS5SearchConnection(SphinxConnection):
+    def __init__(self, conn: Dict[str, Any]):  # pylint: disable=super-init-not-called
+        self.path = conn["path"]
+        self.min_word_len = conn.get("min_word_len", 2)
+        self.sqlite_conn = sqlite3.connect(
+            self.path,
+            timeout=conn.get("timeout", 30),
+            check_same_thread=False,
+        )
+        self.sqlite_conn.execute("pragma journal_mode=wal")
+        self._with_level = 0
+        self.create_tables()
+
+    def create_tables(self) -> None:
+        for index, schema in INDEXES.items():
+            self.sqlite_conn.execute(
+                "create table if not exists `{0}` (id integer primary key, {1})".format(
+                    index, ", ".join("`{}` integer not null default 0".format(x) for x in schema["attrs"])
+                )
+            )
+            self.sqlite_conn.execute(
+                "create virtual table if not exists `{0}_fts` using fts5({1}, tokenize='unicode61 remove_diacritics 2')".format(
+                    index, ", ".join(schema["fields"])
+                )
+            )
+            # Многозначные атрибуты: по строке на каждое значение
+            self.sqlite_conn.execute(
+                "create table if not exists `{0}_mva` (id integer not null, attr text not null, value integer not null)".format(index)
+            )
+            self.sqlite_conn.execute(
+                "create index if not exists `{0}_mva_value` on `{0}_mva` (attr, value, id)".format(index)
+            )
+            self.sqlite_conn.execute("create index if not exists `{0}_mva_id` on `{0}_mva` (id)".format(index))
+        self.sqlite_conn.commit()
+
+    def ping(self) -> None:
+        self.sqlite_conn.execute("select 1")
+
+    def close(self) -> None:
+        self.sqlite_conn.close()
+
+    def tables(self) -> Sequence[Tuple[str, str]]:
+        return [(x, "rt") for x in INDEXES]
+
+    def _execute(self, sql: str, args: Optional[Sequence[Any]] = None) -> sqlite3.Cursor:
+        return self.sqlite_conn.execute(sql, tuple(args or ()))
+
+    def begin(self) -> None:
+        pass
+
+    def commit(self) -> None:
+        self.sqlite_conn.commit()
+
+    def rollback(self) -> None:
+        self.sqlite_conn.rollback()
+
+    def flush(self, index: str) -> None:
+        self._execute("insert into `{0}_fts` (`{0}_fts`) values ('optimize')".format(index))
+
+    def _schema(self, index: str) -> Dict[str, Tuple[str, ...]]:
+        try:
+            return INDEXES[index]
+        except KeyError:
+            raise SphinxError("unknown index {!r}".format(index))
+
+    def build_where(self, filters: Dict[str, Any], index: Optional[str] = None) -> Tuple[str, List[Any]]:
+        # Обычные атрибуты обрабатываются как в Sphinx, а многозначные
+        # превращаются в подзапросы к таблице _mva
+        multi = self._schema(index)["multi"] if index is not None else ()
+        parts: List[str] = []
+        args: List[Any] = []
+
+        for f, x in filters.items():
+            name, _, action = f.partition("__")
+            if name not in multi:
+                wsql, wargs = super().build_where({f: x})
+                if wsql:
+                    parts.append(wsql.replace("%s", "?"))
+                    args.extend(wargs)
+                continue
+
+            subquery = "select id from `{}_mva` where attr = ? and value".format(index)
+            if not action:
+                parts.append("id in ({} = ?)".format(subquery))
+                args.extend((name, x))
+            elif action in ("in", "in_any", "not_in"):
+                if x:
+                    parts.append("id {} ({} in ({}))".format(
+                        "not in" if action == "not_in" else "in",
+                        subquery,
+                        ", ".join("?" for _ in x),
+                    ))
+                    args.append(name)
+                    args.extend(x)
+            elif action == "in_all":
+                for v in x:
+                    parts.append("id in ({} = ?)".format(subquery))
+                    args.extend((name, v))
+            else:
+                raise ValueError("Unknown action %r for multi-value attribute" % action)
+
+        return " and ".join(parts), args
+
+    def _filtered_ids_sql(self, index: str, filters: Dict[str, Any]) -> Tuple[str, List[Any]]:
+        if "filters" in filters:
+            filters = filters["filters"]
+        sql = "select id from `{}`".format(index)
+        wsql, args = self.build_where(filters, index=index)
+        if wsql:
+            sql += " where " + wsql
+        return sql, args
+
+    def _translate_sort(self, sort_by: Optional[Union[str, Sequence[str]]], has_query: bool) -> str:
+        if sort_by is None:
+            return "weight desc, id" if has_query else "id"
+        if not isinstance(sort_by, str):
+            sort_by = ", ".join(sort_by)
+        sort_by = re.sub(r"(?i)weight\(\)", "weight", sort_by)
+        sort_by = re.sub(r"(?i)rand\(\)", "random()", sort_by)
+        return sort_by + ", id"
+
+    def search(
+        self,
+        index: str,
+        query: str,
+        fields: Sequence[str] = ("id",),
+        raw_fields: Sequence[str] = ("WEIGHT() AS weight",),
+        sort_by: Optional[Union[str, Sequence[str]]] = None,
+        limit: Optional[Union[int, Tuple[int, int]]] = None,
+        options: Optional[Dict[str, Any]] = None,
+        weights: Optional[Dict[str, Any]] = None,
+        extended_syntax: bool = True,
+        meta: bool = True,
+        **filters: Any
+    ) -> SphinxSearchResult:
+        schema = self._schema(index)
+        options = dict(options or {})
+        options.setdefault("max_matches", 1000)
+        max_matches = int(options["max_matches"])
+
+        if not extended_syntax:
+            query = self.escape_match(query)
+        groups, exclude, _ = parse_query(query, self.min_word_len)
+        if not groups and exclude:
+            # Как и в Sphinx, запрос из одних отрицаний ничего не находит
+            return SphinxSearchResult(matches=[], meta={"total_found": 0, "total": 0, "max_matches": max_matches})
+
+        select_fields = ["a.id"] + ["a.`{}`".format(x) for x in fields if x != "id"]
+        if groups:
+            weights = weights or {}
+            bm25 = "bm25(`{}_fts`, {})".format(index, ", ".join(str(float(weights.get(x, 1))) for x in schema["fields"]))
+            # bm25 отрицателен, и чем меньше, тем лучше
+            select_fields.append("cast(-1000 * {} as integer) + 1 as weight".format(bm25))
+            sql = "from `{0}_fts` f join `{0}` a on a.id = f.rowid where `{0}_fts` match ?".format(index)
+            args: List[Any] = [build_match_query(groups, exclude)]
+        else:
+            select_fields.append("1 as weight")
+            sql = "from `{0}` a where 1".format(index)
+            args = []
+
+        if "filters" in filters:
+            filters = filters["filters"]
+        wsql, wargs = self.build_where(filters, index=index)
+        if wsql:
+            sql += " and " + wsql
+            args.extend(wargs)
+
+        select_sql = "select {} {} order by {}".format(
+            ", ".join(select_fields), sql, self._translate_sort(sort_by, bool(groups))
+        )
+        if limit is not None:
+            offset, count = (0, limit) if isinstance(limit, int) else limit
+            count = max(0, min(count, max_matches - offset))
+            select_sql += " limit {:d} offset {:d}".format(count, offset)
+
+        try:
+            cur = self._execute(select_sql, args)
+            result_fields = [x[0] for x in cur.description]
+            matches = [dict(zip(result_fields, x)) for x in cur.fetchall()]
+
+            meta_result: Optional[Dict[str, Any]] = None
+            if meta:
+                total_found = self._execute("select count(*) " + sql, args).fetchone()[0]
+                meta_result = {
+                    "total": min(total_found, max_matches),
+                    "total_found": total_found,
+                    "max_matches": max_matches,
+                }
+        except sqlite3.OperationalError as exc:
+            if "fts5" not in str(exc):
+                raise
+            raise SphinxError(str(exc))
+
+        return SphinxSearchResult(matches=matches, meta=meta_result, sql=(select_sql, tuple(args)))
+
+    def call_snippets(self, index: str, texts: Union[str, Sequence[str]], query: str, **options: Any) -> List[str]:
+        if isinstance(texts, str):
+            texts = [texts]
+        _, _, prefixes = parse_query(query, self.min_word_len)
+        return [build_snippet(text, prefixes, **options) for text in texts]
+
+    def select_highlights(
+        self, index: str, ids: Sequence[int], query: str, field: str = "text", **options: Any
+    ) -> Dict[int, str]:
+        ids = list(ids)
+        if not ids:
+            return {}
+        if field not in self._schema(index)["fields"]:
+            raise SphinxError("unknown field {!r}".format(field))
+
+        _, _, prefixes = parse_query(query, self.min_word_len)
+        cur = self._execute(
+            "select rowid, `{}` from `{}_fts` where rowid in ({})".format(field, index, ", ".join("?" for _ in ids)),
+            ids,
+        )
+        return {int(row_id): build_snippet(text or "", prefixes, **options) for row_id, text in cur.fetchall()}
+
+    def call_keywords(self, index: str, query: str, hits: bool = False) -> List[Dict[str, Any]]:
+        result = []
+        for i, word in enumerate(_word_re.findall(query.lower()), 1):
+            item: Dict[str, Any] = {"qpos": str(i), "tokenized": word, "normalized": word}
+            if hits:
+                item["docs"] = item["hits"] = str(self._execute(
+                    "select count(*) from `{}_fts` where `{}_fts` match ?".format(index, index),
+                    ['"{}"'.format(word)],
+                ).fetchone()[0])
+            result.append(item)
+        return result
+
+    def _delete_ids(self, index: str, ids_sql: str, args: Sequence[Any]) -> None:
+        ids = [x[0] for x in self._execute(ids_sql, args).fetchall()]
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            self._execute("delete from `{}` where id in ({})".format(index, placeholders), chunk)
+            self._execute("delete from `{}_fts` where rowid in ({})".format(index, placeholders), chunk)
+            self._execute("delete from `{}_mva` where id in ({})".format(index, placeholders), chunk)
+
+    def add(self, index: str, items: Sequence[Dict[str, Any]], replace: bool = True) -> None:
+        if not items:
+            return
+        schema = self._schema(index)
+        ids = [item["id"] for item in items]
+
+        if replace:
+            self._delete_ids(index, "select value from json_each(?)", [str(ids)])
+        else:
+            placeholders = ", ".join("?" for _ in ids)
+            if self._execute("select 1 from `{}` where id in ({}) limit 1".format(index, placeholders), ids).fetchone():
+                raise SphinxError("duplicate id in insert into {}".format(index))
+
+        attrs = schema["attrs"]
+        self.sqlite_conn.executemany(
+            "insert into `{}` (id, {}) values (?, {})".format(
+                index, ", ".join("`{}`".format(x) for x in attrs), ", ".join("?" for _ in attrs)
+            ),
+            [[item["id"]] + [int(item.get(x) or 0) for x in attrs] for item in items],
+        )
+        fields = schema["fields"]
+        self.sqlite_conn.executemany(
+            "insert into `{}_fts` (rowid, {}) values (?, {})".format(
+                index, ", ".join(fields), ", ".join("?" for _ in fields)
+            ),
+            [[item["id"]] + [item.get(x) or "" for x in fields] for item in items],
+        )
+        self.sqlite_conn.executemany(
+            "insert into `{}_mva` (id, attr, value) values (?, ?, ?)".format(index),
+            [(item["id"], attr, int(v)) for item in items for attr in schema["multi"] for v in item.get(attr) or ()],
+        )
+
+    def update(self, index: str, fields: Dict[str, Any], **filters: Any) -> None:
+        if not fields:
+            raise ValueError("Empty fields list is not allowed")
+        schema = self._schema(index)
+        ids_sql, args = self._filtered_ids_sql(index, filters)
+
+        attrs = {k: v for k, v in fields.items() if k in schema["attrs"]}
+        unknown = set(fields) - set(schema["attrs"]) - set(schema["multi"])
+        if unknown:
+            # Как и Sphinx, полнотекстовые поля через UPDATE не меняем
+            raise SphinxError("cannot update fields {} in {}".format(", ".join(sorted(unknown)), index))
+
+        if attrs:
+            self._execute(
+                "update `{}` set {} where id in ({})".format(
+                    index, ", ".join("`{}` = ?".format(k) for k in attrs), ids_sql
+                ),
+                [int(v or 0) for v in attrs.values()] + list(args),
+            )
+
+        for attr in schema["multi"]:
+            if attr not in fields:
+                continue
+            ids = [x[0] for x in self._execute(ids_sql, args).fetchall()]
+            self._execute(
+                "delete from `{}_mva` where attr = ? and id in (select value from json_each(?))".format(index),
+                [attr, str(ids)],
+            )
+            self.sqlite_conn.executemany(
+                "insert into `{}_mva` (id, attr, value) values (?, ?, ?)".format(index),
+                [(x, attr, int(v)) for x in ids for v in fields[attr] or ()],
+            )
+
+    def delete(self, index: str, **filters: Any) -> None:
+        self._schema(index)
+        ids_sql, args = self._filtered_ids_sql(index, filters)
+        self._delete_ids(index, ids_sql, args)
+
+
+class FTS5SearchPool(SphinxPool):
+    def _create_connection(self) -> FTS5SearchConnection:
+        return FTS5SearchConnection(self.conn)
@@ -8,6 +8,7 @@ import re
 import sys
 import logging
 import importlib
+import threading
 from datetime import datetime
 from logging.handlers import SMTPHandler
 
@@ -28,7 +29,7 @@ from flask_cors import CORS
 from pony import orm
 
 from mini_fiction import models  # pylint: disable=unused-import
-from mini_fiction import database, tasks, context_processors, ratelimit
+from mini_fiction import database, tasks, context_processors, ratelimit, search_queue, view_queue, published_ids, leaderboards
 from mini_fiction.bl import init_bl
 from mini_fiction.logic import frontend
 
@@ -107,6 +108,10 @@ def create_app():
     configure_i18n(app)
     configure_cache(app)
     configure_rate_limit(app)
+    configure_search_queue(app)
+    configure_view_queue(app)
+    configure_published_story_ids(app)
+    configure_leaderboards(app)
     configure_forms(app)
     configure_users(app)
     configure_error_handlers(app)
@@ -246,6 +251,31 @@ def configure_rate_limit(app):
         app.rate_limiter = ratelimit.NullRateLimiter(app)
 
 
+def configure_search_queue(app):
+    if app.config.get('SEARCH_QUEUE_BACKEND'):
+        app.search_queue = search_queue.RedisSearchQueue(app)
+    else:
+        app.search_queue = search_queue.NullSearchQueue(app)
+
+
+def configure_view_queue(app):
+    if app.config.get('VIEW_QUEUE_BACKEND'):
+        app.view_queue = view_queue.RedisViewQueue(app)
+    else:
+        app.view_queue = view_queue.NullViewQueue(app)
+
+
+def configure_published_story_ids(app):
+    if app.config.get('PUBLISHED_STORY_IDS_BACKEND'):
+        app.published_story_ids = published_ids.RedisPublishedStoryIds(app)
+    else:
+        app.published_story_ids = published_ids.CachePublishedStoryIds(app)
+
+
+def configure_leaderboards(app):
+    app.leaderboards = leaderboards.StoryLeaderboards(app)
+
+
 def configure_forms(app):
     app.csrf = CSRFProtect(app)
 
@@ -464,13 +494,23 @@ def configure_templates(app):
 
 
 def configure_search(app):
-    from mini_fiction.apis import amsphinxql
-    app.sphinx = amsphinxql.SphinxPool(app.config['SPHINX_CONFIG']['connection_params'])
+    pool_options = app.config['SPHINX_CONFIG'].get('pool') or {}
+    if app.config['SEARCH_BACKEND'] == 'fts5':
+        from mini_fiction.apis import fts5search
+        conn = dict(app.config['FTS5_SEARCH_CONFIG'])
+        conn.setdefault('min_word_len', app.config['SPHINX_INDEX_OPTIONS']['min_word_len'])
+        app.sphinx = fts5search.FTS5SearchPool(conn, **pool_options)
+    elif app.config['SEARCH_BACKEND'] == 'sphinx':
+        from mini_fiction.apis import amsphinxql
+        app.sphinx = amsphinxql.SphinxPool(app.config['SPHINX_CONFIG']['connection_params'], **pool_options)
+    else:
+        raise ValueError('Unknown SEARCH_BACKEND: {!r}'.format(app.config['SEARCH_BACKEND']))
 
 
 def configure_celery(app):
     app.celery = Celery('mini_fiction', broker=app.config['CELERY_CONFIG']['broker_url'])
     app.celery.conf.update(app.config['CELERY_CONFIG'])
+    app.celery.conf.beat_schedule = get_celery_beat_schedule(app.config)
 
     TaskBase = app.celery.Task
 
@@ -486,6 +526,35 @@ def configure_celery(app):
     tasks.apply_for_app(app)
 
 
+def get_celery_beat_schedule(config):
+    """Расписание celery beat: из CELERY_CONFIG плюс периодические задачи,
+    которые нужны только при определённых настройках. Интервалы берутся
+    из конфига приложения, чтобы их можно было переопределить в
+    local_settings.
+    """
+
+    schedule = dict(config['CELERY_CONFIG'].get('beat_schedule') or {})
+
+    if config.get('SEARCH_QUEUE_BACKEND'):
+        schedule.setdefault('flush_search_queue', {
+            'task': 'sphinx_flush_queue',
+            'schedule': float(config['SEARCH_QUEUE_INTERVAL']),
+        })
+
+    if config.get('VIEW_QUEUE_BACKEND'):
+        schedule.setdefault('flush_view_queue', {
+            'task': 'flush_view_queue',
+            'schedule': float(config['VIEW_QUEUE_INTERVAL']),
+        })
+
+    schedule.setdefault('rebuild_story_top', {
+        'task': 'rebuild_story_top',
+        'schedule': float(config['STORY_TOP_REFRESH_INTERVAL']),
+    })
+
+    return schedule
+
+
 def configure_captcha(app):
     captcha_path = app.config.get('CAPTCHA_CLASS')
     if not captcha_path or '.' not in captcha_path:
@@ -565,6 +634,15 @@ def configure_frontend(app: Flask):
     app.add_template_global(frontend.scripts, name='scripts')
     app.add_template_global(frontend.favicon_bundle, name='favicon_bundle')
 
+    # Load manifests once at startup, requests only check them for changes
+    # from time to time
+    frontend.clear_manifests_registry()
+    with app.app_context():
+        frontend.get_raw_manifests()
+
+    if app.config['FRONTEND_MANIFESTS_RELOAD_ON_SIGHUP'] and threading.current_thread() is threading.main_thread():
+        frontend.install_sighup_handler()
+
 
 def configure_sidebar(app: Flask):
     app.index_sidebar = {}
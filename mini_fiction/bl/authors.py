@@ -815,6 +815,10 @@ class AuthorBL(BaseBL):
             ).prefetch(NewsComment.newsitem)
         } if news_comment_ids else {}
 
+        StoryComment.bl.prefetch_html(story_comments.values())
+        StoryLocalComment.bl.prefetch_html(local_comments.values())
+        NewsComment.bl.prefetch_html(news_comments.values())
+
         # Преобразуем каждое уведомление в json-совместимый формат со всеми дополнениями
         for n in items:
             item = {
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import bisect
+
 from pony import orm
+from flask import current_app
 
 from mini_fiction.utils.misc import Paginator
 
@@ -51,10 +54,7 @@ class Commentable(object):
             if root_count < 1:
                 return []
 
-            root_comment_ids = list(orm.select(
-                x.id for x in self.select_comments()
-                if x.tree_depth == 0
-            ).order_by('x.id')[root_offset:root_offset + root_count])
+            root_comment_ids = self.get_comments_tree_index()['root_ids'][root_offset:root_offset + root_count]
 
             if not root_comment_ids:
                 return []
@@ -74,45 +74,61 @@ class Commentable(object):
         # при вызове его с параметрами по умолчанию, так как он используется
         # в команде checkcomments, что подразумевает, что root_id и tree_depth
         # могут врать
-        tree = []
-        comments_dict = {}
         comments = self.get_comments_list(None, root_offset, root_count, root_id)  # maxdepth=None для подсчёта числа вложенных комментов
 
+        # Карта id -> parent_id строится по уже загруженным комментариям:
+        # c.parent.id берётся из внешнего ключа и не загружает родителя из БД.
+        # Выборка всегда содержит ветки целиком (get_comments_list режет
+        # по root_id), так что все предки каждого коммента тоже в ней
+        parent_ids = {}
         for c in comments:
-            # Проставляем счётчики вложенных комментов по всей ветке выше
-            p = c.parent
-            while p:
-                if p.id in comments_dict:
-                    comments_dict[p.id][2] += 1
-                    if last_viewed_comment is not None and last_viewed_comment < c.id:
-                        comments_dict[p.id][3] += 1
-                p = p.parent
-            del p
+            parent_ids[c.id] = c.parent.id if c.parent is not None else None
+
+        # Родитель всегда старше ответа, поэтому при обходе от новых
+        # комментов к старым счётчики ответа уже окончательно посчитаны
+        # к моменту, когда они прибавляются к родителю
+        answers_counts = dict.fromkeys(parent_ids, 0)
+        unread_counts = dict.fromkeys(parent_ids, 0)
+        for c in reversed(comments):
+            parent_id = parent_ids[c.id]
+            if parent_id not in answers_counts:
+                continue
+            answers_counts[parent_id] += answers_counts[c.id] + 1
+            unread_counts[parent_id] += unread_counts[c.id]
+            if last_viewed_comment is not None and last_viewed_comment < c.id:
+                unread_counts[parent_id] += 1
 
+        tree = []
+        comments_dict = {}
+        for c in comments:
             # Если столь глубокий коммент у нас не просили, не добавляем его в ветку
             if maxdepth is not None and c.tree_depth > maxdepth:
                 continue
 
-            item = [c, [], 0, 0]  # [сам коммент, ответы, число всех вложенных комментов, число вложенных непросмотренных]
+            # [сам коммент, ответы, число всех вложенных комментов, число вложенных непросмотренных]
+            item = [c, [], answers_counts[c.id], unread_counts[c.id]]
             comments_dict[c.id] = item
-            if c.parent is None or c.parent.id not in comments_dict:
+            parent_id = parent_ids[c.id]
+            if parent_id is None or parent_id not in comments_dict:
                 tree.append(item)
             else:
-                comments_dict[c.parent.id][1].append(item)
+                comments_dict[parent_id][1].append(item)
 
         return tree
 
     def get_comments_tree_list(self, maxdepth=None, root_offset=None, root_count=None, root_id=None, last_viewed_comment=None):
-        return self._comments_tree_iter(self.get_comments_tree(maxdepth, root_offset, root_count, root_id, last_viewed_comment=last_viewed_comment))
+        result = self._comments_tree_iter(self.get_comments_tree(maxdepth, root_offset, root_count, root_id, last_viewed_comment=last_viewed_comment))
+        if result:
+            # Весь HTML страницы комментариев достаём из кэша одним запросом
+            type(result[0][0]).bl.prefetch_html([x[0] for x in result])
+        return result
 
     def paginate_comments(self, comments_page=1, per_page=25, maxdepth=None, last_viewed_comment=None):
         target = self.model  # pylint: disable=e1101
 
-        comments_count = target.comments.select().count()
-        if comments_count > 0:
-            root_comments_total = self.select_comments().filter(lambda x: x.tree_depth == 0).count()
-        else:
-            root_comments_total = comments_count
+        tree_index = self.get_comments_tree_index()
+        comments_count = tree_index['count']
+        root_comments_total = len(tree_index['root_ids'])
 
         paged = Paginator(
             number=comments_page,
@@ -134,6 +150,55 @@ class Commentable(object):
 
         return comments_count, paged, comments_tree_list
 
+    # Кэш структуры дерева комментариев: отсортированный список id корневых
+    # комментов (для пагинации) и общее число комментов. Обновляется инкрементально
+    # при создании комментов (см. BaseCommentBL.create). Удалённые комменты
+    # остаются в дереве, поэтому удаление и восстановление его не меняют.
+    # Если число комментов в кэше не совпадает с target.comments_count
+    # (гонка или откат транзакции), структура строится заново
+
+    def get_comments_tree_cache_key(self):
+        target = self.model  # pylint: disable=e1101
+        return '{}_comments_tree_{}'.format(type(target).__name__.lower(), target.id)
+
+    def build_comments_tree_index(self):
+        root_ids = []
+        count = 0
+        comments = orm.select((x.id, x.tree_depth) for x in self.select_comments())
+        for comment_id, tree_depth in comments:
+            if tree_depth == 0:
+                root_ids.append(comment_id)
+            count += 1
+        root_ids.sort()
+        return {'count': count, 'root_ids': root_ids}
+
+    def get_comments_tree_index(self):
+        tree_index = current_app.cache.get(self.get_comments_tree_cache_key())
+        if tree_index is None or tree_index['count'] != self.model.comments_count:  # pylint: disable=e1101
+            tree_index = self.reset_comments_tree_index()
+        return tree_index
+
+    def reset_comments_tree_index(self):
+        tree_index = self.build_comments_tree_index()
+        current_app.cache.set(
+            self.get_comments_tree_cache_key(),
+            tree_index,
+            timeout=current_app.config['COMMENTS_TREE_CACHE_TIME'],
+        )
+        return tree_index
+
+    def add_to_comments_tree_index(self, comment):
+        key = self.get_comments_tree_cache_key()
+        tree_index = current_app.cache.get(key)
+        if tree_index is None:
+            # Нечего обновлять, построится при следующем обращении
+            return
+
+        if comment.tree_depth == 0:
+            bisect.insort(tree_index['root_ids'], comment.id)
+        tree_index['count'] += 1
+        current_app.cache.set(key, tree_index, timeout=current_app.config['COMMENTS_TREE_CACHE_TIME'])
+
     def _comments_tree_iter(self, tree):
         result = []
         for x in tree:
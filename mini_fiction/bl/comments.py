@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import bisect
 import ipaddress
 import traceback
 from datetime import datetime, timedelta
@@ -61,14 +62,9 @@ class BaseCommentBL(BaseBL):
             else:
                 per_page = current_app.config['COMMENTS_COUNT']['page']
 
-        root_comment_ids = list(orm.select(
-            x.id for x in getattr(c, self.target_attr).bl.select_comments()
-            if x.tree_depth == 0 and x.id <= c.root_id
-        ).order_by('x.id'))
-
-        try:
-            root_order = root_comment_ids.index(c.root_id)
-        except ValueError:
+        root_comment_ids = getattr(c, self.target_attr).bl.get_comments_tree_index()['root_ids']
+        root_order = bisect.bisect_left(root_comment_ids, c.root_id)
+        if root_order >= len(root_comment_ids) or root_comment_ids[root_order] != c.root_id:
             return 1
 
         return root_order // per_page + 1
@@ -206,6 +202,8 @@ class BaseCommentBL(BaseBL):
         if parent:
             parent.answers_count += 1
 
+        target.bl.add_to_comments_tree_index(comment)
+        comment.bl.cache_html()
         current_app.cache.delete('index_comments_html_guest')
 
         return comment
@@ -247,6 +245,7 @@ class BaseCommentBL(BaseBL):
         )
         editlog.flush()
 
+        self.cache_html()
         current_app.cache.delete('index_comments_html_guest')
 
         return editlog
@@ -326,6 +325,89 @@ class BaseCommentBL(BaseBL):
             current_app.logger.warning("filter_html_comment_text failed:\n\n%s", traceback.format_exc())
             return "#ERROR#"
 
+    # Кэширование отрендеренного HTML комментариев
+
+    # Чистить ли текст (safe_string_multiline_coerce) перед рендерингом
+    # закэшированного HTML, как в text2html
+    coerce_text_for_html = True
+
+    def _html_cache_key(self, comment):
+        return '{}_html_{}'.format(type(comment).__name__.lower(), comment.id)
+
+    def _render_text_html(self, comment, text):
+        if self.coerce_text_for_html:
+            return self.text2html(text)
+
+        # Как filtered_html_property, которым такие комментарии
+        # рендерились до появления кэша
+        try:
+            return Markup(html_doc_to_string(filter_html(text or '')))
+        except Exception:
+            current_app.logger.warning("filter_html failed: %s %s\n%s", type(comment).__name__, comment.id, traceback.format_exc())
+            return "#ERROR#"
+
+    def _render_html(self, comment):
+        # Версией кэша служит edits_count, так как текст комментария
+        # меняется только через update
+        return (
+            comment.edits_count,
+            str(self._render_text_html(comment, comment.text)),
+            str(self._render_text_html(comment, comment.brief_text)),
+        )
+
+    def _is_html_actual(self, comment, value):
+        return value is not None and value[0] == comment.edits_count
+
+    def get_html(self):
+        '''Возвращает кортеж ``(edits_count, text_html, brief_text_html)``
+        для текущего комментария, по возможности без рендеринга: сперва
+        из загруженного в этом запросе значения, потом из кэша.
+        '''
+
+        c = self.model
+        value = getattr(c, '_html_cache', None)
+        if not self._is_html_actual(c, value):
+            self.prefetch_html([c])
+            value = c._html_cache
+        return value
+
+    def prefetch_html(self, comments):
+        '''Достаёт из кэша отрендеренный HTML для всех переданных комментариев
+        одним запросом, рендерит недостающие и сохраняет их в кэш тоже одним
+        запросом. После этого text_as_html и brief_text_as_html этих
+        комментариев уже не обращаются ни к кэшу, ни к фильтрам.
+        '''
+
+        comments = [c for c in comments if not self._is_html_actual(c, getattr(c, '_html_cache', None))]
+        if not comments:
+            return
+
+        keys = [self._html_cache_key(c) for c in comments]
+        cached_values = current_app.cache.get_many(*keys)
+
+        new_values = {}
+        for key, c, value in zip(keys, comments, cached_values):
+            if not self._is_html_actual(c, value):
+                value = self._render_html(c)
+                if '#ERROR#' not in (value[1], value[2]):
+                    new_values[key] = value
+            c._html_cache = value
+
+        if new_values:
+            current_app.cache.set_many(new_values, timeout=current_app.config['COMMENT_HTML_CACHE_TIME'])
+
+    def cache_html(self):
+        '''Рендерит HTML текущего комментария и сохраняет его в кэш.
+        Вызывается после создания и редактирования комментария.
+        '''
+
+        c = self.model
+        value = self._render_html(c)
+        c._html_cache = value
+        if '#ERROR#' not in (value[1], value[2]):
+            current_app.cache.set(self._html_cache_key(c), value, timeout=current_app.config['COMMENT_HTML_CACHE_TIME'])
+        return value
+
 
 class StoryCommentBL(BaseCommentBL):
     target_attr = 'story'
@@ -434,7 +516,8 @@ class StoryCommentBL(BaseCommentBL):
 
         comment = super().create(target, author, ip, data)
         later(current_app.tasks['notify_story_comment'].delay, comment.id)
-        later(current_app.tasks['sphinx_update_comments_count'].delay, comment.story.id)
+        later(current_app.search_queue.push_story, comment.story.id, ('comments_count',))
+        later(comment.story.bl.reset_users_state, comment.story.id)
 
         if comment.author:
             comment.author.all_story_comments_count += 1
@@ -472,6 +555,7 @@ class StoryLocalCommentBL(BaseCommentBL):
     can_vote = False
     can_abuse = False
     schema = STORY_COMMENT
+    coerce_text_for_html = False
 
     def has_comments_access(self, target, author=None):
         return author and (author.is_staff or target.story.bl.is_contributor(author))
@@ -533,6 +617,7 @@ class NewsCommentBL(BaseCommentBL):
     can_vote = True
     can_abuse = True
     schema = NEWS_COMMENT
+    coerce_text_for_html = False
 
     def access_for_commenting_by(self, target, author=None):
         if (not author or not author.is_authenticated) and not current_app.config['NEWS_COMMENTS_BY_GUEST']:
@@ -12,5 +12,9 @@ def enrich_story(story):
 
 
 def enrich_stories(stories):
+    from mini_fiction.view_queue import get_pending_views
+
     for story in stories:
         enrich_story(story)
+    # Ожидающие просмотры для всего списка одним запросом к очереди
+    get_pending_views('story', [x.id for x in stories])
@@ -4,7 +4,7 @@ import json
 import random
 import ipaddress
 import traceback
-from hashlib import md5
+from hashlib import md5, sha1
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -13,18 +13,18 @@ from typing import TYPE_CHECKING, Any, Union, Optional, Dict, Tuple, List, Itera
 import lxml.html
 import lxml.etree
 from pony import orm
-from flask import current_app
+from flask import current_app, g
 from markupsafe import Markup
 
 from mini_fiction.bl.migration import enrich_stories
 from mini_fiction.ratelimit import RateLimitExceeded
-from mini_fiction.apis.amsphinxql import SphinxSearchResult
+from mini_fiction.apis.amsphinxql import SphinxSearchResult, estimate_item_size
 from mini_fiction.bl.utils import BaseBL
 from mini_fiction.bl.commentable import Commentable
 from mini_fiction.logic import tags
 from mini_fiction.utils.converter import convert
 from mini_fiction.utils.misc import words_count, call_after_request as later
-from mini_fiction.utils.misc import normalize_text_for_search_index, normalize_text_for_search_query
+from mini_fiction.utils.misc import normalize_text_for_search_index, normalize_text_for_search_query, trim_text_around_match
 from mini_fiction.utils import diff as utils_diff
 from mini_fiction.validation import Validator, ValidationError
 from mini_fiction.validation.stories import STORY
@@ -51,6 +51,103 @@ class ChapterSearchResult(SphinxSearchResult):
     chapters: List[Tuple["Chapter", str]] = field(default_factory=list)
 
 
+@dataclass
+class UserStoryState:
+    accessible: bool = True
+    favorited: bool = False
+    bookmarked: bool = False
+    # Число просмотров глав (у старых рассказов у главы может быть
+    # несколько просмотров) и число комментариев при последнем посещении
+    read_chapters_count: int = 0
+    last_comments: Optional[int] = None
+    # {chapter_id: дата просмотра}
+    chapter_view_dates: Dict[int, datetime] = field(default_factory=dict)
+    unread_chapters_count: int = 0
+    unread_comments_count: int = 0
+
+    def update_unread_counts(self, chapters_count: int, comments_count: int) -> None:
+        self.unread_chapters_count = 0
+        self.unread_comments_count = 0
+        if not self.accessible:
+            return
+        if self.read_chapters_count and chapters_count:
+            self.unread_chapters_count = max(0, chapters_count - self.read_chapters_count)
+        if self.last_comments is not None and comments_count:
+            self.unread_comments_count = max(0, comments_count - self.last_comments)
+
+
+def _search_fields_group_key(fields):
+    # Поля с одинаковыми значениями можно обновить у нескольких объектов одним запросом
+    return tuple(sorted(
+        (k, tuple(v) if isinstance(v, list) else v)
+        for k, v in fields.items()
+    ))
+
+
+def _search_cache_version_key(index):
+    return 'search_version_{}'.format(index)
+
+
+def _get_search_cache_version(index):
+    version = current_app.cache.get(_search_cache_version_key(index))
+    if version is None:
+        version = random.getrandbits(63)
+        current_app.cache.set(_search_cache_version_key(index), version, timeout=0)
+    return version
+
+
+# Счётчики, которые меняются на каждый голос и комментарий: из-за них
+# кэш поиска не сбрасывается, а расхождение в сортировке и фильтрах по ним
+# проживёт не дольше SEARCH_RESULTS_CACHE_TIME
+SEARCH_CACHE_DRIFTING_FIELDS = frozenset(('vote_total', 'vote_value', 'comments_count'))
+
+
+def reset_search_cache(*indexes):
+    '''Сбрасывает закэшированные результаты поиска по указанным индексам;
+    вызывается при добавлении и удалении документов и при изменении полей,
+    по которым ищут и фильтруют (кроме SEARCH_CACHE_DRIFTING_FIELDS).'''
+
+    for index in indexes:
+        current_app.cache.set(_search_cache_version_key(index), random.getrandbits(63), timeout=0)
+
+
+def cached_sphinx_search(index: str, query: str, **kwargs: Any) -> SphinxSearchResult:
+    '''Выполняет sphinx.search, кэшируя результат (id, веса и meta) на
+    SEARCH_RESULTS_CACHE_TIME секунд. Ключ кэша — хэш от всех параметров
+    поиска, поэтому одинаковые запросы гостей и поисковых роботов (страницы
+    тегов, персонажей, рейтингов) не доходят до Sphinx. Кэш индекса
+    сбрасывается через reset_search_cache при его изменении.
+    '''
+
+    timeout = current_app.config['SEARCH_RESULTS_CACHE_TIME']
+    if not timeout:
+        with current_app.sphinx as sphinx:
+            return sphinx.search(index, query, **kwargs)
+
+    # Порядок значений в фильтрах вида id__in не влияет на результат
+    params = {
+        k: sorted(v) if '__' in k and isinstance(v, (list, tuple, set)) else v
+        for k, v in kwargs.items()
+    }
+    params_hash = sha1(json.dumps(
+        [index, query, params],
+        sort_keys=True,
+        ensure_ascii=False,
+        default=list,
+    ).encode('utf-8')).hexdigest()
+    cache_key = 'search_result_{}_{}'.format(index, params_hash)
+
+    version = _get_search_cache_version(index)
+    cached = current_app.cache.get(cache_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with current_app.sphinx as sphinx:
+        result = sphinx.search(index, query, **kwargs)
+    current_app.cache.set(cache_key, (version, result), timeout=timeout)
+    return result
+
+
 class StoryBL(BaseBL, Commentable):
     sort_types = {
         0: "weight() DESC, first_published_at DESC",
@@ -145,7 +242,7 @@ class StoryBL(BaseBL, Commentable):
 
         current_app.cache.delete('index_updated_chapters')
 
-        later(current_app.tasks['sphinx_update_story'].delay, story.id, None)
+        later(current_app.search_queue.push_story, story.id, None)
         return story
 
     def edit_log(self, editor, data):
@@ -229,7 +326,7 @@ class StoryBL(BaseBL, Commentable):
             self._publish_changed_event(caused_by_user=editor)
 
         if changed_sphinx_fields:
-            later(current_app.tasks['sphinx_update_story'].delay, story.id, tuple(changed_sphinx_fields))
+            later(current_app.search_queue.push_story, story.id, tuple(changed_sphinx_fields))
         return story
 
     def _publish_changed_event(self, caused_by_user=None, tm=None):
@@ -278,6 +375,10 @@ class StoryBL(BaseBL, Commentable):
 
         current_app.cache.delete('index_updated_chapters')
         current_app.cache.delete('index_comments_html')
+        later(current_app.published_story_ids.set_published, story.id, published)
+        later(self.reset_users_state, story.id)
+        if published:
+            later(self.schedule_downloads_build, story.id)
 
     def approve(self, user, approved):
         # TODO: с publish() очень много общего, можно вынести общее в отдельную функцию
@@ -318,7 +419,7 @@ class StoryBL(BaseBL, Commentable):
             self._publish_changed_event(caused_by_user=user, tm=tm)
 
         if changed_sphinx_fields:
-            later(current_app.tasks['sphinx_update_story'].delay, story.id, tuple(changed_sphinx_fields))
+            later(current_app.search_queue.push_story, story.id, tuple(changed_sphinx_fields))
 
     def publish(self, user, published):
         # TODO: с approve() очень много общего, можно вынести общее в отдельную функцию
@@ -390,7 +491,7 @@ class StoryBL(BaseBL, Commentable):
                     changed_sphinx_fields.add('first_published_at')
                 self._publish_changed_event(caused_by_user=user, tm=tm)
 
-            later(current_app.tasks['sphinx_update_story'].delay, story.id, tuple(changed_sphinx_fields))
+            later(current_app.search_queue.push_story, story.id, tuple(changed_sphinx_fields))
 
             return True
 
@@ -430,14 +531,16 @@ class StoryBL(BaseBL, Commentable):
                 data={'draft': (True, False)},
             )
             story.words += c.words
-            later(current_app.tasks['sphinx_update_chapter'].delay, c.id)
+            later(current_app.search_queue.push_chapter, c.id)
             if story.published and not c.first_published_at:
                 c.bl.first_publish(tm=tm, notify=False, caused_by_user=user)  # Уведомления разошлём сами чуть ниже
                 published_chapter_ids.append(c.id)
 
         story.all_chapters_count = chapters_count
         story.published_chapters_count = chapters_count
-        later(current_app.tasks['sphinx_update_story'].delay, story.id, ('words',))
+        later(current_app.search_queue.push_story, story.id, ('words',))
+        later(story.bl.reset_users_state, story.id)
+        later(story.bl.schedule_downloads_build, story.id)
 
         if published_chapter_ids:
             later(current_app.tasks['notify_story_chapters'].delay, published_chapter_ids, user.id if user else None)
@@ -449,6 +552,8 @@ class StoryBL(BaseBL, Commentable):
 
         story = self.model
         later(current_app.tasks['sphinx_delete_story'].delay, story.id)
+        if story.published:
+            later(current_app.published_story_ids.remove, story.id)
 
         # При необходимости уведомляем модераторов об удалении
         # (учтите, что код отправки уведомления выполнится не сейчас, а после удаления)
@@ -541,32 +646,41 @@ class StoryBL(BaseBL, Commentable):
         if not user.is_authenticated:
             return
 
-        from mini_fiction.models import Activity
+        # Activity обновится, когда очередь просмотров применит просмотр
+        # (при выключенной очереди — прямо сейчас)
+        story = self.model
+        current_app.view_queue.push_story_view(
+            user.id, story.id, datetime.utcnow(), views=story.views, comments_count=story.comments_count,
+        )
+
+        def update_state(state):
+            state.last_comments = story.comments_count
+            state.update_unread_counts(story.published_chapters_count, story.comments_count)
+
+        self.update_cached_user_state(user, story.id, update_state)
+
+    def get_views_count(self):
+        '''Число просмотров рассказа вместе с ещё не применёнными
+        просмотрами из очереди просмотров.
+        '''
+
+        from mini_fiction.view_queue import get_pending_views
 
         story = self.model
-        last_comment = self.select_comments().order_by('-c.id').first()
-        data = {
-            'last_views': story.views,
-            'last_comments': story.comments_count,
-            'last_comment_id': last_comment.id if last_comment else 0,
-        }
+        return story.views + get_pending_views('story', [story.id])[story.id]
 
-        acts = list(Activity.select(lambda x: x.story == story and x.author == user))
-        if acts:
-            for act in acts[1:]:
-                # Если по каким-то причинам сайт лаганул и насоздавал активитей, то удаляем лишнее
-                act.delete()
-            act = acts[0]
-        else:
-            act = None
-        del acts
+    def get_chapters_views_count(self, chapters):
+        '''Число просмотров глав рассказа вместе с ещё не применёнными
+        просмотрами; очередь просмотров запрашивается один раз для всех глав.
 
-        if not act:
-            act = Activity(story=story, author=user, **data)
-        else:
-            for k, v in data.items():
-                setattr(act, k, v)
-        return act
+        :param chapters: главы
+        :return: словарь {chapter_id: число просмотров}
+        '''
+
+        from mini_fiction.view_queue import get_pending_views
+
+        pending = get_pending_views('chapter', [x.id for x in chapters])
+        return {x.id: x.views + pending[x.id] for x in chapters}
 
     def vote(self, user, value, ip):
         from mini_fiction.models import Vote
@@ -584,6 +698,7 @@ class StoryBL(BaseBL, Commentable):
         ip = ipaddress.ip_address(ip).exploded
 
         vote = Vote.select(lambda x: x.author == user and x.story == story).for_update().first()
+        changes = []
         if not vote:
             vote = Vote(
                 author=user,
@@ -592,21 +707,39 @@ class StoryBL(BaseBL, Commentable):
                 ip=ip,
                 revoked_at=None,
             )
+            changes.append((None, value))
         elif value != vote.vote_value:
+            # Отозванная оценка не учитывается в рейтинге, даже если её поменять
+            if vote.revoked_at is None:
+                changes.append((vote.vote_value, value))
             vote.vote_value = value
             vote.ip = ip
             vote.updated = datetime.utcnow()
         vote.flush()
-        self.update_rating()
+        if changes:
+            self.update_rating(changes)
         return vote
 
-    def update_rating(self):
+    def update_rating(self, changes=None):
+        '''Обновляет рейтинг рассказа. Если передан список изменённых оценок
+        (пары ``(старая оценка, новая оценка)``, см.
+        ``BaseVoting.apply_vote_changes``), рейтинг обновляется по ним,
+        иначе пересчитывается по всем оценкам.
+        '''
+
         if not current_app.story_voting:
             return
         story = self.model
-        current_app.story_voting.update_rating(story)
+        if changes is None:
+            current_app.story_voting.update_rating(story)
+        else:
+            current_app.story_voting.apply_vote_changes(story, changes)
         story.flush()
-        later(current_app.tasks['sphinx_update_story'].delay, story.id, ('vote_total', 'vote_value'))
+        later(
+            current_app.leaderboards.rating_changed,
+            story.id, story.vote_value, story.vote_total, story.first_published_at, story.approved and not story.draft,
+        )
+        later(current_app.search_queue.push_story, story.id, ('vote_total', 'vote_value'))
 
     def vote_view_html(self, user=None, full=False):
         if not current_app.story_voting:
@@ -650,6 +783,41 @@ class StoryBL(BaseBL, Commentable):
 
         return queryset
 
+    def select_top_ids(self, period, count):
+        '''То же, что select_top, но только первые count пар
+        ``(id, vote_value)``; используется для сборки топов в leaderboards.
+        '''
+
+        queryset = orm.select((x.id, x.vote_value) for x in self.select_top(period))
+        return list(queryset.order_by(orm.desc(2), orm.desc(1))[:count])
+
+    def get_top(self, period=0):
+        '''Возвращает id рассказов из топа за период, ближайший к указанному
+        (см. leaderboards.bucket_period), и сам этот период.
+
+        :param int period: период в днях, 0 — за всё время
+        :rtype: tuple
+        '''
+
+        from mini_fiction.leaderboards import bucket_period
+
+        period = bucket_period(period)
+        return current_app.leaderboards.get_ids(period), period
+
+    def get_published_by_ids(self, ids, prefetch=()):
+        '''Загружает опубликованные рассказы с указанными id в том же порядке;
+        рассказов, снятых с публикации после сборки топа, в списке не будет.
+        '''
+
+        ids = list(ids)
+        if not ids:
+            return []
+        queryset = self.model.select(lambda x: x.id in ids and x.approved and not x.draft)
+        if prefetch:
+            queryset = queryset.prefetch(*prefetch)
+        stories = {x.id: x for x in queryset}
+        return [stories[i] for i in ids if i in stories]
+
     def select_by_author(self, author, for_user=None):
         from mini_fiction.models import StoryContributor
 
@@ -836,6 +1004,32 @@ class StoryBL(BaseBL, Commentable):
 
         return True
 
+    def filter_users_with_access(self, users):
+        '''Оставляет из списка зарегистрированных пользователей тех, у кого
+        есть доступ к рассказу (как has_access, но без запроса соавторов на
+        каждого пользователя). Для рассылки уведомлений подписчикам.
+        '''
+
+        users = list(users)
+        if self.model.published:
+            return users
+
+        contributor_ids = {x.user.id for x in self.get_contributors()}
+        # Для остальных пользователей доступ зависит только от настроек
+        # рассказа, так что достаточно проверить одного
+        others_allowed = None
+
+        result = []
+        for user in users:
+            if user.is_staff or user.id in contributor_ids:
+                result.append(user)
+                continue
+            if others_allowed is None:
+                others_allowed = self.has_access(user)
+            if others_allowed:
+                result.append(user)
+        return result
+
     def can_vote(self, user):
         story = self.model
         if not user or not user.is_authenticated:
@@ -848,9 +1042,15 @@ class StoryBL(BaseBL, Commentable):
 
     # search
 
-    def add_stories_to_search(self, stories, with_chapters=True):
+    def add_stories_to_search(self, stories, with_chapters=True, max_batch_bytes=None):
+        '''Добавляет рассказы в поисковый индекс (или заменяет уже добавленные).
+
+        :return: примерный размер отправленных данных рассказов в байтах
+          (без глав)
+        '''
+
         if current_app.config['SPHINX_DISABLED']:
-            return
+            return 0
         sphinx_stories = []
         for story in stories:
             data = {
@@ -869,12 +1069,19 @@ class StoryBL(BaseBL, Commentable):
             sphinx_stories.append(data)
 
         with current_app.sphinx as sphinx:
-            sphinx.add('stories', sphinx_stories)
+            if max_batch_bytes:
+                sphinx.add_batched('stories', sphinx_stories, max_bytes=max_batch_bytes)
+            else:
+                sphinx.add('stories', sphinx_stories)
+        reset_search_cache('stories')
 
         if with_chapters:
             from mini_fiction.models import Chapter
+            # Число слов рассказа уже записано выше вместе с остальными полями
             chapters = sum([list(x.chapters) for x in stories], [])
-            Chapter.bl.add_chapters_to_search(chapters)
+            Chapter.bl.add_chapters_to_search(chapters, update_story_words=False)
+
+        return sum(estimate_item_size(x) for x in sphinx_stories)
 
     def delete_stories_from_search(self, story_ids):
         if current_app.config['SPHINX_DISABLED']:
@@ -883,41 +1090,106 @@ class StoryBL(BaseBL, Commentable):
             sphinx.delete('stories', id__in=story_ids)
         with current_app.sphinx as sphinx:
             sphinx.delete('chapters', story_id__in=story_ids)
+        reset_search_cache('stories', 'chapters')
 
     def search_add(self, with_chapters=True):
         self.add_stories_to_search((self.model,), with_chapters=with_chapters)
 
     def search_update(self, update_fields=(), with_chapters=True):
+        self.update_stories_in_search({self.model: update_fields}, with_chapters=with_chapters)
+
+    def update_stories_in_search(self, updates, with_chapters=True):
+        '''Обновляет изменённые поля многих рассказов и их глав в поисковом
+        индексе. Рассказы (и главы), у которых новые значения полей совпадают,
+        обновляются одним запросом UPDATE.
+
+        :param updates: словарь {рассказ: набор изменённых полей}; None вместо
+          набора полей означает полную переиндексацию рассказа вместе с главами
+        :param bool with_chapters: обновлять ли общие поля у глав
+        :return: число выполненных запросов
+        '''
+
         if current_app.config['SPHINX_DISABLED']:
-            return
-        story = self.model
+            return 0
+
+        reindex_stories = []
+        reindex_stories_only = []
+        story_groups = {}
+        chapter_groups = {}
+        chapters_story_ids = []
+
+        for story, update_fields in updates.items():
+            if update_fields is None:
+                reindex_stories.append(story)
+                continue
 
-        f = set(update_fields)
+            f = set(update_fields)
+            if not f:
+                continue
+
+            # Изменённые поля, общие и для рассказа, и для его глав
+            common_fields = story.bl.sphinx_get_common_fields(f)
+            # Изменённые поля конкретно рассказа
+            story_fields = common_fields.copy()
 
-        # Изменённые поля, общие и для рассказа, и для его глав
-        common_fields = self.sphinx_get_common_fields(f)
-        # Изменённые поля конкретно рассказа
-        story_fields = common_fields.copy()
+            if 'first_published_at' in f:
+                # first_published_at изменяется только один раз и одновременно у рассказов и у глав
+                # Поэтому смело пихаем в common_fields
+                common_fields['first_published_at'] = int(((story.first_published_at or story.date) - datetime(1970, 1, 1, 0, 0, 0)).total_seconds())
+                story_fields['first_published_at'] = common_fields['first_published_at']
 
-        if 'first_published_at' in f:
-            # first_published_at изменяется только один раз и одновременно у рассказов и у глав
-            # Поэтому смело пихаем в common_fields
-            common_fields['first_published_at'] = int(((story.first_published_at or story.date) - datetime(1970, 1, 1, 0, 0, 0)).total_seconds())
-            story_fields['first_published_at'] = common_fields['first_published_at']
+            if 'words' in f:
+                story_fields['words'] = story.words
+
+            if f - set(story_fields):
+                # Есть неучтённые поля — для них оптимизаций нет, тупо переиндексируем всё
+                reindex_stories_only.append(story)
+            else:
+                story_groups.setdefault(_search_fields_group_key(story_fields), (story_fields, []))[1].append(story.id)
 
-        if 'words' in f:
-            story_fields['words'] = story.words
+            if with_chapters and common_fields:
+                chapter_groups.setdefault(_search_fields_group_key(common_fields), (common_fields, []))[1].append(story.id)
+                chapters_story_ids.append(story.id)
 
-        if f - set(story_fields):
-            # Есть неучтённые поля — для них оптимизаций нет, тупо переиндексируем всё
-            self.search_add(with_chapters=False)
+        statements = 0
+
+        if reindex_stories:
+            self.add_stories_to_search(reindex_stories, with_chapters=with_chapters)
+            statements += 1
+        if reindex_stories_only:
+            self.add_stories_to_search(reindex_stories_only, with_chapters=False)
+            statements += 1
+
+        if chapter_groups:
+            from mini_fiction.models import Chapter
+            story_chapters = {}
+            for story_id, chapter_id in orm.select((c.story.id, c.id) for c in Chapter if c.story.id in chapters_story_ids):
+                story_chapters.setdefault(story_id, []).append(chapter_id)
         else:
-            with current_app.sphinx as sphinx:
-                sphinx.update('stories', fields=story_fields, id=story.id)
+            story_chapters = {}
 
-        if with_chapters and common_fields and list(story.chapters):
-            with current_app.sphinx as sphinx:
-                sphinx.update('chapters', fields=common_fields, id__in=[x.id for x in story.chapters])
+        if not story_groups and not chapter_groups:
+            return statements
+
+        with current_app.sphinx as sphinx:
+            for story_fields, story_ids in story_groups.values():
+                sphinx.update('stories', fields=story_fields, id__in=story_ids)
+                statements += 1
+
+            for common_fields, story_ids in chapter_groups.values():
+                chapter_ids = sum((story_chapters.get(x, []) for x in story_ids), [])
+                if chapter_ids:
+                    sphinx.update('chapters', fields=common_fields, id__in=chapter_ids)
+                    statements += 1
+
+        # Голоса и комментарии обновляют только счётчики; если ничего
+        # другого не изменилось, кэш поиска не трогаем
+        if any(set(fields) - SEARCH_CACHE_DRIFTING_FIELDS for fields, _ in story_groups.values()):
+            reset_search_cache('stories')
+        if any(set(fields) - SEARCH_CACHE_DRIFTING_FIELDS for fields, _ in chapter_groups.values()):
+            reset_search_cache('chapters')
+
+        return statements
 
     def search_delete(self):
         self.delete_stories_from_search((self.model.id,))
@@ -1014,17 +1286,16 @@ class StoryBL(BaseBL, Commentable):
         if filters.get('max_vote_value') is not None:
             sphinx_filters['vote_value__lte'] = int(filters['max_vote_value'])
 
-        with current_app.sphinx as sphinx:
-            result_orig = sphinx.search(
-                'stories',
-                query,
-                weights=current_app.config['SPHINX_CONFIG']['weights_stories'],
-                options=current_app.config['SPHINX_CONFIG']['select_options'],
-                limit=limit,
-                sort_by=self.sort_types[sort_by],
-                meta=True,
-                **sphinx_filters,
-            )
+        result_orig = cached_sphinx_search(
+            'stories',
+            query,
+            weights=current_app.config['SPHINX_CONFIG']['weights_stories'],
+            options=current_app.config['SPHINX_CONFIG']['select_options'],
+            limit=limit,
+            sort_by=self.sort_types[sort_by],
+            meta=True,
+            **sphinx_filters,
+        )
 
         ids: List[int] = [x['id'] for x in result_orig.matches]
         stories_dict: Dict[int, "Story"] = {x.id: x for x in self.model.select(lambda x: x.id in ids)}
@@ -1060,15 +1331,45 @@ class StoryBL(BaseBL, Commentable):
             for x in self.dump_full():
                 fp.write(je.encode(x) + "\n")
 
-    def dump_full(self) -> Iterator[Dict[str, object]]:
+    def _iter_dump_query(self, query: Any, release_cache: bool = False) -> Iterator[Any]:
+        """Перебирает объекты запроса по возрастанию id пачками по
+        STORY_DUMP_BATCH_SIZE штук (keyset-пагинацией, а не OFFSET), чтобы
+        не загружать из базы всё сразу. С release_cache=True после каждой
+        пачки сбрасывается кэш db_session, иначе загруженные объекты так и
+        будут висеть в памяти до конца выгрузки; это допустимо только
+        в db_session, где ничего не изменяется.
+        """
+
+        batch_size = current_app.config['STORY_DUMP_BATCH_SIZE']
+        last_id = None
+        while True:
+            if last_id is None:
+                batch = query.order_by(lambda x: x.id)[:batch_size]
+            else:
+                batch = query.filter(lambda x: x.id > last_id).order_by(lambda x: x.id)[:batch_size]
+            yield from batch
+            if len(batch) < batch_size:
+                break
+            last_id = batch[-1].id
+            if release_cache:
+                orm.rollback()
+
+    def dump_full(self, *, release_cache: bool = False) -> Iterator[Dict[str, object]]:
         from mini_fiction import dumpload
-        from mini_fiction.models import StoryCommentEdit, StoryCommentVote
-        from mini_fiction.models import StoryLocalComment, StoryLocalCommentEdit
+        from mini_fiction.models import Favorites, Bookmark, Vote, StoryView, Activity, StoryLog
+        from mini_fiction.models import StoryComment, StoryCommentEdit, StoryCommentVote
+        from mini_fiction.models import Chapter, StoryLocalThread, StoryLocalComment, StoryLocalCommentEdit
         from mini_fiction.models import Notification, Subscription
 
         story = self.model
+        story_id = story.id
+        local_id = story.local.id if story.local else None
+        chapter_ids = [x.id for x in sorted(story.chapters, key=lambda x: x.order)]
         mdf = dumpload.MiniFictionDump()
 
+        def select(query: Any) -> Iterator[Any]:
+            return self._iter_dump_query(query, release_cache=release_cache)
+
         yield mdf.obj2json(story, 'story')
 
         # Сначала всё, что не зависит от глав
@@ -1078,76 +1379,78 @@ class StoryBL(BaseBL, Commentable):
             yield mdf.obj2json(x, 'storytag')
         for x in sorted(story.tags_log, key=lambda c: c.id):
             yield mdf.obj2json(x, 'storytaglog')
-        for x in sorted(story.favorites, key=lambda c: c.id):
+        for x in select(Favorites.select(lambda x: x.story.id == story_id)):
             yield mdf.obj2json(x, 'favorites')
-        for x in sorted(story.bookmarks, key=lambda c: c.id):
+        for x in select(Bookmark.select(lambda x: x.story.id == story_id)):
             yield mdf.obj2json(x, 'bookmark')
-        for x in sorted(story.votes, key=lambda c: c.id):
+        for x in select(Vote.select(lambda x: x.story.id == story_id)):
             yield mdf.obj2json(x, 'vote')
 
-        # Потом главы
-        for chapter in sorted(story.chapters, key=lambda x: x.order):
-            yield mdf.obj2json(chapter, 'chapter')
+        # Потом главы (текст глав тоже может быть большим, поэтому по одной)
+        for chapter_id in chapter_ids:
+            yield mdf.obj2json(Chapter[chapter_id], 'chapter')
+            if release_cache:
+                orm.rollback()
 
         # Потом всё, что прямо или косвенно зависит от глав
-        for x in story.story_views_set:
+        for x in select(StoryView.select(lambda x: x.story.id == story_id)):
             yield mdf.obj2json(x, 'storyview')
-        for x in story.activity:
+        for x in select(Activity.select(lambda x: x.story.id == story_id)):
             yield mdf.obj2json(x, 'activity')
-        for x in story.edit_log:
+        for x in select(StoryLog.select(lambda x: x.story.id == story_id)):
             yield mdf.obj2json(x, 'storylog')
 
         # Комменты к рассказу
         comment_ids = set()
-        for x in sorted(story.comments, key=lambda c: c.id):
+        for x in select(StoryComment.select(lambda x: x.story.id == story_id)):
             comment_ids.add(x.id)
             yield mdf.obj2json(x, 'storycomment')
-        for x in StoryCommentEdit.select(lambda x: x.comment.id in comment_ids):
+        for x in select(StoryCommentEdit.select(lambda x: x.comment.story.id == story_id)):
             yield mdf.obj2json(x, 'storycommentedit')
-        for x in StoryCommentVote.select(lambda x: x.comment.id in comment_ids):
+        for x in select(StoryCommentVote.select(lambda x: x.comment.story.id == story_id)):
             yield mdf.obj2json(x, 'storycommentvote')
 
         # Комменты в редакторской
         # (плюс сбор id для выгрузки уведомлений)
         local_comment_ids = set()
-        if story.local:
-            yield mdf.obj2json(story.local, 'storylocalthread')
-            for x in StoryLocalComment.select(lambda x: x.local == story.local):
+        if local_id is not None:
+            yield mdf.obj2json(StoryLocalThread[local_id], 'storylocalthread')
+            for x in select(StoryLocalComment.select(lambda x: x.local.id == local_id)):
                 local_comment_ids.add(x.id)
                 yield mdf.obj2json(x, 'storylocalcomment')
-            for x in StoryLocalCommentEdit.select(lambda x: x.comment.id in local_comment_ids):
+            for x in select(StoryLocalCommentEdit.select(lambda x: x.comment.local.id == local_id)):
                 yield mdf.obj2json(x, 'storylocalcommentedit')
 
         # Уведомления о состоянии рассказа
-        for x in Notification.select(
-            lambda x: x.type in ('story_publish', 'story_draft', 'author_story') and x.target_id == story.id
-        ):
+        for x in select(Notification.select(
+            lambda x: x.type in ('story_publish', 'story_draft', 'author_story') and x.target_id == story_id
+        )):
             yield mdf.obj2json(x, 'notification')
 
         # Уведомления о новых главах
-        chapter_ids = set(x.id for x in story.chapters)
-        for x in Notification.select(
+        chapter_ids = set(chapter_ids)
+        for x in select(Notification.select(
             lambda x: x.type in ('story_chapter',) and x.target_id in chapter_ids
-        ):
+        )):
             yield mdf.obj2json(x, 'notification')
 
         # Уведомления о новых комментах
-        for x in Notification.select(
+        for x in select(Notification.select(
             lambda x: x.type in ('story_reply', 'story_comment') and x.target_id in comment_ids
-        ):
+        )):
             yield mdf.obj2json(x, 'notification')
 
         # Уведомления о комментах в редакторской
-        if story.local:
-            for x in Notification.select(
+        if local_id is not None:
+            for x in select(Notification.select(
                 lambda x: x.type in ('story_lreply', 'story_lcomment') and x.target_id in local_comment_ids
-            ):
+            )):
                 yield mdf.obj2json(x, 'notification')
 
         # Подписки на рассказ
-        for x in Subscription.select(
-            lambda x: x.type in ('story_chapter', 'story_comment', 'story_lcomment') and x.target_id == story.id
-        ):
+        for x in select(Subscription.select(
+            lambda x: x.type in ('story_chapter', 'story_comment', 'story_lcomment') and x.target_id == story_id
+        )):
             yield mdf.obj2json(x, 'subscription')
 
     def dump_to_file_only_public(
@@ -1183,10 +1486,14 @@ class StoryBL(BaseBL, Commentable):
         with_chapters: bool = True,
         with_favorites: bool = False,
         with_comments: bool = False,
+        release_cache: bool = False,
     ) -> Iterator[Dict[str, object]]:
         from mini_fiction import dumpload
+        from mini_fiction.models import Chapter, Favorites, StoryComment
 
         story = self.model
+        story_id = story.id
+        chapter_ids = [x.id for x in sorted(story.chapters, key=lambda x: x.order) if not x.draft]
 
         mdf = dumpload.MiniFictionDump()
 
@@ -1240,14 +1547,13 @@ class StoryBL(BaseBL, Commentable):
 
         # Из избранного не палим дату
         if with_favorites:
-            for x in sorted(story.favorites, key=lambda c: c.id):
+            for x in self._iter_dump_query(Favorites.select(lambda x: x.story.id == story_id), release_cache=release_cache):
                 yield mdf.obj2json(x, 'favorites', params={'exclude': None, 'only': ['id', 'author', 'story']})
 
         # В главах ничего особенного, но лишние даты и черновики тоже не палим
         if with_chapters:
-            for chapter in sorted(story.chapters, key=lambda x: x.order):
-                if chapter.draft:
-                    continue
+            for chapter_id in chapter_ids:
+                chapter = Chapter[chapter_id]
                 chapter_only = [
                     'id', 'date', 'story', 'notes', 'order', 'title',
                     'text', 'text_md5', 'updated', 'words', 'draft',
@@ -1261,10 +1567,12 @@ class StoryBL(BaseBL, Commentable):
                         chapter_override['updated'] = chapter.first_published_at
 
                 yield mdf.obj2json(chapter, 'chapter', params={'exclude': None, 'only': chapter_only}, override=chapter_override)
+                if release_cache:
+                    orm.rollback()
 
         # Удалённые комментарии тоже дампим, но со стиранием из них всей информации
         if with_comments:
-            for x in sorted(story.comments, key=lambda c: c.id):
+            for x in self._iter_dump_query(StoryComment.select(lambda x: x.story.id == story_id), release_cache=release_cache):
                 comment_override = {'ip': '127.0.0.1'}
                 if x.deleted:
                     comment_override['updated'] = x.date
@@ -1334,7 +1642,7 @@ class StoryBL(BaseBL, Commentable):
                 story_tag_log.flush()
 
             if update_search:
-                later(current_app.tasks['sphinx_update_story'].delay, story.id, ('tag',))
+                later(current_app.search_queue.push_story, story.id, ('tag',))
 
         return story_tag, story_tag_log
 
@@ -1380,7 +1688,7 @@ class StoryBL(BaseBL, Commentable):
                 story_tag_log.flush()
 
             if update_search:
-                later(current_app.tasks['sphinx_update_story'].delay, story.id, ('tag',))
+                later(current_app.search_queue.push_story, story.id, ('tag',))
 
         return story_tag_log
 
@@ -1419,7 +1727,7 @@ class StoryBL(BaseBL, Commentable):
             self.add_tag(user, tag, log=log, update_search=False)
 
         if update_search:
-            later(current_app.tasks['sphinx_update_story'].delay, self.model.id, ('tag',))
+            later(current_app.search_queue.push_story, self.model.id, ('tag',))
 
         return add_tags, rm_tags
 
@@ -1554,21 +1862,208 @@ class StoryBL(BaseBL, Commentable):
         # это быстрее, чем RAND() в MySQL
 
         Story = self.model
-        ids = current_app.cache.get('all_story_ids')
-        if not ids:
-            ids = orm.select((x.id, x.date) for x in Story if x.approved and not x.draft).order_by(2)
-            ids = [x[0] for x in ids]
-            current_app.cache.set('all_story_ids', ids, 300)
-        if len(ids) > count:
-            ids = random.sample(ids, count)
-        q = Story.select(lambda x: x.id in ids)
-        if prefetch:
-            q = q.prefetch(*prefetch)
-        stories = list(q)
+
+        def load(ids):
+            q = Story.select(lambda x: x.id in ids and x.approved and not x.draft)
+            if prefetch:
+                q = q.prefetch(*prefetch)
+            return list(q)
+
+        ids = current_app.published_story_ids.sample(count)
+        stories = load(ids)
+        if len(stories) < len(ids):
+            # Множество id могло разойтись с базой: добираем недостающие
+            # рассказы из выборки побольше
+            seen_ids = set(ids)
+            extra_ids = [x for x in current_app.published_story_ids.sample(count * 2) if x not in seen_ids]
+            stories.extend(load(extra_ids[:count - len(stories)]))
         random.shuffle(stories)
         enrich_stories(stories)
         return stories
 
+    def get_user_stories_state(self, user, story_ids):
+        '''Собирает всё, что пользователь знает о рассказах в списке:
+        избранное, закладки, число непрочитанных глав и комментариев и даты
+        просмотра глав.
+
+        Результат запоминается до конца запроса и в кэше на
+        USER_STORY_STATE_CACHE_TIME секунд. Просмотры сразу записываются
+        в кэш (см. update_cached_user_state), избранное и закладки после
+        коммита сбрасывают его (см. invalidate_cached_user_state), а новые
+        главы и комментарии меняют версию состояния рассказа, после чего
+        закэшированное состояние всех пользователей перестаёт быть
+        действительным (см. reset_users_state).
+
+        :param user: пользователь (должен быть авторизован)
+        :param story_ids: id рассказов
+        :return: словарь {story_id: UserStoryState}; рассказов, которых нет
+          в базе, в нём тоже нет
+        '''
+
+        if isinstance(story_ids, int):
+            story_ids = [story_ids]
+
+        memo = g.setdefault('user_stories_state', {})
+        missing_ids = [x for x in story_ids if (user.id, x) not in memo]
+
+        if missing_ids:
+            state_keys = [self._user_state_cache_key(user.id, x) for x in missing_ids]
+            version_keys = [self._user_state_version_cache_key(x) for x in missing_ids]
+            cached = current_app.cache.get_many(*(state_keys + version_keys))
+            versions = dict(zip(missing_ids, cached[len(missing_ids):]))
+
+            load_ids = []
+            for story_id, entry in zip(missing_ids, cached[:len(missing_ids)]):
+                if entry is not None and entry[0] == versions[story_id]:
+                    memo[(user.id, story_id)] = entry[1]
+                else:
+                    load_ids.append(story_id)
+
+            if load_ids:
+                loaded = self._load_user_stories_state(user, load_ids)
+                current_app.cache.set_many({
+                    self._user_state_cache_key(user.id, story_id): (versions[story_id], state)
+                    for story_id, state in loaded.items()
+                }, timeout=current_app.config['USER_STORY_STATE_CACHE_TIME'])
+                for story_id in load_ids:
+                    memo[(user.id, story_id)] = loaded.get(story_id)
+
+        result = {}
+        for story_id in story_ids:
+            state = memo[(user.id, story_id)]
+            if state is not None:
+                result[story_id] = state
+        return result
+
+    def get_user_state(self, user):
+        '''То же, что get_user_stories_state, для одного рассказа.
+
+        :return: UserStoryState или None для неавторизованного пользователя
+        '''
+
+        if not user or not user.is_authenticated:
+            return None
+        return self.get_user_stories_state(user, [self.model.id]).get(self.model.id)
+
+    def update_cached_user_state(self, user, story_id, update):
+        '''Изменяет уже закэшированное состояние рассказа для пользователя,
+        не перезагружая его из базы; если в кэше ничего нет, ничего не делает.
+
+        :param user: пользователь
+        :param int story_id: id рассказа
+        :param update: функция, которая получает UserStoryState и изменяет его
+        '''
+
+        memo = g.get('user_stories_state')
+        if memo and memo.get((user.id, story_id)) is not None:
+            update(memo[(user.id, story_id)])
+
+        state_key = self._user_state_cache_key(user.id, story_id)
+        entry, version = current_app.cache.get_many(state_key, self._user_state_version_cache_key(story_id))
+        if entry is None or entry[0] != version:
+            return
+        update(entry[1])
+        current_app.cache.set(state_key, entry, timeout=current_app.config['USER_STORY_STATE_CACHE_TIME'])
+
+    def invalidate_cached_user_state(self, user, story_id, update):
+        '''Для изменений, которые сохраняются в базе (избранное, закладки):
+        состояние, запомненное в текущем запросе, изменяется сразу, а
+        закэшированное удаляется уже после коммита, чтобы следующий запрос
+        загрузил его из базы. Так кэш не разойдётся с базой, если коммит не
+        удался, и не перезапишется параллельными запросами.
+
+        :param user: пользователь
+        :param int story_id: id рассказа
+        :param update: функция, которая получает UserStoryState и изменяет его
+        '''
+
+        memo = g.get('user_stories_state')
+        if memo and memo.get((user.id, story_id)) is not None:
+            update(memo[(user.id, story_id)])
+
+        later(current_app.cache.delete, self._user_state_cache_key(user.id, story_id))
+
+    def schedule_downloads_build(self, story_id):
+        '''Ставит в очередь рендеринг файлов для скачивания рассказа, чтобы
+        после обновления рассказа их не рендерили прямо в запросах.
+
+        :param int story_id: id рассказа (вызывается через later)
+        '''
+
+        if current_app.config['STORY_DOWNLOADS_PREBUILD']:
+            current_app.tasks['build_story_downloads'].delay(story_id)
+
+    def reset_users_state(self, story_id):
+        '''Сбрасывает закэшированное состояние рассказа у всех пользователей;
+        вызывается при изменении числа глав и комментариев рассказа.
+
+        :param int story_id: id рассказа (вызывается через later, когда
+          самого объекта рассказа уже может не быть)
+        '''
+
+        current_app.cache.set(
+            self._user_state_version_cache_key(story_id),
+            random.getrandbits(63),
+            timeout=current_app.config['USER_STORY_STATE_CACHE_TIME'],
+        )
+        memo = g.get('user_stories_state')
+        if memo:
+            for key in [x for x in memo if x[1] == story_id]:
+                del memo[key]
+
+    def _user_state_cache_key(self, user_id, story_id):
+        return 'user_story_state_{}_{}'.format(user_id, story_id)
+
+    def _user_state_version_cache_key(self, story_id):
+        return 'story_user_state_version_{}'.format(story_id)
+
+    def _load_user_stories_state(self, user, story_ids):
+        # Для всех рассказов хватает двух запросов к базе
+
+        from mini_fiction.models import Story, StoryView
+
+        story_ids = list(story_ids)
+        if not story_ids:
+            return {}
+
+        stories = orm.select((
+            s.id,
+            s.approved and not s.draft,
+            s.published_chapters_count,
+            s.comments_count,
+            orm.count(f for f in s.favorites if f.author == user),
+            orm.count(b for b in s.bookmarks if b.author == user),
+            orm.max(a.last_comments for a in s.activity if a.author == user),
+        ) for s in Story if s.id in story_ids)
+
+        views = orm.select(
+            (v.story.id, v.chapter.id, v.date) for v in StoryView
+            if v.author == user and v.story.id in story_ids and v.chapter is not None
+        ).without_distinct()
+
+        read_chapters_count = {}
+        chapter_view_dates = {}
+        for story_id, chapter_id, date in views:
+            read_chapters_count[story_id] = read_chapters_count.get(story_id, 0) + 1
+            chapter_view_dates.setdefault(story_id, {})[chapter_id] = date
+
+        result = {}
+        for story_id, published, chapters_count, comments_count, favorited, bookmarked, last_comments in stories:
+            state = UserStoryState(
+                # Непрочитанное считается только у доступных пользователю рассказов
+                # (как в select_accessible)
+                accessible=published or user.is_staff,
+                favorited=favorited > 0,
+                bookmarked=bookmarked > 0,
+                read_chapters_count=read_chapters_count.get(story_id, 0),
+                last_comments=last_comments,
+                chapter_view_dates=chapter_view_dates.get(story_id, {}),
+            )
+            state.update_unread_counts(chapters_count, comments_count)
+            result[story_id] = state
+
+        return result
+
     def get_unread_chapters_count(self, user, story_ids):
         from mini_fiction.models import StoryView
 
@@ -1706,8 +2201,10 @@ class ChapterBL(BaseBL):
         story.all_chapters_count += 1
         if not chapter.draft:
             story.published_chapters_count += 1
+            later(story.bl.reset_users_state, story.id)
+            later(story.bl.schedule_downloads_build, story.id)
         story.updated = datetime.utcnow()
-        later(current_app.tasks['sphinx_update_chapter'].delay, chapter.id)
+        later(current_app.search_queue.push_chapter, chapter.id)
         # current_app.cache.delete('index_updated_chapters') не нужен, если draft=True
         return chapter
 
@@ -1791,6 +2288,8 @@ class ChapterBL(BaseBL):
             if not minor:
                 chapter.updated = datetime.utcnow()
                 chapter.story.updated = datetime.utcnow()
+                if not chapter.draft:
+                    later(chapter.story.bl.schedule_downloads_build, chapter.story.id)
             chapter.bl.edit_log(
                 editor=editor,
                 action='edit',
@@ -1806,7 +2305,7 @@ class ChapterBL(BaseBL):
         if chapter_text_diff:
             current_app.cache.delete(f"chapter_text_html_{chapter.id}")
 
-        later(current_app.tasks['sphinx_update_chapter'].delay, chapter.id)
+        later(current_app.search_queue.push_chapter, chapter.id)
         return chapter
 
     def update_words_count(self, chapter, update_story_words=True):
@@ -1829,6 +2328,10 @@ class ChapterBL(BaseBL):
             story.published_chapters_count -= 1
             story.words = story.words - chapter.words
         later(current_app.tasks['sphinx_delete_chapter'].delay, story.id, chapter.id)
+        # Вместе с главой удаляются и её просмотры
+        later(story.bl.reset_users_state, story.id)
+        if not chapter.draft:
+            later(story.bl.schedule_downloads_build, story.id)
 
         old_order = chapter.order
         chapter.bl.edit_log(
@@ -1998,6 +2501,101 @@ class ChapterBL(BaseBL):
 
         return Markup(result)
 
+    # Кэширование отрендеренного HTML глав
+
+    def _html_cache_timeout(self, chapter):
+        is_new_chapter = (datetime.utcnow() - chapter.updated).total_seconds() < current_app.config['CHAPTER_NEW_AGE']
+        if is_new_chapter:
+            return current_app.config['CHAPTER_NEW_HTML_BACKEND_CACHE_TIME']
+        return current_app.config['CHAPTER_OLD_HTML_BACKEND_CACHE_TIME']
+
+    def _is_html_memo_actual(self, chapter):
+        memo = getattr(chapter, '_html_cache', None)
+        return memo is not None and memo[0] == chapter.updated and memo[1] == chapter.text_md5
+
+    def get_text_html(self):
+        chapter = self.model
+        if not self._is_html_memo_actual(chapter):
+            self.prefetch_html([chapter])
+        return chapter._html_cache[2]
+
+    def get_notes_html(self):
+        chapter = self.model
+        if not self._is_html_memo_actual(chapter):
+            self.prefetch_html([chapter])
+        return chapter._html_cache[3]
+
+    def prefetch_html(self, chapters, executor=None):
+        '''Готовит HTML текста и примечаний сразу для всех переданных глав:
+        достаёт всё из кэша одним запросом, рендерит только недостающее
+        и сохраняет его обратно тоже одним запросом (на каждый вариант
+        времени жизни кэша). После этого text_as_html и notes_as_html этих
+        глав не обращаются ни к кэшу, ни к фильтрам.
+
+        :param chapters: список глав
+        :param executor: необязательный ``concurrent.futures.Executor``
+          (см. :func:`create_chapters_html_render_pool`) для рендеринга
+          недостающих глав в нескольких процессах
+        '''
+
+        chapters = [c for c in chapters if not self._is_html_memo_actual(c)]
+        if not chapters:
+            return
+
+        keys = []
+        for c in chapters:
+            keys.append('chapter_text_html_{}'.format(c.id))
+            keys.append('chapter_notes_html_{}'.format(c.id))
+        cached_values = current_app.cache.get_many(*keys)
+
+        results = {}  # {cache_key: html}
+        misses = []  # [(chapter, cache_key, field)]
+        for i, c in enumerate(chapters):
+            text_key, notes_key = keys[i * 2], keys[i * 2 + 1]
+            cached_text, cached_notes = cached_values[i * 2], cached_values[i * 2 + 1]
+
+            if cached_text and cached_text[0] == c.updated and cached_text[1] == c.text_md5:
+                results[text_key] = cached_text[2]
+            else:
+                misses.append((c, text_key, 'text'))
+
+            if cached_notes and cached_notes[0] == c.updated:
+                results[notes_key] = cached_notes[1]
+            else:
+                misses.append((c, notes_key, 'notes'))
+
+        if misses:
+            sources = [(field, getattr(c, field)) for c, _, field in misses]
+            if executor is not None and len(misses) > 1:
+                rendered = list(executor.map(_render_chapter_html_in_worker, sources))
+            else:
+                rendered = [self._render_html_field(field, source) for field, source in sources]
+
+            new_values = {}  # {timeout: {cache_key: value}}
+            for (c, key, field), html in zip(misses, rendered):
+                results[key] = html
+                if field == 'text':
+                    value = (c.updated, c.text_md5, html)
+                else:
+                    value = (c.updated, html)
+                new_values.setdefault(self._html_cache_timeout(c), {})[key] = value
+
+            for timeout, values in new_values.items():
+                current_app.cache.set_many(values, timeout=timeout)
+
+        for c in chapters:
+            c._html_cache = (
+                c.updated,
+                c.text_md5,
+                Markup(results['chapter_text_html_{}'.format(c.id)]),
+                Markup(results['chapter_notes_html_{}'.format(c.id)]),
+            )
+
+    def _render_html_field(self, field, source):
+        if field == 'text':
+            return str(self.text2html(source))
+        return str(self.notes2html(source))
+
     def get_version(self, text_md5=None, log_item=None):
         from mini_fiction.models import StoryLog
 
@@ -2083,14 +2681,16 @@ class ChapterBL(BaseBL):
         else:
             story.published_chapters_count += 1
             story.words += chapter.words
+        later(story.bl.reset_users_state, story.id)
 
         if not story.draft and story.published and not chapter.first_published_at:
             chapter.bl.first_publish(tm=tm, notify=True, caused_by_user=user)
 
         # Это необходимо, пока архивы для скачивания рассказа обновляются по этой дате
         story.updated = tm
+        later(story.bl.schedule_downloads_build, story.id)
 
-        later(current_app.tasks['sphinx_update_chapter'].delay, chapter.id)
+        later(current_app.search_queue.push_chapter, chapter.id)
         current_app.cache.delete('index_updated_chapters')
 
     def first_publish(self, tm=None, notify=True, caused_by_user=None):
@@ -2112,49 +2712,71 @@ class ChapterBL(BaseBL):
             later(current_app.tasks['notify_story_chapters'].delay, [chapter.id], caused_by_user.id if caused_by_user else None)
 
     def is_viewed_by(self, user):
-        from mini_fiction.models import StoryView
-
         if not user or not user.is_authenticated:
             return None
 
         chapter = self.model
-        story = chapter.story
-
-        # Так надо, чтобы поня закэшировала SQL-запрос и списки рассказов не тормозили
-        viewed_chapters = StoryView.select(lambda x: x.author.id == user.id and x.story == story)
-        viewed_chapters = {x.chapter.id: x.date for x in viewed_chapters if x.chapter}
-        return viewed_chapters.get(chapter.id)
+        state = chapter.story.bl.get_user_state(user)
+        return state.chapter_view_dates.get(chapter.id) if state else None
 
     def viewed(self, user):
         if not user.is_authenticated:
             return
 
-        from mini_fiction.models import StoryView
-
         chapter = self.model
         story = chapter.story
 
-        story_view = StoryView.select(lambda x: x.story == story and x.author == user).first()
-        # Из-за всяких легаси у одной главы от одного юзера может быть несколько просмотров,
-        # поэтому select/first вместо get
-        view = StoryView.select(lambda x: x.story == story and x.chapter == chapter and x.author == user).first()
+        # Повторные просмотры отсекаются по закэшированному состоянию
+        # рассказа для пользователя, а новые уходят в очередь просмотров,
+        # которая создаст StoryView и увеличит счётчики без лишних запросов
+        # в каждом просмотре
+        state = story.bl.get_user_state(user)
+        if state is not None and chapter.id in state.chapter_view_dates:
+            return
 
-        if not view:
-            view = StoryView(
-                story=story,
-                chapter=chapter,
-                author=user,
-            )
-            chapter.views += 1
-            if not story_view:
-                story.views += 1
-        return view
+        tm = datetime.utcnow()
+        current_app.view_queue.push_chapter_view(
+            user.id, story.id, chapter.id, tm,
+            new_story_view=state is not None and not state.chapter_view_dates,
+        )
+
+        def update_state(state):
+            state.read_chapters_count += 1
+            state.chapter_view_dates[chapter.id] = tm
+            state.update_unread_counts(story.published_chapters_count, story.comments_count)
+
+        story.bl.update_cached_user_state(user, story.id, update_state)
+
+    def get_views_count(self):
+        '''Число просмотров главы вместе с ещё не применёнными просмотрами
+        из очереди просмотров.
+        '''
+
+        from mini_fiction.view_queue import get_pending_views
+
+        chapter = self.model
+        return chapter.views + get_pending_views('chapter', [chapter.id])[chapter.id]
 
     # search
 
-    def add_chapters_to_search(self, chapters, update_story_words=True):
+    def add_chapters_to_search(self, chapters, update_story_words=True, common_fields_cache=None, max_batch_bytes=None):
+        '''Добавляет главы в поисковый индекс (или заменяет уже добавленные).
+
+        :param chapters: список глав
+        :param bool update_story_words: обновить число слов у рассказов
+        :param dict common_fields_cache: словарь для запоминания общих
+          полей рассказов (story_id -> поля); можно передавать один и тот же
+          между вызовами, чтобы не запрашивать их заново для каждой главы
+        :param int max_batch_bytes: если указано, главы отправляются
+          несколькими запросами с данными не больше указанного размера
+        :return: число выполненных запросов REPLACE
+        '''
+
         if current_app.config['SPHINX_DISABLED']:
-            return
+            return 0
+
+        if common_fields_cache is None:
+            common_fields_cache = {}
 
         sphinx_chapters = []
         for chapter in chapters:
@@ -2171,11 +2793,20 @@ class ChapterBL(BaseBL):
 
                 'chapter_draft': chapter.draft,
             }
-            data.update(chapter.story.bl.sphinx_get_common_fields())
+            common_fields = common_fields_cache.get(chapter.story.id)
+            if common_fields is None:
+                common_fields = chapter.story.bl.sphinx_get_common_fields()
+                common_fields_cache[chapter.story.id] = common_fields
+            data.update(common_fields)
             sphinx_chapters.append(data)
 
         with current_app.sphinx as sphinx:
-            sphinx.add('chapters', sphinx_chapters)
+            if max_batch_bytes:
+                statements = sphinx.add_batched('chapters', sphinx_chapters, max_bytes=max_batch_bytes)
+            else:
+                sphinx.add('chapters', sphinx_chapters)
+                statements = 1 if sphinx_chapters else 0
+        reset_search_cache('chapters')
 
         if update_story_words:
             stories = {}
@@ -2185,11 +2816,14 @@ class ChapterBL(BaseBL):
                 for story in stories.values():
                     story.bl.search_update(('words',))
 
+        return statements
+
     def delete_chapters_from_search(self, story_ids, chapter_ids, update_story_words=True):
         if current_app.config['SPHINX_DISABLED']:
             return
         with current_app.sphinx as sphinx:
             sphinx.delete('chapters', id__in=chapter_ids)
+        reset_search_cache('chapters')
 
         if story_ids and update_story_words:
             from mini_fiction.models import Story
@@ -2272,35 +2906,31 @@ class ChapterBL(BaseBL):
         if filters.get('max_vote_value') is not None:
             sphinx_filters['vote_value__lte'] = int(filters['max_vote_value'])
 
-        with current_app.sphinx as sphinx:
-            result_orig = sphinx.search(
-                'chapters',
-                query,
-                weights=current_app.config['SPHINX_CONFIG']['weights_chapters'],
-                options=current_app.config['SPHINX_CONFIG']['select_options'],
-                limit=limit,
-                sort_by=self.sort_types[sort_by],
-                meta=True,
-                **sphinx_filters,
-            )
+        result_orig = cached_sphinx_search(
+            'chapters',
+            query,
+            weights=current_app.config['SPHINX_CONFIG']['weights_chapters'],
+            options=current_app.config['SPHINX_CONFIG']['select_options'],
+            limit=limit,
+            sort_by=self.sort_types[sort_by],
+            meta=True,
+            **sphinx_filters,
+        )
 
-            ids = [x['id'] for x in result_orig.matches]
-            chapters_dict: Dict[int, "Chapter"] = {x.id: x for x in self.model.select(
-                lambda x: x.id in ids
-            ).prefetch(self.model.story)}
-
-            chapters: List[Tuple["Chapter", str]] = []
-
-            for i in ids:
-                if i not in chapters_dict:
-                    continue
-                excerpt = sphinx.call_snippets(
-                    index="chapters",
-                    texts=chapters_dict[i].text,
-                    query=query,
-                    **current_app.config["SPHINX_CONFIG"]["excerpts_opts"],
-                )
-                chapters.append((chapters_dict[i], excerpt[0] if excerpt else ""))
+        ids = [x['id'] for x in result_orig.matches]
+        prefetch = [self.model.story]
+        if current_app.config['SPHINX_CONFIG'].get('snippets_mode') != 'stored':
+            prefetch.append(self.model.text)
+        chapters_dict: Dict[int, "Chapter"] = {x.id: x for x in self.model.select(
+            lambda x: x.id in ids
+        ).prefetch(*prefetch)}
+
+        found_chapters = [chapters_dict[i] for i in ids if i in chapters_dict]
+        chapters: List[Tuple["Chapter", str]] = []
+        if found_chapters:
+            with current_app.sphinx as sphinx:
+                excerpts = self._get_search_excerpts(sphinx, found_chapters, query)
+            chapters = list(zip(found_chapters, excerpts))
 
         max_matches = int(result_orig.meta["max_matches"])
         total_found = int(result_orig.meta["total_found"])
@@ -2314,3 +2944,71 @@ class ChapterBL(BaseBL):
             total_found=total_found,
             chapters=chapters,
         )
+
+    def _get_search_excerpts(self, sphinx, chapters, query):
+        # Все сниппеты строятся одним запросом. В режиме 'window' вместо
+        # полного текста главы отправляется только кусок вокруг первого
+        # совпадения, а в режиме 'stored' текст вообще не отправляется:
+        # Manticore строит сниппеты по хранимому полю text (для этого
+        # нужны sphinxconf с тем же режимом и переиндексация)
+        if not chapters:
+            return []
+
+        cfg = current_app.config['SPHINX_CONFIG']
+        mode = cfg.get('snippets_mode') or 'full'
+        opts = cfg['excerpts_opts']
+
+        if mode == 'stored':
+            highlights = sphinx.select_highlights(
+                'chapters',
+                [x.id for x in chapters],
+                query,
+                field='text',
+                **opts,
+            )
+            return [highlights.get(x.id, '') for x in chapters]
+
+        texts = [x.text for x in chapters]
+        if mode == 'window':
+            window = cfg.get('snippets_window') or 16384
+            texts = [trim_text_around_match(text, query, window) for text in texts]
+
+        excerpts = sphinx.call_snippets(index='chapters', texts=texts, query=query, **opts)
+        excerpts += [''] * (len(chapters) - len(excerpts))
+        return excerpts
+
+
+# Рендеринг HTML глав в отдельных процессах
+
+_render_worker_app = None
+
+
+def _init_chapters_html_render_worker():
+    # Приложение досталось процессу от родителя через fork; рендерингу
+    # нужны только настройки, к базе данных воркер не обращается
+    _render_worker_app.app_context().push()
+
+
+def _render_chapter_html_in_worker(item):
+    from mini_fiction.models import Chapter
+
+    field, source = item
+    return Chapter.bl._render_html_field(field, source)  # pylint: disable=protected-access
+
+
+def create_chapters_html_render_pool(processes=None):
+    '''Создаёт пул процессов для рендеринга HTML глав, пригодный для
+    передачи в ``Chapter.bl.prefetch_html(chapters, executor=...)``.
+    Предназначен для консольных команд, а не для обработки запросов.
+    '''
+
+    global _render_worker_app
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    _render_worker_app = current_app._get_current_object()  # pylint: disable=protected-access
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_chapters_html_render_worker,
+    )
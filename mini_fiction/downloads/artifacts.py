@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import fcntl
+import tempfile
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+from flask import current_app
+
+from mini_fiction.utils.misc import nonrequest_context
+
+
+# Готовые файлы для скачивания рассказов лежат в MEDIA_ROOT/stories/<id>/.
+# Файл считается актуальным, если время его изменения не раньше
+# story.updated; при записи ему ставится время начала рендеринга, чтобы
+# изменения рассказа во время рендеринга не потерялись.
+# Рендеринг одного формата одного рассказа защищён блокировкой файла
+# .<расширение>.lock, общей для всех процессов сайта и Celery: пока один
+# процесс рендерит файл, остальные отдают предыдущую версию файла или,
+# если её нет, ждут окончания рендеринга.
+
+
+def get_artifact_path(story, fmt):
+    return Path(current_app.config['MEDIA_ROOT']) / 'stories' / str(story.id) / fmt.filename(story)
+
+
+def is_artifact_fresh(path, story):
+    try:
+        mtime = path.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return datetime.utcfromtimestamp(mtime) >= story.updated
+
+
+@contextmanager
+def render_lock(story, fmt, timeout=None):
+    '''Блокировка рендеринга формата fmt рассказа story. Возвращает True,
+    если блокировка получена, и False, если за timeout секунд её так и не
+    освободили (timeout=0 — не ждать вовсе, None — ждать сколько угодно).
+    '''
+
+    lock_path = Path(current_app.config['MEDIA_ROOT']) / 'stories' / str(story.id) / '.{}.lock'.format(fmt.extension)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(lock_path, 'a+b') as fp:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            try:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | (fcntl.LOCK_NB if timeout is not None else 0))
+                acquired = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    acquired = False
+                    break
+                time.sleep(0.1)
+
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def open_atomic(path, mtime=None):
+    '''Открывает на запись временный файл в том же каталоге и после
+    успешного выхода из блока переименовывает его в path, чтобы никто не
+    увидел наполовину записанный файл.
+    '''
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + path.name + '.', suffix='.tmp', dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            yield fp
+        os.chmod(tmp_path, 0o644)
+        if mtime is not None:
+            os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_atomic(path, data, mtime=None):
+    with open_atomic(path, mtime=mtime) as fp:
+        fp.write(data)
+
+
+def render_artifact(story, fmt, path):
+    # Форматы пишут файл по частям прямо на диск, не собирая его в памяти
+    started_at = time.time()
+    with open_atomic(path, mtime=started_at) as fp, nonrequest_context():
+        fmt.render_to_file(fp, story=story)
+
+
+def build_artifact(story, fmt, force=False):
+    '''Рендерит и сохраняет файл для скачивания, если он устарел (или
+    всегда при force=True), дождавшись окончания рендеринга в других
+    процессах. Возвращает путь к файлу.
+    '''
+
+    path = get_artifact_path(story, fmt)
+    if not force and is_artifact_fresh(path, story):
+        return path
+
+    with render_lock(story, fmt):
+        # Пока ждали блокировку, файл мог отрендерить кто-то другой
+        if force or not is_artifact_fresh(path, story):
+            render_artifact(story, fmt, path)
+    return path
+
+
+def get_artifact(story, fmt):
+    '''Возвращает путь к файлу для скачивания в запросе. Устаревший файл
+    рендерится заново, но если его уже рендерит другой процесс, отдаётся
+    предыдущая версия, а если её нет — ждём не дольше
+    STORY_DOWNLOAD_RENDER_WAIT секунд.
+    '''
+
+    path = get_artifact_path(story, fmt)
+    if is_artifact_fresh(path, story):
+        return path
+
+    with render_lock(story, fmt, timeout=0) as acquired:
+        if acquired:
+            if not is_artifact_fresh(path, story):
+                render_artifact(story, fmt, path)
+            return path
+
+    if path.exists():
+        return path
+
+    with render_lock(story, fmt, timeout=current_app.config['STORY_DOWNLOAD_RENDER_WAIT']):
+        # Если так и не дождались, рендерим без блокировки: запись
+        # атомарная, так что в худшем случае отрендерим дважды
+        if not is_artifact_fresh(path, story):
+            render_artifact(story, fmt, path)
+    return path
+
+
+def build_story_artifacts(story, formats=None, force=False):
+    '''Рендерит все устаревшие файлы для скачивания рассказа.
+    Возвращает список путей к отрендеренным файлам.
+    '''
+
+    from mini_fiction.downloads import list_formats
+
+    built = []
+    for fmt in formats if formats is not None else list_formats():
+        path = get_artifact_path(story, fmt)
+        if not force and is_artifact_fresh(path, story):
+            continue
+        built.append(build_artifact(story, fmt, force=force))
+    return built
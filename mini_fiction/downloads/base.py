@@ -4,7 +4,7 @@
 import re
 import zipfile
 
-from flask import url_for, render_template
+from flask import url_for, stream_template
 from mini_fiction.utils import misc
 
 
@@ -39,6 +39,14 @@ class BaseDownloadFormat(object):
     def render(self, **kw):
         raise NotImplementedError
 
+    def render_to_file(self, fp, **kw):
+        '''Записывает отрендеренный файл в открытый на запись бинарный файл
+        fp. Форматы, умеющие писать файл по частям, переопределяют этот
+        метод, чтобы не держать в памяти весь файл целиком.
+        '''
+
+        fp.write(self.render(**kw))
+
     @property
     def slug(self):
         return slugify(str(self.name.lower()))
@@ -47,19 +55,24 @@ class BaseDownloadFormat(object):
 class ZipFileDownloadFormat(BaseDownloadFormat):
     content_type = 'application/zip'
     chapter_encoding = 'utf-8'
+    chapter_template_uses_html = False
 
     def render(self, **kw):
         from io import BytesIO
 
         buf = BytesIO()
-        zipobj = zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_DEFLATED)
+        self.render_to_file(buf, **kw)
+        return buf.getvalue()
+
+    def render_to_file(self, fp, **kw):
+        # Главы сжимаются и пишутся в архив по одной, так что в памяти
+        # не бывает больше одной отрендеренной главы
+        zipobj = zipfile.ZipFile(fp, mode='w', compression=zipfile.ZIP_DEFLATED)
         try:
             self.render_zip_contents(zipobj, **kw)
         finally:
             zipobj.close()
 
-        return buf.getvalue()
-
     def render_zip_contents(self, zipobj, story, **kw):
         from mini_fiction.models import Chapter
 
@@ -68,13 +81,10 @@ class ZipFileDownloadFormat(BaseDownloadFormat):
 
         chapters = list(story.chapters.select(lambda x: not x.draft).order_by(Chapter.order, Chapter.id))
         num_width = len(str(max(x.order for x in chapters))) if chapters else 1
-        for chapter in chapters:
-            data = render_template(
-                self.chapter_template,
-                chapter=chapter,
-                story=story,
-            ).encode(self.chapter_encoding)
+        if self.chapter_template_uses_html:
+            Chapter.bl.prefetch_html(chapters)
 
+        for chapter in chapters:
             name = slugify(chapter.autotitle)
             num = str(chapter.order).rjust(num_width, '0')
             arcname = str('%s/%s_%s.%s' % (dirname, num, name, ext))
@@ -89,7 +99,9 @@ class ZipFileDownloadFormat(BaseDownloadFormat):
             zipinfo.compress_type = zipfile.ZIP_DEFLATED
             zipinfo.external_attr = 0o644 << 16  # Python 3.4 ставит файлам права 000, фиксим
 
-            zipobj.writestr(zipinfo, data)
+            with zipobj.open(zipinfo, 'w') as fp:
+                for chunk in stream_template(self.chapter_template, chapter=chapter, story=story):
+                    fp.write(chunk.encode(self.chapter_encoding))
 
 
 def slugify(s):
@@ -6,23 +6,74 @@ import zipfile
 from .base import BaseDownloadFormat, ZipFileDownloadFormat, slugify
 
 
+FB2_NS = '{http://www.gribuser.ru/xml/fictionbook/2.0}'
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+
+def prefix_fb2_ids(doc, prefix):
+    # То же, что делает с каждым документом join-fb2-docs.xslt: к id секций
+    # и внутренним ссылкам добавляется префикс номера документа
+    for elem in doc.iter(FB2_NS + 'section'):
+        if elem.get('id') is not None:
+            elem.set('id', prefix + elem.get('id'))
+    for elem in doc.iter(FB2_NS + 'a'):
+        href = elem.get(XLINK_HREF)
+        if href is not None and href.startswith('#'):
+            elem.set(XLINK_HREF, '#' + prefix + href[1:])
+
+
 class FB2BaseDownload:
     def render_fb2(self, story, **kw):
+        from io import BytesIO
+
+        buf = BytesIO()
+        self.write_fb2(buf, story=story, **kw)
+        return buf.getvalue()
+
+    def write_fb2(self, fp, story, **kw):
+        '''Пишет FB2-файл рассказа в fp по мере конвертирования глав:
+        в памяти одновременно находится дерево только одной главы (и сноски,
+        которые в FB2 идут отдельным телом после всех глав). Результат тот же,
+        что у ``join_fb2_docs`` для всех глав разом.
+        '''
+
         import lxml.etree as etree
         from ..filters import fb2
         from mini_fiction.models import Chapter
 
-        chapters = story.chapters.select(lambda x: not x.draft).order_by(Chapter.order, Chapter.id)
-        chapters = [fb2.html_to_fb2(c.get_fb2_chapter_text(), title=c.autotitle) for c in chapters]
-        subdocs = [self._get_annotation_doc(story)] + chapters
-
-        doc = fb2.join_fb2_docs(
-            subdocs,
+        # Описание книги и подвал собираются тем же XSLT из одной аннотации
+        header = fb2.join_fb2_docs(
+            [self._get_annotation_doc(story)],
             title=story.title,
             author_name=story.authors[0].username,  # TODO: multiple authors
             date=(story.first_published_at or story.date).strftime('%Y-%m-%dT%H:%M:%SZ'),
         )
-        return etree.tostring(doc, encoding='UTF-8', xml_declaration=True)
+        footer = [x for x in header if x.tag not in (FB2_NS + 'description', FB2_NS + 'body')]
+
+        chapters = story.chapters.select(lambda x: not x.draft).order_by(Chapter.order, Chapter.id)
+        notes = []
+
+        with etree.xmlfile(fp, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            with xf.element(FB2_NS + 'FictionBook', nsmap=header.nsmap):
+                xf.write(header.find(FB2_NS + 'description'))
+                with xf.element(FB2_NS + 'body'):
+                    # Первым документом при склейке идёт аннотация
+                    for num, chapter in enumerate(chapters, 2):
+                        doc = fb2.html_to_fb2(chapter.get_fb2_chapter_text(), title=chapter.autotitle)
+                        prefix_fb2_ids(doc, 'doc{}_'.format(num))
+                        for body in doc.iterfind(FB2_NS + 'body'):
+                            if body.get('name') is None:
+                                for elem in body:
+                                    xf.write(elem)
+                            else:
+                                notes.extend(body)
+                        xf.flush()
+                with xf.element(FB2_NS + 'body', name='notes'):
+                    for elem in notes:
+                        xf.write(elem)
+                for elem in footer:
+                    xf.write(elem)
 
     def _get_annotation_doc(self, story):
         from ..filters import fb2
@@ -55,8 +106,6 @@ class FB2ZipDownload(FB2BaseDownload, ZipFileDownloadFormat):
     debug_content_type = 'text/xml; charset=utf-8'
 
     def render_zip_contents(self, zipobj, story, **kw):
-        data = self.render_fb2(story=story, **kw)
-
         filename = kw.pop('filename', slugify(story.title or str(story.id))) + '.fb2'
 
         zipinfo = zipfile.ZipInfo(
@@ -66,7 +115,8 @@ class FB2ZipDownload(FB2BaseDownload, ZipFileDownloadFormat):
         zipinfo.compress_type = zipfile.ZIP_DEFLATED
         zipinfo.external_attr = 0o644 << 16  # Python 3.4 ставит файлам права 000, фиксим
 
-        zipobj.writestr(zipinfo, data)
+        with zipobj.open(zipinfo, 'w') as fp:
+            self.write_fb2(fp, story=story, **kw)
 
     def render(self, **kw):
         if kw.get('debug'):
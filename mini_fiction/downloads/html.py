@@ -9,3 +9,4 @@ class HTMLDownload(ZipFileDownloadFormat):
     name = 'HTML'
     chapter_template = 'chapter_pure_html.html'
     chapter_extension = 'html'
+    chapter_template_uses_html = True
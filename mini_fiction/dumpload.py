@@ -183,16 +183,21 @@ class MiniFictionDump(ponydump.PonyDump):
         self.put_depmap_entity_after('storyview', after_entity=None)
 
 
-def dumpdb_console(dirpath, entities_list=None, gzip_compression=0, verbosity=2):
+def dumpdb_console(dirpath, entities_list=None, gzip_compression=0, verbosity=2, processes=1):
     from mini_fiction.utils.misc import progress_drawer
 
     mfd = MiniFictionDump()
 
     ljust_cnt = max(len(x) for x in mfd.entities) + 2
 
+    def speed(status):
+        return '{:.0f} rows/s'.format(status['current'] / status['elapsed'] if status['elapsed'] else 0)
+
     drawer = None
     current_entity = None
-    for status in mfd.dump_to_directory(dirpath, entities_list, gzip_compression=gzip_compression):
+    for status in mfd.dump_to_directory(
+        dirpath, entities_list, gzip_compression=gzip_compression, processes=processes
+    ):
         if not status['entity']:
             # Закончилось всё
             if verbosity:
@@ -220,9 +225,9 @@ def dumpdb_console(dirpath, entities_list=None, gzip_compression=0, verbosity=2)
                     pass
                 drawer = None
                 if verbosity:
-                    print()
+                    print(' ' + speed(status))
             elif verbosity:
-                print('ok. {}'.format(status['count']))
+                print('ok. {} ({})'.format(status['count'], speed(status)))
             continue
 
         if verbosity >= 2:
@@ -317,6 +322,49 @@ def loaddb_console(paths, verbosity=2, only_create=False):
                     ))
 
 
+def bulk_loaddb_console(paths, verbosity=2, batch_size=1000):
+    mfd = MiniFictionDump()
+
+    filelist = mfd.walk_all_paths(paths)
+    if not filelist:
+        raise OSError('Cannot find dump files')
+
+    titles = {'update': 'optional relations', 'm2m': 'many-to-many relations'}
+    inserted = 0
+    current = None
+    last_status = None
+
+    def finish(status):
+        if verbosity:
+            speed = status['current'] / status['elapsed'] if status['elapsed'] else 0
+            print('\r{}: {} rows ({:.0f} rows/s)'.format(current, status['current'], speed))
+
+    for status in mfd.bulk_load_from_files(filelist=filelist, batch_size=batch_size):
+        if status['stage'] == 'insert':
+            title = status['path'].name
+        elif status['stage']:
+            title = '{} {}'.format(status['entity'], titles[status['stage']])
+        else:
+            title = None
+
+        if title != current:
+            if last_status is not None:
+                finish(last_status)
+                if last_status['stage'] == 'insert':
+                    inserted += last_status['current']
+            current = title
+
+        if title is None:
+            break
+        last_status = status
+        if verbosity >= 2:
+            print('\r{}: {}'.format(title, status['current']), end='')
+            sys.stdout.flush()
+
+    if verbosity:
+        print('Finished. {} objects created'.format(inserted))
+
+
 def zip_dump(path: Path, params=None, keep_broken=False):
     """
     Создаёт дамп некоторых моделей сайта, безопасный для публичного
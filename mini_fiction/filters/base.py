@@ -2,10 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import threading
 from functools import wraps
 
 from lxml import etree
-from flask import current_app
+from flask import current_app, has_app_context
+
+
+# Compiled stylesheets shared by all threads of the process:
+# {path: (mtime, etree.XSLT)}
+_xslt_registry = {}
+_xslt_registry_lock = threading.Lock()
 
 
 def load_xslt_transform(file_path):
@@ -13,6 +20,34 @@ def load_xslt_transform(file_path):
         return etree.XSLT(etree.XML(f.read(), base_url=file_path))
 
 
+def get_xslt_transform(file_path, auto_reload=False):
+    '''Возвращает скомпилированную XSLT-таблицу из общего для всего процесса
+    реестра, компилируя её при первом обращении. Если ``auto_reload``
+    включен, то при изменении mtime файла таблица будет перекомпилирована.
+    '''
+
+    item = _xslt_registry.get(file_path)
+    if item is not None and not auto_reload:
+        return item[1]
+
+    mtime = os.stat(file_path).st_mtime_ns
+    if item is not None and item[0] == mtime:
+        return item[1]
+
+    with _xslt_registry_lock:
+        # Другой поток мог успеть скомпилировать таблицу, пока мы ждали
+        item = _xslt_registry.get(file_path)
+        if item is None or item[0] != mtime:
+            item = (mtime, load_xslt_transform(file_path))
+            _xslt_registry[file_path] = item
+    return item[1]
+
+
+def clear_xslt_registry():
+    with _xslt_registry_lock:
+        _xslt_registry.clear()
+
+
 def html_doc_transform(fn):
     @wraps(fn)
     def wrapper(doc, **kw):
@@ -51,17 +86,13 @@ def xslt_transform_loader(file_path):
     def factory(xslt_name):
         xslt_path = os.path.join(dir_path, xslt_name)
 
-        if False and not current_app.config['DEBUG']:  # FIXME: can't port this
-            transform_ = load_xslt_transform(xslt_path)
-
-            def transform(doc, **kw):
-                kw = transform_xslt_params(kw)
-                return transform_(doc, **kw).getroot()
-        else:
-            def transform(doc, **kw):
-                kw = transform_xslt_params(kw)
-                transform = load_xslt_transform(xslt_path)
-                return transform(doc, **kw).getroot()
+        # Фабрика вызывается при импорте модуля, когда приложения ещё нет,
+        # поэтому настройка проверяется только в момент вызова
+        def transform(doc, **kw):
+            kw = transform_xslt_params(kw)
+            auto_reload = has_app_context() and current_app.config['XSLT_AUTO_RELOAD']
+            transform_ = get_xslt_transform(xslt_path, auto_reload=auto_reload)
+            return transform_(doc, **kw).getroot()
 
         return html_doc_transform(transform)
     return factory
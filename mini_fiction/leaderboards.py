@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from flask import current_app
+
+
+def bucket_period(period: int, periods: Optional[List[int]] = None) -> int:
+    '''Приводит произвольный период топа (в днях, 0 — за всё время)
+    к ближайшему из STORY_TOP_PERIODS. Ближайший считается в разах, а не
+    в днях: 10 дней ближе к неделе, чем к месяцу, а периоды намного
+    длиннее самого длинного считаются топом за всё время.
+    '''
+
+    if periods is None:
+        periods = current_app.config['STORY_TOP_PERIODS']
+    limited = sorted(x for x in periods if x > 0)
+    if period <= 0 or not limited:
+        return 0 if 0 in periods or not limited else limited[-1]
+    if period in limited:
+        return period
+    if 0 in periods and period >= limited[-1] * 2:
+        return 0
+    return min(limited, key=lambda x: abs(math.log(period / x)))
+
+
+class StoryLeaderboards:
+    '''Топы рассказов за стандартные периоды (STORY_TOP_PERIODS): первые
+    STORY_TOP_SIZE id рассказов по рейтингу лежат в кэше упакованной
+    строкой, как в CachePublishedStoryIds. Задача rebuild_story_top
+    периодически пересобирает их, а изменение рейтинга рассказа, который
+    есть в топе или может в него попасть, сбрасывает топ, чтобы его
+    пересобрал следующий запрос.
+    '''
+
+    cache_key = 'story_top_{}'
+
+    def __init__(self, app):
+        self._periods = list(app.config['STORY_TOP_PERIODS'])
+        self._size = app.config['STORY_TOP_SIZE']
+        # С запасом, чтобы топ не пропадал из кэша между пересборками
+        self._timeout = app.config['STORY_TOP_REFRESH_INTERVAL'] * 2
+
+    def get_ids(self, period: int) -> List[int]:
+        '''Возвращает id рассказов топа, отсортированные по рейтингу.
+
+        :param int period: период в днях (0 — за всё время); приводится
+          к ближайшему стандартному через bucket_period
+        '''
+
+        period = bucket_period(period, self._periods)
+        entry = current_app.cache.get(self.cache_key.format(period))
+        if entry is None:
+            entry = self._build(period)
+        ids = array('I')
+        ids.frombytes(entry[0])
+        return ids.tolist()
+
+    def rebuild(self) -> Dict[int, int]:
+        '''Пересобирает все топы; возвращает {период: число рассказов}.'''
+        return {period: len(self._build(period)[0]) // array('I').itemsize for period in self._periods}
+
+    def rating_changed(self, story_id: int, vote_value: int, vote_total: int, first_published_at: Optional[datetime], published: bool) -> None:
+        '''Сбрасывает топы, на которые могло повлиять изменение рейтинга
+        рассказа (вызывается через later, после коммита).
+        '''
+
+        qualifies = published and vote_total >= current_app.config['MINIMUM_VOTES_FOR_VIEW']
+        now = datetime.utcnow()
+        for period in self._periods:
+            key = self.cache_key.format(period)
+            entry = current_app.cache.get(key)
+            if entry is None:
+                continue
+            packed, threshold = entry
+
+            in_period = period == 0 or (first_published_at is not None and first_published_at >= now - timedelta(days=period))
+            if not in_period:
+                continue
+
+            ids = array('I')
+            ids.frombytes(packed)
+            if story_id in ids:
+                # Рассказ мог сдвинуться в топе или выпасть из него
+                current_app.cache.delete(key)
+            elif qualifies and (threshold is None or len(ids) < self._size or (vote_value, story_id) > threshold):
+                # Рассказ попадает в топ
+                current_app.cache.delete(key)
+
+    def _build(self, period):
+        from mini_fiction.models import Story
+
+        top = Story.bl.select_top_ids(period, self._size)
+        ids = array('I', [x[0] for x in top])
+        # Последнее место в топе: чтобы попасть в топ, нужно его обогнать
+        threshold = (top[-1][1], top[-1][0]) if top else None
+        entry = (ids.tobytes(), threshold)
+        current_app.cache.set(self.cache_key.format(period), entry, timeout=self._timeout)
+        return entry
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
 import re
+import signal
+import threading
+import time
 from itertools import chain
 from pathlib import Path
+from types import FrameType
 from typing import Dict, List, Optional, Tuple
 
-from flask import g, url_for
+from flask import g, has_request_context, request, url_for
 from pydantic import BaseModel, parse_file_as
 from werkzeug.datastructures import MultiDict
 
@@ -31,16 +35,17 @@ RawAsset = Dict[str, Asset]
 ResolvedAssets = List[Tuple[str, ResolvedAsset]]
 
 
-def get_manifest(*, bundle_type: str, path: Path) -> ResolvedAssets:
-    bundle_dir_name = path.parent.name
-
+def load_manifest(path: Path) -> RawAsset:
     if not path.exists():
         raise FileNotFoundError(
             f"Manifest file {path.as_posix()} does not exist. "
             'Use "make frontend" or "make frontend-build" command to create it'
         )
+    return parse_file_as(RawAsset, path)
 
-    raw_assets: RawAsset = parse_file_as(RawAsset, path)
+
+def resolve_manifest(*, bundle_type: str, path: Path, raw_assets: RawAsset) -> ResolvedAssets:
+    bundle_dir_name = path.parent.name
     return [
         (
             name,
@@ -53,35 +58,145 @@ def get_manifest(*, bundle_type: str, path: Path) -> ResolvedAssets:
     ]
 
 
-# pylint: disable=unsubscriptable-object
-def _get_assets() -> MultiDict[str, ResolvedAsset]:
-    static_root = Path(get_settings().STATIC_ROOT)
-    bundled_manifests = chain(
-        *(
-            get_manifest(bundle_type="static", path=manifest_path)
-            for manifest_path in static_root.glob("*/manifest.json")
-        )
-    )
+def get_manifest(*, bundle_type: str, path: Path) -> ResolvedAssets:
+    return resolve_manifest(bundle_type=bundle_type, path=path, raw_assets=load_manifest(path))
+
+
+def _find_manifests() -> List[Tuple[str, Path]]:
+    manifests = [("static", path) for path in sorted(Path(get_settings().STATIC_ROOT).glob("*/manifest.json"))]
     localstatic_root_path = get_settings().LOCALSTATIC_ROOT
     if localstatic_root_path is not None:
-        localstatic_root = Path(localstatic_root_path)
-        localstatic_manifests = chain(
-            *(
-                get_manifest(bundle_type="localstatic", path=manifest_path)
-                for manifest_path in localstatic_root.glob("*/manifest.json")
-            )
-        )
-    else:
-        localstatic_manifests = chain()
+        manifests.extend(("localstatic", path) for path in sorted(Path(localstatic_root_path).glob("*/manifest.json")))
+    return manifests
+
+
+class ManifestsRegistry:
+    """Manifests parsed once per process and shared by all threads."""
+
+    def __init__(self) -> None:
+        # {path: (mtime_ns, bundle_type, raw assets)}
+        self.manifests: Dict[Path, Tuple[int, str, RawAsset]] = {}
+        self.lock = threading.Lock()
+        # When manifest files were last globbed and stat'ed (None means "never")
+        self.checked_at: Optional[float] = None
+        # Incremented on every change of the registry, invalidates resolved_assets
+        self.version = 0
+        # {(registry version, script root): resolved assets}
+        self.resolved_assets: Dict[Tuple[int, Optional[str]], MultiDict[str, ResolvedAsset]] = {}  # pylint: disable=unsubscriptable-object
+
+    def refresh(self) -> None:
+        # Must be called with self.lock held
+        changed = False
+        found = _find_manifests()
+        found_paths = {path for _, path in found}
+
+        for path in [x for x in self.manifests if x not in found_paths]:
+            del self.manifests[path]
+            changed = True
+
+        for bundle_type, path in found:
+            mtime = path.stat().st_mtime_ns
+            item = self.manifests.get(path)
+            if item is None or item[0] != mtime or item[1] != bundle_type:
+                self.manifests[path] = (mtime, bundle_type, load_manifest(path))
+                changed = True
+
+        if changed:
+            self.version += 1
+            self.resolved_assets.clear()
+        self.checked_at = time.monotonic()
 
-    return MultiDict((*bundled_manifests, *localstatic_manifests))
+    def clear(self) -> None:
+        with self.lock:
+            self.manifests.clear()
+            self.resolved_assets.clear()
+            self.checked_at = None
+            self.version += 1
+
+
+_manifests_registry = ManifestsRegistry()
+
+
+def get_raw_manifests(*, auto_reload: bool = False) -> Tuple[int, List[Tuple[str, Path, RawAsset]]]:
+    """Returns parsed manifests from the process-wide registry together
+    with the registry version. Manifest files are globbed and stat'ed again
+    on every call if ``auto_reload`` is enabled, otherwise no more often
+    than every FRONTEND_MANIFESTS_CHECK_INTERVAL seconds (never if it is
+    None); only changed files are parsed again.
+    """
+
+    registry = _manifests_registry
+    interval = get_settings().FRONTEND_MANIFESTS_CHECK_INTERVAL
+    checked_at = registry.checked_at
+    if (
+        auto_reload
+        or checked_at is None
+        or interval is not None and time.monotonic() - checked_at >= interval
+    ):
+        with registry.lock:
+            # Another thread might have refreshed the registry while we were waiting
+            if auto_reload or registry.checked_at is checked_at:
+                registry.refresh()
+
+    with registry.lock:
+        return registry.version, [
+            (bundle_type, path, raw_assets)
+            for path, (_, bundle_type, raw_assets) in registry.manifests.items()
+        ]
+
+
+def invalidate_manifests_registry() -> None:
+    """Makes the next get_raw_manifests call check manifest files again.
+    Safe to call from a signal handler.
+    """
+
+    _manifests_registry.checked_at = None
+
+
+def clear_manifests_registry() -> None:
+    _manifests_registry.clear()
+
+
+def install_sighup_handler() -> None:
+    """Makes SIGHUP revalidate manifests (e.g. after deploying new frontend
+    build without restarting the workers). Previous handler is still called.
+    """
+
+    previous_handler = signal.getsignal(signal.SIGHUP)
+
+    def handler(signum: int, frame: Optional[FrameType]) -> None:
+        invalidate_manifests_registry()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+
+    signal.signal(signal.SIGHUP, handler)
+
+
+# pylint: disable=unsubscriptable-object
+def _get_assets(*, auto_reload: bool = False) -> MultiDict[str, ResolvedAsset]:
+    version, manifests = get_raw_manifests(auto_reload=auto_reload)
+
+    # URLs depend on the application root only, so they are resolved once
+    # for every registry version
+    key = (version, request.script_root if has_request_context() else None)
+    registry = _manifests_registry
+    assets = registry.resolved_assets.get(key)
+    if assets is None:
+        assets = MultiDict(chain(*(
+            resolve_manifest(bundle_type=bundle_type, path=path, raw_assets=raw_assets)
+            for bundle_type, path, raw_assets in manifests
+        )))
+        with registry.lock:
+            if version == registry.version:
+                registry.resolved_assets[key] = assets
+    return assets
 
 
 # pylint: disable=unsubscriptable-object
 def get_assets() -> MultiDict[str, ResolvedAsset]:
     if get_settings().FRONTEND_MANIFESTS_AUTO_RELOAD:
         # Always serve assets from fresh manifests
-        return _get_assets()
+        return _get_assets(auto_reload=True)
 
     manifests = getattr(g, "frontend_assets", None)
     if manifests is None:
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+
+import click
+from flask import current_app
+from pony import orm
+from pony.orm import db_session
+
+from mini_fiction.database import db
+from mini_fiction.models import Story
+from mini_fiction.management.manager import cli
+
+
+def build_stories_downloads(story_ids, extensions=None, force=False):
+    from mini_fiction.downloads import list_formats
+    from mini_fiction.downloads.artifacts import build_story_artifacts
+
+    formats = [x for x in list_formats() if not extensions or x.extension in extensions]
+    built = 0
+    for story_id in story_ids:
+        with db_session:
+            story = Story.get(id=story_id)
+            if story is None or not story.published or not story.published_chapters_count:
+                continue
+            built += len(build_story_artifacts(story, formats=formats, force=force))
+    return len(story_ids), built
+
+
+_worker_app = None
+
+
+def _init_worker():
+    _worker_app.app_context().push()
+
+
+@cli.command(short_help='Renders story download files.', help='Renders missing and outdated download files (FB2, HTML etc.) of all published stories.')
+@click.option('-j', '--processes', type=int, default=1, help='Number of processes (default 1).')
+@click.option('-f', '--format', 'extensions', multiple=True, help='Render only files with this extension (e.g. fb2, html.zip); may be repeated.')
+@click.option('--force', is_flag=True, help='Render files even if they are up to date.')
+@click.option('--chunk-size', type=int, default=20, help='How many stories one process renders at a time (default 20).')
+def builddownloads(processes, extensions, force, chunk_size):
+    global _worker_app
+
+    orm.sql_debug(False)
+    with db_session:
+        story_ids = list(orm.select(
+            x.id for x in Story if x.approved and not x.draft and x.published_chapters_count > 0
+        ).order_by(1))
+
+    chunks = [story_ids[i:i + chunk_size] for i in range(0, len(story_ids), chunk_size)]
+    started_at = time.monotonic()
+    done = 0
+    built = 0
+
+    def progress(result):
+        nonlocal done, built
+        done += result[0]
+        built += result[1]
+        tm = max(time.monotonic() - started_at, 0.001)
+        sys.stderr.write(' [%.1f%%] %d/%d stories, %d files, %.1f stories/s\r' % (
+            done * 100 / max(len(story_ids), 1), done, len(story_ids), built, done / tm,
+        ))
+        sys.stderr.flush()
+
+    if processes > 1 and len(chunks) > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        mp_context = multiprocessing.get_context('fork')
+        # Соединение с базой данных не должно достаться дочерним процессам
+        db.disconnect()
+        _worker_app = current_app._get_current_object()  # pylint: disable=protected-access
+
+        with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context, initializer=_init_worker) as executor:
+            futures = [executor.submit(build_stories_downloads, chunk, extensions, force) for chunk in chunks]
+            for future in as_completed(futures):
+                progress(future.result())
+    else:
+        for chunk in chunks:
+            progress(build_stories_downloads(chunk, extensions, force))
+
+    sys.stderr.write('\n Rendered %d files for %d stories in %.1fs\n' % (built, done, time.monotonic() - started_at))
+    sys.stderr.flush()
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import click
+from flask import current_app
 from pony import orm
 
 from mini_fiction.management.manager import cli
@@ -94,6 +95,16 @@ def check_comments_for(target, comments_list):
     tree = target.bl.get_comments_tree()
     check_comments_tree(tree)
 
+    # Сверяем закэшированную структуру дерева (используется в пагинации)
+    # с пересчитанной по уже исправленным данным
+    cached_index = current_app.cache.get(target.bl.get_comments_tree_cache_key())
+    tree_index = target.bl.reset_comments_tree_index()
+    if cached_index is not None and cached_index != tree_index:
+        print('comments tree cache: count {} -> {}, roots {} -> {}'.format(
+            cached_index['count'], tree_index['count'],
+            len(cached_index['root_ids']), len(tree_index['root_ids']),
+        ))
+
 
 @cli.command(short_help='Checks story comments.', help='Checks tree, answers, votes, ids etc. of story comments.')
 @click.argument('story_ids', nargs=-1, type=int)
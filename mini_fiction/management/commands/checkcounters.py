@@ -4,8 +4,12 @@
 # pylint: disable=cell-var-from-loop
 
 import sys
+import time
+from itertools import repeat
+
 import click
 from pony import orm
+from pony.orm.core import populate_criteria_list
 
 from mini_fiction.management.manager import cli
 from mini_fiction.models import (
@@ -189,12 +193,144 @@ def check_chapter_views_count(verbosity=0, dry_run=False):
         print('{} chapters available, {} chapters changed'.format(all_count, changed_count), file=sys.stderr)
 
 
+def check_counters_set_based(entity, title, aggregates, stored, format_label, verbosity=0, dry_run=False, batch_size=1000):
+    """Пересчитывает счётчики одной модели несколькими запросами с GROUP BY
+    вместо одного-двух запросов на каждый объект.
+
+    :param entity: модель Pony
+    :param str title: название для вывода (например, ``authors``)
+    :param dict aggregates: {имя счётчика: функция, возвращающая пары
+      ``(id, значение)``}; объекты, которых в результате нет, получают 0
+    :param stored: функция, возвращающая кортежи ``(id, подпись...,
+      значения счётчиков в порядке aggregates)``
+    :param format_label: функция, делающая из подписи строку для вывода
+    :param int batch_size: по сколько изменённых строк обновлять за раз
+    """
+
+    fields = list(aggregates)
+    started_at = time.monotonic()
+
+    with orm.db_session:
+        expected = {}
+        for field, query in aggregates.items():
+            tm = time.monotonic()
+            expected[field] = dict(query())
+            if verbosity >= 2:
+                print('{}.{}: {} non-zero values, {:.2f}s'.format(
+                    title, field, len(expected[field]), time.monotonic() - tm,
+                ), file=sys.stderr)
+        aggregates_time = time.monotonic() - started_at
+
+        tm = time.monotonic()
+        all_count = 0
+        changes = []
+        for row in stored():
+            all_count += 1
+            obj_id = row[0]
+            label = row[1:-len(fields)]
+            old_values = row[-len(fields):]
+            new_values = tuple(expected[field].get(obj_id, 0) for field in fields)
+
+            for field, old_value, new_value in zip(fields, old_values, new_values):
+                if verbosity >= 2 or (verbosity and old_value != new_value):
+                    print('{} {}: {} -> {}'.format(format_label(obj_id, *label), field, old_value, new_value), file=sys.stderr)
+            if new_values != tuple(old_values):
+                changes.append(new_values + (obj_id,))
+        diff_time = time.monotonic() - tm
+
+    tm = time.monotonic()
+    if changes and not dry_run:
+        db = entity._database_
+        attrs = [entity._adict_[field] for field in fields]
+        params = [['PARAM', (i, None, None), attr.converters[0]] for i, attr in enumerate(attrs)]
+        where_list = ['WHERE']
+        populate_criteria_list(where_list, entity._pk_columns_, entity._pk_converters_, repeat('EQ'), len(params))
+        sql, adapter = db._ast2sql(['UPDATE', entity._table_, [(attr.column, param) for attr, param in zip(attrs, params)], where_list])
+
+        for i in range(0, len(changes), batch_size):
+            with orm.db_session:
+                cursor = db.get_connection().cursor()
+                cursor.executemany(sql, [adapter(x) for x in changes[i:i + batch_size]])
+    update_time = time.monotonic() - tm
+
+    if verbosity >= 1:
+        print('{} {} available, {} {} changed'.format(all_count, title, len(changes), title), file=sys.stderr)
+        print('{}: {:.2f}s (aggregates {:.2f}s, diff {:.2f}s, update {:.2f}s)'.format(
+            title, time.monotonic() - started_at, aggregates_time, diff_time, update_time,
+        ), file=sys.stderr)
+
+
+def check_all_counters_set_based(verbosity=0, dry_run=False, batch_size=1000):
+    families = [
+        (Author, 'authors', {
+            'published_stories_count': lambda: orm.select(
+                (c.user.id, orm.count(c.story, distinct=True))
+                for c in StoryContributor
+                if not c.story.draft and c.story.approved and c.is_author
+            ),
+            'all_story_comments_count': lambda: orm.select(
+                (c.author.id, orm.count(c)) for c in StoryComment if c.author is not None
+            ),
+        }, lambda: orm.select(
+            (x.id, x.username, x.published_stories_count, x.all_story_comments_count) for x in Author
+        ), lambda obj_id, username: 'Author {} (id={})'.format(username, obj_id)),
+
+        (Tag, 'tags', {
+            'stories_count': lambda: orm.select((x.tag.id, orm.count(x)) for x in StoryTag),
+            'published_stories_count': lambda: orm.select(
+                (x.tag.id, orm.count(x)) for x in StoryTag if x.story.approved and not x.story.draft
+            ),
+        }, lambda: orm.select(
+            (x.id, x.name, x.stories_count, x.published_stories_count) for x in Tag
+        ), lambda obj_id, name: 'Tag {} (id={})'.format(name, obj_id)),
+
+        (Story, 'stories', {
+            'all_chapters_count': lambda: orm.select((x.story.id, orm.count(x)) for x in Chapter),
+            'published_chapters_count': lambda: orm.select((x.story.id, orm.count(x)) for x in Chapter if not x.draft),
+            # Как и в check_story_chapters_and_views_count, все анонимные
+            # просмотры считаются за одного зрителя
+            'views': lambda: orm.select(
+                (x.story.id, orm.count(orm.coalesce(x.author.id, 0), distinct=True))
+                for x in StoryView if x.story is not None
+            ),
+        }, lambda: orm.select(
+            (x.id, x.all_chapters_count, x.published_chapters_count, x.views) for x in Story
+        ), lambda obj_id: 'Story {}'.format(obj_id)),
+
+        (Chapter, 'chapters', {
+            'views': lambda: orm.select(
+                (x.chapter.id, orm.count(orm.coalesce(x.author.id, 0), distinct=True))
+                for x in StoryView if x.chapter is not None
+            ),
+        }, lambda: orm.select(
+            (x.id, x.story.id, x.order, x.views) for x in Chapter
+        ), lambda obj_id, story_id, order: 'Chapter {}/{} ({})'.format(story_id, order, obj_id)),
+    ]
+
+    for i, (entity, title, aggregates, stored, format_label) in enumerate(families):
+        if i > 0 and verbosity:
+            print('', file=sys.stderr)
+        check_counters_set_based(
+            entity, title, aggregates, stored, format_label,
+            verbosity=verbosity, dry_run=dry_run, batch_size=batch_size,
+        )
+
+
 @cli.command(short_help='Recalculates counters', help='Recalculates some cached counters (stories count, chapters count, views etc.)')
 @click.option('-d', '--dry-run', 'dry_run', help='Only print log with no changes made', is_flag=True)
 @click.option("-v", "--verbose", "verbosity", count=True, help='Verbosity: -v prints changed items, -vv prints all items.')
-def checkcounters(dry_run, verbosity=0):
+@click.option('-s', '--set-based', 'set_based', is_flag=True, help='Calculate all counters with a few GROUP BY queries and update changed rows in bulk (much faster on big databases).')
+@click.option('--batch-size', 'batch_size', type=int, default=1000, help='Rows per bulk UPDATE in set-based mode (default 1000).')
+def checkcounters(dry_run, verbosity=0, set_based=False, batch_size=1000):
     orm.sql_debug(False)
 
+    if set_based:
+        check_all_counters_set_based(verbosity=verbosity, dry_run=dry_run, batch_size=batch_size)
+        if verbosity and dry_run:
+            print('', file=sys.stderr)
+            print('(DRY RUN)', file=sys.stderr)
+        return
+
     check_author_counters(verbosity=verbosity, dry_run=dry_run)
     if verbosity:
         print('', file=sys.stderr)
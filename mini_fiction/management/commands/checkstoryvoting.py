@@ -11,10 +11,11 @@ from mini_fiction.management.manager import cli
 from mini_fiction.models import Story
 
 
-@cli.command(help='Checks votes of stories.')
+@cli.command(help='Checks votes of stories and recalculates rating and its aggregates (vote_extra) from all votes.')
 @click.argument('story_ids', nargs=-1, type=int)
 @click.option("-v", "--verbose", "verbosity", count=True, help='Verbosity: -v prints changed items, -vv prints all items.')
-def checkstoryvoting(story_ids, verbosity=0):
+@click.option('-n', '--dry-run', 'dry_run', is_flag=True, help='Only print changed stories, don\'t save them.')
+def checkstoryvoting(story_ids, verbosity=0, dry_run=False):
     orm.sql_debug(False)
 
     if not current_app.story_voting:
@@ -66,7 +67,11 @@ def checkstoryvoting(story_ids, verbosity=0):
                         f'Story {story.id}: {old_value} -> {new_value}{" (changed)" if changed else ""}'
                     )
 
-            if changed_stories:
+            if changed_stories and dry_run:
+                if verbosity:
+                    print('Found {} changed stories (not saved).'.format(len(changed_stories)), flush=True)
+                orm.rollback()
+            elif changed_stories:
                 if verbosity:
                     print('Saving...', end=' ', flush=True)
                 for story in changed_stories:
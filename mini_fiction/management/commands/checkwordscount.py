@@ -37,7 +37,7 @@ def story_check_words_count(story, verbosity=0):
         if chapter_changed:
             chapters_changed += 1
             orm.commit()
-            current_app.tasks['sphinx_update_chapter'].delay(chapter.id, update_story_words=False)
+            current_app.search_queue.push_chapter(chapter.id, update_story_words=False)
 
     story_changed = story.words != all_words
 
@@ -50,7 +50,7 @@ def story_check_words_count(story, verbosity=0):
     if story_changed:
         story.words = all_words
         orm.commit()
-        current_app.tasks['sphinx_update_story'].delay(story.id, ('words',))
+        current_app.search_queue.push_story(story.id, ('words',))
 
     return story_changed, chapters_changed
 
@@ -5,6 +5,7 @@ from typing import Optional
 import click
 from pony.orm import db_session
 
+from mini_fiction.bl.stories import create_chapters_html_render_pool
 from mini_fiction.management.manager import cli
 from mini_fiction.models import Chapter
 
@@ -12,13 +13,16 @@ from mini_fiction.models import Chapter
 @cli.command(short_help="Dumps formatted chapter texts.")
 @click.option("--from", "from_story_id", type=int, help="Start with specified story id")
 @click.option("--to", "to_story_id", type=int, help="Start at specified story id")
+@click.option("-j", "--processes", type=int, default=1, help="Number of processes for rendering chapters (default 1)")
 @click.argument("output_directory")
 def dumpchaptershtml(
     output_directory: str,
     from_story_id: Optional[int] = None,
     to_story_id: Optional[int] = None,
+    processes: int = 1,
 ) -> None:
     output_path = Path(output_directory)
+    executor = create_chapters_html_render_pool(processes) if processes > 1 else None
     isatty = sys.stderr.isatty()
     last_chapter_id: Optional[int] = None
 
@@ -37,10 +41,12 @@ def dumpchaptershtml(
 
             qs = qs.prefetch(Chapter.notes, Chapter.text).order_by(Chapter.id)
 
-            chapters = list(qs[:20])
+            chapters = list(qs[:20 * max(1, processes)])
             if not chapters:
                 break
 
+            Chapter.bl.prefetch_html(chapters, executor=executor)
+
             for chapter in chapters:
                 last_chapter_id = chapter.id
 
@@ -63,5 +69,8 @@ def dumpchaptershtml(
                     fp.write(chapter.text_as_html)
                     fp.write("\n")
 
+    if executor is not None:
+        executor.shutdown()
+
     if isatty:
         print(f"\r\033[KDumped {count} chapters, skipped {empty_count} empty chapters.", file=sys.stderr)
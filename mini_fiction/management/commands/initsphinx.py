@@ -2,23 +2,128 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import time
 
+import click
 from flask import current_app
 from pony import orm
 from pony.orm import db_session
 
+from mini_fiction.database import db
 from mini_fiction.models import Story, Chapter
+from mini_fiction.bl.stories import reset_search_cache
 
 
 from mini_fiction.management.manager import cli
 
 
+# Сколько общих полей рассказов помнить при индексации глав; главы одного
+# рассказа обычно идут подряд по id, так что больше и не нужно
+COMMON_FIELDS_CACHE_SIZE = 5000
+
+
+def index_chapters_range(min_id, max_id, read_size, max_batch_bytes, progress=None):
+    '''Индексирует главы с id в диапазоне [min_id, max_id], читая их из базы
+    порциями по read_size штук с keyset-пагинацией по id.
+
+    :param progress: необязательная функция, которая вызывается после
+      каждой порции с аргументами (число глав, размер текстов в байтах)
+    :return: кортеж (число глав, размер текстов в байтах, число запросов)
+    '''
+
+    count = 0
+    size = 0
+    statements = 0
+    common_fields_cache = {}
+    pk = min_id - 1
+
+    while True:
+        with db_session:
+            chapters = tuple(
+                Chapter.select(lambda x: x.id > pk and x.id <= max_id)
+                .prefetch(
+                    Chapter.text,
+                    Chapter.notes,
+                    Chapter.story,
+                    Story.contributors,
+                    Story.characters,
+                    Story.tags,
+                )
+                .order_by(Chapter.id)[:read_size]
+            )
+            if not chapters:
+                break
+
+            if len(common_fields_cache) > COMMON_FIELDS_CACHE_SIZE:
+                common_fields_cache.clear()
+
+            statements += Chapter.bl.add_chapters_to_search(
+                chapters,
+                update_story_words=False,
+                common_fields_cache=common_fields_cache,
+                max_batch_bytes=max_batch_bytes,
+            )
+            pk = chapters[-1].id
+
+            chunk_size = sum(len((x.text or '').encode('utf-8')) for x in chapters)
+            count += len(chapters)
+            size += chunk_size
+            if progress is not None:
+                progress(len(chapters), chunk_size)
+
+    return count, size, statements
+
+
+_worker_app = None
+_worker_counters = None
+
+
+def _init_worker(counters):
+    global _worker_counters
+    _worker_counters = counters
+    _worker_app.app_context().push()
+    # Соединения родителя не годятся для использования в дочернем процессе
+    _worker_app.sphinx = _worker_app.sphinx.copy()
+
+
+def _worker_progress(count, size):
+    with _worker_counters.get_lock():
+        _worker_counters[0] += count
+        _worker_counters[1] += size
+
+
+def _index_chapters_range_in_worker(min_id, max_id, read_size, max_batch_bytes):
+    return index_chapters_range(min_id, max_id, read_size, max_batch_bytes, progress=_worker_progress)
+
+
+def _print_progress(title, ok, count, size, started_at):
+    tm = max(time.monotonic() - started_at, 0.001)
+    sys.stderr.write(' [%.1f%%] %d/%d %s, %.1f/s, %.2f MiB/s\r' % (
+        ok * 100 / max(count, 1), ok, count, title, ok / tm, size / 1048576 / tm,
+    ))
+    sys.stderr.flush()
+
+
+def _print_summary(title, ok, size, statements, started_at):
+    tm = max(time.monotonic() - started_at, 0.001)
+    sys.stderr.write('\n %d %s (%.1f MiB) in %.1fs with %d queries: %.1f %s/s, %.2f MiB/s\n' % (
+        ok, title, size / 1048576, tm, statements, ok / tm, title, size / 1048576 / tm,
+    ))
+    sys.stderr.flush()
+
+
 @cli.command(short_help='Fills the search index.', help='Clears the current index of Sphinx/Manticore search and fills it from the database.')
-def initsphinx():
+@click.option('-j', '--processes', type=int, default=1, help='Number of processes for indexing chapters (default 1).')
+@click.option('--read-size', type=int, default=200, help='How many chapters to read from database at a time (default 200).')
+@click.option('--batch-bytes', type=int, default=None, help='Max size of one REPLACE query (default from SPHINX_CONFIG).')
+def initsphinx(processes, read_size, batch_bytes):
     if current_app.config.get('SPHINX_DISABLED'):
         print('Please set SPHINX_DISABLED = False before initsphinx.', file=sys.stderr)
         sys.exit(1)
 
+    if batch_bytes is None:
+        batch_bytes = current_app.config['SPHINX_CONFIG'].get('max_batch_bytes') or 4 * 1024 * 1024
+
     orm.sql_debug(False)
     sys.stderr.write(' Cleaning...')
     sys.stderr.flush()
@@ -30,12 +135,15 @@ def initsphinx():
         sphinx.flush('stories')
     with current_app.sphinx as sphinx:
         sphinx.flush('chapters')
+    reset_search_cache('stories', 'chapters')
     sys.stderr.write('Done.\n')
     sys.stderr.flush()
 
     ok = 0
     pk = 0
+    size = 0
     stories = None
+    started_at = time.monotonic()
     with db_session:
         count = Story.select().count()
     while True:
@@ -50,36 +158,76 @@ def initsphinx():
             if not stories:
                 break
 
-            Story.bl.add_stories_to_search(stories, with_chapters=False)
+            size += Story.bl.add_stories_to_search(stories, with_chapters=False, max_batch_bytes=batch_bytes)
             pk = stories[-1].id
             ok += len(stories)
-            sys.stderr.write(' [%.1f%%] %d/%d stories\r' % (ok * 100 / count, ok, count))
-            sys.stderr.flush()
+            _print_progress('stories', ok, count, size, started_at)
 
     with current_app.sphinx as sphinx:
         sphinx.flush('stories')
 
     sys.stderr.write('\n')
 
-    ok = 0
-    pk = 0
-    chapters = None
     with db_session:
         count = Chapter.select().count()
-    while True:
-        with db_session:
-            chapters = tuple(Chapter.select(lambda x: x.id > pk).order_by(Chapter.id)[:20])
-            if not chapters:
-                break
+        min_id = orm.select(orm.min(x.id) for x in Chapter).first() or 0
+        max_id = orm.select(orm.max(x.id) for x in Chapter).first() or 0
 
-            Chapter.bl.add_chapters_to_search(chapters, update_story_words=False)
-            pk = chapters[-1].id
-            ok += len(chapters)
-            sys.stderr.write(' [%.1f%%] %d/%d chapters\r' % (ok * 100 / count, ok, count))
-            sys.stderr.flush()
+    started_at = time.monotonic()
+    if processes > 1 and count > 0:
+        ok, size, statements = _index_chapters_parallel(processes, min_id, max_id, count, read_size, batch_bytes, started_at)
+    else:
+        progress_state = [0, 0]
+
+        def progress(chunk_count, chunk_size):
+            progress_state[0] += chunk_count
+            progress_state[1] += chunk_size
+            _print_progress('chapters', progress_state[0], count, progress_state[1], started_at)
+
+        ok, size, statements = index_chapters_range(min_id, max_id, read_size, batch_bytes, progress=progress)
 
     with current_app.sphinx as sphinx:
         sphinx.flush('chapters')
 
-    sys.stderr.write('\n')
-    sys.stderr.flush()
+    _print_summary('chapters', ok, size, statements, started_at)
+
+
+def _index_chapters_parallel(processes, min_id, max_id, count, read_size, batch_bytes, started_at):
+    global _worker_app
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, wait
+
+    # Диапазоны id одинаковой длины; главы удаляются редко, поэтому
+    # нагрузка между процессами распределяется достаточно равномерно
+    step = (max_id - min_id) // processes + 1
+    ranges = [(x, min(x + step - 1, max_id)) for x in range(min_id, max_id + 1, step)]
+
+    mp_context = multiprocessing.get_context('fork')
+    counters = mp_context.Array('q', 2)
+
+    # Соединение с базой данных не должно достаться дочерним процессам
+    db.disconnect()
+    _worker_app = current_app._get_current_object()  # pylint: disable=protected-access
+
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=mp_context,
+        initializer=_init_worker,
+        initargs=(counters,),
+    ) as executor:
+        futures = [
+            executor.submit(_index_chapters_range_in_worker, lo, hi, read_size, batch_bytes)
+            for lo, hi in ranges
+        ]
+        pending = futures
+        while pending:
+            _, pending = wait(pending, timeout=1.0)
+            _print_progress('chapters', counters[0], count, counters[1], started_at)
+
+        results = [f.result() for f in futures]
+
+    return (
+        sum(x[0] for x in results),
+        sum(x[1] for x in results),
+        sum(x[2] for x in results),
+    )
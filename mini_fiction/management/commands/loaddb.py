@@ -19,10 +19,19 @@ from mini_fiction.utils.misc import timedelta_format
 ))
 @click.option('-s', '--silent', 'silent', help='Don\'t print progress bar to console.', is_flag=True)
 @click.option('-C', '--only-create', 'only_create', help='Only create non-existent objects.', is_flag=True)
+@click.option('-B', '--bulk', 'bulk', help=(
+    'Fast loading to the empty database: inserts rows in batches without '
+    'checking existing objects (implies --only-create).'
+), is_flag=True)
+@click.option('--batch-size', 'batch_size', type=int, default=1000, help='Rows per batch for --bulk (default 1000).')
 @click.argument('pathlist', nargs=-1, required=True)
-def loaddb(pathlist, silent, only_create):
-    from mini_fiction.dumpload import loaddb_console as cmd
+def loaddb(pathlist, silent, only_create, bulk, batch_size):
     orm.sql_debug(False)
     tm = time.time()
-    cmd(pathlist, verbosity=1 if silent else 2, only_create=only_create)
+    if bulk:
+        from mini_fiction.dumpload import bulk_loaddb_console
+        bulk_loaddb_console(pathlist, verbosity=1 if silent else 2, batch_size=batch_size)
+    else:
+        from mini_fiction.dumpload import loaddb_console
+        loaddb_console(pathlist, verbosity=1 if silent else 2, only_create=only_create)
     print('Done in {}.'.format(timedelta_format(time.time() - tm)))
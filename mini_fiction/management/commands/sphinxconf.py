@@ -59,6 +59,7 @@ def sphinxconf():
         'chapters_index_path': chapters_index_path,
         'chapters_index_name': chapters_index_name,
         'chapters_rt_mem_limit': cfg['chapters_rt_mem_limit'],
+        'chapters_stored_fields': 'text' if cfg.get('snippets_mode') == 'stored' else '',
     }
 
     project_root = os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
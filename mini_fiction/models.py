@@ -535,10 +535,14 @@ class Story(DbEntity):  # type: ignore
         return cls.select(lambda x: not x.approved and not x.draft)
 
     def favorited(self, user_id):
-        return self.favorites.select(lambda x: x.author.id == user_id).exists()
+        user = Author.get(id=user_id)
+        state = self.bl.get_user_state(user) if user else None
+        return bool(state and state.favorited)
 
     def bookmarked(self, user_id):
-        return self.bookmarks.select(lambda x: x.author.id == user_id).exists()
+        user = Author.get(id=user_id)
+        state = self.bl.get_user_state(user) if user else None
+        return bool(state and state.bookmarked)
 
     # Дельта количества последних добавленных комментариев с момента посещения юзером рассказа
     def last_comments_by_author(self, author):
@@ -626,49 +630,11 @@ class Chapter(DbEntity):  # type: ignore
 
     @property
     def notes_as_html(self):
-        # FIXME: унести кэширование куда-нибудь в bl
-
-        cache_key = 'chapter_notes_html_{}'.format(self.id)
-        cached_result = current_app.cache.get(cache_key)
-        if cached_result and cached_result[0] == self.updated:
-            return Markup(cached_result[1])
-
-        is_new_chapter = (datetime.utcnow() - self.updated).total_seconds() < current_app.config['CHAPTER_NEW_AGE']
-        if is_new_chapter:
-            cache_timeout = current_app.config['CHAPTER_NEW_HTML_BACKEND_CACHE_TIME']
-        else:
-            cache_timeout = current_app.config['CHAPTER_OLD_HTML_BACKEND_CACHE_TIME']
-
-        result = self.bl.notes2html(self.notes)
-        current_app.cache.set(
-            cache_key,
-            (self.updated, str(result)),
-            timeout=cache_timeout,
-        )
-        return result
+        return self.bl.get_notes_html()
 
     @property
     def text_as_html(self):
-        # FIXME: унести кэширование куда-нибудь в bl
-
-        cache_key = 'chapter_text_html_{}'.format(self.id)
-        cached_result = current_app.cache.get(cache_key)
-        if cached_result and cached_result[0] == self.updated and cached_result[1] == self.text_md5:
-            return Markup(cached_result[2])
-
-        is_new_chapter = (datetime.utcnow() - self.updated).total_seconds() < current_app.config['CHAPTER_NEW_AGE']
-        if is_new_chapter:
-            cache_timeout = current_app.config['CHAPTER_NEW_HTML_BACKEND_CACHE_TIME']
-        else:
-            cache_timeout = current_app.config['CHAPTER_OLD_HTML_BACKEND_CACHE_TIME']
-
-        result = self.bl.text2html(self.text)
-        current_app.cache.set(
-            cache_key,
-            (self.updated, self.text_md5, str(result)),
-            timeout=cache_timeout,
-        )
-        return result
+        return self.bl.get_text_html()
 
     @property
     def text_preview(self):
@@ -787,11 +753,11 @@ class StoryComment(DbEntity):  # type: ignore
 
     @property
     def text_as_html(self):
-        return self.bl.text2html(self.text)
+        return Markup(self.bl.get_html()[1])
 
     @property
     def brief_text_as_html(self):
-        return self.bl.text2html(self.brief_text)
+        return Markup(self.bl.get_html()[2])
 
     def before_update(self):
         self.updated = datetime.utcnow()
@@ -864,8 +830,13 @@ class StoryLocalComment(DbEntity):  # type: ignore
     def brief_text(self):
         return htmlcrop(self.text, current_app.config['BRIEF_COMMENT_LENGTH'])
 
-    text_as_html = filtered_html_property('text', filter_html)
-    brief_text_as_html = filtered_html_property('brief_text', filter_html)
+    @property
+    def text_as_html(self):
+        return Markup(self.bl.get_html()[1])
+
+    @property
+    def brief_text_as_html(self):
+        return Markup(self.bl.get_html()[2])
 
     def before_update(self):
         self.updated = datetime.utcnow()
@@ -1037,8 +1008,13 @@ class NewsComment(DbEntity):  # type: ignore
     def brief_text(self):
         return htmlcrop(self.text, current_app.config['BRIEF_COMMENT_LENGTH'])
 
-    text_as_html = filtered_html_property('text', filter_html)
-    brief_text_as_html = filtered_html_property('brief_text', filter_html)
+    @property
+    def text_as_html(self):
+        return Markup(self.bl.get_html()[1])
+
+    @property
+    def brief_text_as_html(self):
+        return Markup(self.bl.get_html()[2])
 
     def before_update(self):
         self.updated = datetime.utcnow()
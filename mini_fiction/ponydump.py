@@ -6,11 +6,16 @@
 import os
 import gzip
 import json
+import time
 import uuid
+import threading
+from queue import Queue, Empty
+from itertools import groupby, repeat
 from datetime import datetime
 from pathlib import Path
 
 from pony import orm
+from pony.orm.core import DEFAULT, populate_criteria_list
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -68,6 +73,9 @@ class PonyDump(object):
         #   {ключмодели2: {ключмодели1}, ключмодели3: {ключмодели1}}]
         self._depcache = {}
 
+        # Кэш SQL-условий для keyset-пагинации при дампе: {Entity: str}
+        self._keyset_sql_cache = {}
+
     def _build_depmap(self):
         '''Строит список зависимостей моделей Pony ORM друг от друга.
         Каждая модель в списке имеет обязательные зависимости только
@@ -488,59 +496,23 @@ class PonyDump(object):
         if not pk:
             return
 
-        first = True
-        while pk:
+        # Keyset-пагинация: следующая пачка — это объекты с первичным ключом
+        # больше последнего выгруженного. Значения подставляются в условие
+        # как параметры запроса (last_pk — сырые значения столбцов ключа)
+        keyset_sql = self._get_keyset_sql(entity)
+        last_pk = None
+        while True:
             with orm.db_session:
-                # Тут ультра сложна: селектим объекты, прописывая в условии
-                # where корректную сортировку (просто x.get_pk() > pk никто
-                # не даст, если len(pk) > 1)
-
-                objs = None
-                pk_zip = list(zip(pk_attrs, pk))
-
-                while pk_zip:
-                    # WHERE foo == 1 AND bar == 2 AND baz > 3
-
-                    # Поня имеет баг https://github.com/ponyorm/pony/issues/223
-                    # eval() обходит этот баг, после фикса можно его убрать
-                    # (а ещё из-за этого течёт память, что хорошо заметно при
-                    # chunk_size=1)
-
-                    q = entity.select()
-                    if len(pk) == 1 and pk_zip[0][0] == 'id':
-                        # Отдельно выписан частный и самый частый случай, чтоб eval память кушал поменьше
-                        value = pk_zip[0][1]
-                        if not first:
-                            q = q.filter(lambda x: x.id > value)
-                        else:
-                            q = q.filter(lambda x: x.id >= value)
-                    else:
-                        for attr, value in pk_zip[:-1]:  # pylint: disable=unused-variable
-                            # Если что, с замыканием проблем нет, поня лямбду вообще не запускает
-                            q = q.filter(eval('lambda x: getattr(x, attr) == value'))  # pylint: disable=W0123
-                        attr, value = pk_zip[-1]
-                        if not first:
-                            q = q.filter(eval('lambda x: getattr(x, attr) > value'))  # pylint: disable=W0123
-                        else:
-                            q = q.filter(eval('lambda x: getattr(x, attr) >= value'))  # pylint: disable=W0123
-
-                    if lazy_attrs:
-                        q = q.prefetch(*lazy_attrs)
-
-                    objs = q[:chunk_size]
-                    first = False
-                    if objs:
-                        # Если объекты есть, то всё
-                        break
-
-                    # Если объектов с текущими pk не осталось, то выкидываем
-                    # меньший атрибут и пытаемся foo == 1 AND bar > 2
-                    # и так в цикле пока всё не кончится
-                    pk_zip = pk_zip[:-1]
+                if last_pk is None:
+                    q = orm.select(x for x in entity)
+                else:
+                    q = orm.select(x for x in entity if orm.raw_sql(keyset_sql))
+                q = q.order_by(*pk_attrs_objs)
+                if lazy_attrs:
+                    q = q.prefetch(*lazy_attrs)
 
+                objs = q[:chunk_size]
                 if not objs:
-                    assert not pk_zip
-                    pk = None
                     break
 
                 # Если объекты из базы достались, то дампим их
@@ -548,7 +520,9 @@ class PonyDump(object):
                 pk = objs[-1].get_pk()
                 if not isinstance(pk, tuple):
                     pk = (pk,)
-                del q, objs, pk_zip
+                last_pk = objs[-1]._get_raw_pkval_()
+                last_chunk = len(objs) < chunk_size
+                del q, objs
 
                 if sanitizer:
                     sanitizer(dump)
@@ -560,14 +534,41 @@ class PonyDump(object):
                 current_count += len(dump)
             dump = None
             yield {'current': current_count, 'count': count, 'pk': pk}
+            if last_chunk:
+                break
 
         yield {'current': current_count, 'count': count, 'pk': None}
 
-    def dump_to_directory(self, path, entities=None, chunk_sizes=None, gzip_compression=0):
+    def _get_keyset_sql(self, entity):
+        '''Возвращает SQL-условие «первичный ключ больше last_pk» для
+        запроса ``select(x for x in entity ...)``. Для первичного ключа
+        (foo, bar, baz) получается
+        ``foo > ? OR (foo = ? AND bar > ?) OR (foo = ? AND bar = ? AND baz > ?)``,
+        что работает во всех СУБД (в отличие от ``(foo, bar, baz) > (?, ?, ?)``).
+        '''
+
+        sql = self._keyset_sql_cache.get(entity)
+        if sql is not None:
+            return sql
+
+        quote_name = self.db.provider.quote_name
+        columns = ['{}.{}'.format(quote_name('x'), quote_name(c)) for c in entity._pk_columns_]
+        parts = []
+        for i, column in enumerate(columns):
+            conds = ['{} = $(last_pk[{}])'.format(columns[j], j) for j in range(i)]
+            conds.append('{} > $(last_pk[{}])'.format(column, i))
+            parts.append('(' + ' AND '.join(conds) + ')')
+        sql = '(' + ' OR '.join(parts) + ')'
+
+        self._keyset_sql_cache[entity] = sql
+        return sql
+
+    def dump_to_directory(self, path, entities=None, chunk_sizes=None, gzip_compression=0, processes=1):
         '''Дампит базу данных в указанный каталог. Если не указаны модели,
         дампит все. Генератор, yield'ит процесс. Если yield'ится 'pk': None,
         значит закончили с текущей моделью, если 'entity': None, значит
-        закончили совсем.
+        закончили совсем. В 'elapsed' лежит время в секундах с начала дампа
+        текущей модели.
 
         :param Path path: путь к каталогу, в который дампить
         :param list entites: список моделей для дампа (если пусто, то все),
@@ -575,6 +576,11 @@ class PonyDump(object):
         :param dict chunk_sizes: по сколько штук за раз брать объектов из базы
         :param int gzip_compression: если больше нуля, файлы дампа будут сжаты
           с указанной степенью сжатия (1-9) и сохранены с расширением jsonl.gz
+        :param int processes: сколько моделей дампить одновременно в отдельных
+          процессах. Каждая модель пишется в свой файл, так что при дампе
+          они друг от друга не зависят. При processes > 1 прогресс
+          yield'ится только по завершении каждой модели (с 'pk': None)
+          в порядке завершения, а вызывать метод нужно вне db_session
         '''
 
         chunk_sizes1 = dict(self.chunk_sizes)
@@ -596,24 +602,61 @@ class PonyDump(object):
         path = Path(path).resolve()
         path.mkdir(parents=True, exist_ok=True)
 
+        jobs = []
         for entity in entities:
             file_path = path / '{}_dump.jsonl'.format(entity)
             if gzip_compression > 0:
                 file_path = file_path.with_suffix(file_path.suffix + '.gz')
-                fp = gzip.open(file_path, 'wt', encoding='utf-8')
-            else:
-                fp = file_path.open('w', encoding='utf-8')
+            chunk_size = max(1, chunk_sizes.get(entity, self.default_chunk_size))
+            jobs.append((entity, file_path, chunk_size, gzip_compression))
 
-            with fp:
-                chunk_size = max(1, chunk_sizes.get(entity, self.default_chunk_size))
-                for progress in self.dump_entity(entity, fp, chunk_size=chunk_size):
-                    progress['entity'] = entity
-                    progress['path'] = file_path
-                    progress['chunk_size'] = chunk_size
-                    yield progress
+        if processes > 1 and len(jobs) > 1:
+            yield from self._dump_entities_parallel(jobs, processes)
+        else:
+            for job in jobs:
+                yield from self._dump_entity_to_file(*job)
 
         yield {'entity': None, 'path': None, 'current': 0, 'count': 0, 'pk': None}
 
+    def _dump_entity_to_file(self, entity, file_path, chunk_size, gzip_compression=0):
+        if gzip_compression > 0:
+            fp = gzip.open(file_path, 'wt', encoding='utf-8')
+        else:
+            fp = file_path.open('w', encoding='utf-8')
+
+        started_at = time.monotonic()
+        with fp:
+            for progress in self.dump_entity(entity, fp, chunk_size=chunk_size):
+                progress['entity'] = entity
+                progress['path'] = file_path
+                progress['chunk_size'] = chunk_size
+                progress['elapsed'] = time.monotonic() - started_at
+                yield progress
+
+    def _dump_entities_parallel(self, jobs, processes):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        global _worker_dump  # pylint: disable=global-statement
+
+        # Самые большие модели запускаем первыми, чтобы они не остались
+        # в одиночестве в конце
+        with orm.db_session:
+            counts = {job[0]: self.entities[job[0]].select().count() for job in jobs}
+        jobs = sorted(jobs, key=lambda job: counts[job[0]], reverse=True)
+
+        # Соединение с базой данных не должно достаться дочерним процессам
+        self.db.disconnect()
+        _worker_dump = self
+        mp_context = multiprocessing.get_context('fork')
+        try:
+            with ProcessPoolExecutor(max_workers=processes, mp_context=mp_context) as executor:
+                futures = [executor.submit(_dump_entity_worker, job) for job in jobs]
+                for future in as_completed(futures):
+                    yield future.result()
+        finally:
+            _worker_dump = None
+
     # Методы для загрузки базы данных из дампа
 
     def _prepare_deps_from_depcache(self, name, entity, pk, dump):
@@ -856,10 +899,7 @@ class PonyDump(object):
                 continue
 
             if attr.py_type is datetime:
-                if isinstance(value, (int, float)):
-                    dump[attr_name] = datetime.utcfromtimestamp(value)
-                elif not isinstance(value, datetime):
-                    dump[attr_name] = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+                dump[attr_name] = parse_json_datetime(value)
 
             # TODO: date, time, timedelta
 
@@ -1058,6 +1098,282 @@ class PonyDump(object):
 
         yield [{'path': None, 'entity': None, 'pk': None, 'created': None, 'updated': None, 'count': all_count, 'all_count': all_count}]
 
+    # Быстрая загрузка в пустую базу данных
+
+    def bulk_load_from_files(self, paths=None, filelist=None, batch_size=1000):
+        '''Быстрая загрузка дампа в базу данных, в которой ещё нет объектов
+        загружаемых моделей (только создание, как ``only_create=True``,
+        но без проверок существования объектов). Вместо создания объектов
+        Pony ORM по одному строки дампа превращаются в кортежи значений
+        столбцов и вставляются через ``executemany`` пачками по batch_size
+        штук; JSON парсится в отдельном потоке, пока вставляется предыдущая
+        пачка.
+
+        Модели загружаются в порядке зависимостей (depmap). Опциональные
+        ссылки на модели, которые ещё не загружены (и на саму себя, например
+        родительский комментарий), сначала вставляются как NULL и
+        проставляются вторым проходом через ``UPDATE`` после загрузки всех
+        файлов; тогда же вставляются связи многие-ко-многим (собранные с обеих
+        сторон и без дублей). Значения автоинкрементных первичных ключей
+        берутся из дампа.
+
+        Генератор, yield'ит прогресс: словари с ключами ``stage`` ('insert',
+        'update' или 'm2m'), ``path``, ``entity``, ``current``, ``count`` и
+        ``elapsed``. Когда stage становится None, значит всё.
+
+        :param list paths: список файлов и каталогов, в которых искать файлы
+        :param set filelist: результат вызова walk_all_paths (тогда аргумент
+          paths игнорируется)
+        :param int batch_size: по сколько строк вставлять в одной транзакции
+        '''
+
+        idx = {x[0]: i for i, x in enumerate(self.depmap)}
+        idx[''] = max(idx.values()) + 1
+
+        if filelist is None:
+            if paths is None or isinstance(paths, str):  # pragma: no cover
+                raise ValueError('List of paths is required')
+            filelist = self.walk_all_paths(paths)
+        filelist = sorted(filelist, key=lambda x: idx[x[0]])
+
+        # Модели без имени в имени файла узнаём только при чтении, поэтому
+        # считаем, что они могут загружаться до самого конца
+        order = {name: i for i, (name, _) in enumerate(filelist) if name}
+        self._check_bulk_tables_empty(order)
+
+        deferred = {}  # {(имя модели, имя атрибута): [значения столбцов + первичный ключ]}
+        m2m_links = {}  # {Set-атрибут, с чьей стороны вставляем: {строки таблицы связей}}
+
+        for position, (name, file_path) in enumerate(filelist):
+            # Ещё не загруженные модели, ссылки на которые придётся отложить
+            pending = {x for x, i in order.items() if i >= position}
+            if not name:
+                pending.update(self.entities)
+            plans = {}
+            current = 0
+            started_at = time.monotonic()
+
+            for batch in self._iter_dump_file_batches(file_path, batch_size):
+                with orm.db_session:
+                    cursor = self.db.get_connection().cursor()
+                    # Строки разных моделей (в файле без имени модели)
+                    # вставляются в том же порядке, в каком идут в файле
+                    for entity_name, dumps in groupby(batch, key=lambda x: x.pop('_entity').lower()):
+                        plan = plans.get(entity_name)
+                        if plan is None:
+                            plan = self._get_bulk_plan(entity_name, pending)
+                            plans[entity_name] = plan
+                        self._bulk_insert(cursor, plan, list(dumps), deferred, m2m_links)
+
+                current += len(batch)
+                yield {
+                    'stage': 'insert', 'path': file_path, 'entity': name or None,
+                    'current': current, 'count': None, 'elapsed': time.monotonic() - started_at,
+                }
+
+        # Второй проход: отложенные опциональные ссылки
+        for (entity_name, attr_name), rows in deferred.items():
+            entity = self.entities[entity_name]
+            attr = getattr(entity, attr_name)
+            sql, adapter = self._get_bulk_update_sql(entity, attr)
+            started_at = time.monotonic()
+            for i in range(0, len(rows), batch_size):
+                with orm.db_session:
+                    cursor = self.db.get_connection().cursor()
+                    cursor.executemany(sql, [adapter(x) for x in rows[i:i + batch_size]])
+                yield {
+                    'stage': 'update', 'path': None, 'entity': entity_name,
+                    'current': min(i + batch_size, len(rows)), 'count': len(rows),
+                    'elapsed': time.monotonic() - started_at,
+                }
+        deferred.clear()
+
+        # Третий проход: связи многие-ко-многим
+        for attr, rows in m2m_links.items():
+            sql, adapter = self._get_bulk_m2m_sql(attr)
+            rows = sorted(rows)
+            started_at = time.monotonic()
+            for i in range(0, len(rows), batch_size):
+                with orm.db_session:
+                    cursor = self.db.get_connection().cursor()
+                    cursor.executemany(sql, [adapter(x) for x in rows[i:i + batch_size]])
+                yield {
+                    'stage': 'm2m', 'path': None, 'entity': self.get_entity_name(attr.entity),
+                    'current': min(i + batch_size, len(rows)), 'count': len(rows),
+                    'elapsed': time.monotonic() - started_at,
+                }
+        m2m_links.clear()
+
+        yield {'stage': None, 'path': None, 'entity': None, 'current': 0, 'count': 0, 'elapsed': 0}
+
+    def _check_bulk_tables_empty(self, names):
+        not_empty = []
+        with orm.db_session:
+            for name in names:
+                if orm.select(x for x in self.entities[name]).exists():
+                    not_empty.append(name)
+        if not_empty:
+            raise ValueError('Bulk loading requires empty tables, but these are not: {}'.format(
+                ', '.join(sorted(not_empty))
+            ))
+
+    def _iter_dump_file_batches(self, file_path, batch_size):
+        # Файл читается и парсится в отдельном потоке; очередь ограничена,
+        # чтобы поток не убегал далеко вперёд и не съедал память
+        queue = Queue(maxsize=4)
+        stop = threading.Event()
+
+        def reader():
+            try:
+                if file_path.name.lower().endswith('.gz'):
+                    fp = gzip.open(file_path, 'rt', encoding='utf-8-sig')
+                else:
+                    fp = file_path.open('r', encoding='utf-8-sig')
+                batch = []
+                with fp:
+                    for lineno, line in enumerate(fp, 1):
+                        if stop.is_set():
+                            return
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            dump = json.loads(line)
+                        except Exception as exc:
+                            raise ValueError('Invalid JSON on line {}: {}'.format(lineno, str(exc)))
+                        if not isinstance(dump, dict) or not dump.get('_entity') or not isinstance(dump['_entity'], str):
+                            raise ValueError('Invalid dump format on line {}'.format(lineno))
+                        if dump['_entity'].lower() not in self.entities:
+                            raise ValueError('Unknown entity "{}" on line {}'.format(dump['_entity'].lower(), lineno))
+                        batch.append(dump)
+                        if len(batch) >= batch_size:
+                            queue.put(batch)
+                            batch = []
+                if batch:
+                    queue.put(batch)
+                queue.put(None)
+            except BaseException as exc:  # pylint: disable=broad-except
+                queue.put(exc)
+
+        thread = threading.Thread(target=reader, name='ponydump-reader', daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Если загрузку прервали, поток не должен остаться висеть на put
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    thread.join(0.05)
+
+    def _get_bulk_plan(self, name, pending):
+        entity = self.entities[name]
+
+        attrs = []  # [(атрибут, отложить ли ссылку)]
+        columns = []
+        converters = []
+        for attr in entity._attrs_with_columns_:
+            deferred = bool(
+                attr.reverse and not attr.is_required and not attr.is_pk and
+                self.get_entity_name(attr.reverse.entity) in pending
+            )
+            attrs.append((attr, deferred))
+            columns.extend(attr.columns)
+            converters.extend(attr.converters)
+
+        params = [['PARAM', (i, None, None), converter] for i, converter in enumerate(converters)]
+        insert_sql, insert_adapter = self.db._ast2sql(['INSERT', entity._table_, columns, params])
+
+        # Для каждой связи многие-ко-многим: с чьей стороны вставлять строки
+        # и надо ли переставлять местами ключи
+        m2m = []
+        for attr in entity._attrs_:
+            if not attr.is_collection or not attr.reverse.is_collection:
+                continue
+            owner = attr if attr.symmetric else min(
+                attr, attr.reverse, key=lambda x: (self.get_entity_name(x.entity), x.name)
+            )
+            m2m.append((attr, owner, owner is not attr))
+
+        return {
+            'name': name,
+            'entity': entity,
+            'attrs': attrs,
+            'pk_attrs': list(entity._pk_attrs_),
+            'insert': (insert_sql, insert_adapter),
+            'm2m': m2m,
+        }
+
+    def _bulk_insert(self, cursor, plan, dumps, deferred, m2m_links):
+        name = plan['name']
+        entity = plan['entity']
+        attr_names = self.attr_names[name]
+
+        rows = []
+        for dump in dumps:
+            unknown = set(dump) - attr_names
+            if unknown:
+                raise ValueError('Unknown attributes in dump of model "{}": {}'.format(
+                    name, ', '.join(unknown)
+                ))
+
+            pk = ()
+            for attr in plan['pk_attrs']:
+                pk += flatten_pk(dump[attr.name])
+
+            values = []
+            for attr, is_deferred in plan['attrs']:
+                value = dump.get(attr.name)
+                if attr.reverse:
+                    raw = flatten_pk(value) if value is not None else attr.reverse.entity._pk_nones_
+                    if is_deferred and value is not None:
+                        deferred.setdefault((name, attr.name), []).append(raw + pk)
+                        raw = attr.reverse.entity._pk_nones_
+                    values.extend(raw)
+                    continue
+
+                if attr.name not in dump:
+                    value = DEFAULT
+                elif value is not None and attr.py_type is datetime:
+                    value = parse_json_datetime(value)
+                value = attr.validate(value, None, entity)
+                values.append(attr.converters[0].val2dbval(value, None) if value is not None else None)
+            rows.append(values)
+
+            for attr, owner, swap in plan['m2m']:
+                links = m2m_links.setdefault(owner, set())
+                for value in dump.get(attr.name) or ():
+                    links.add(flatten_pk(value) + pk if swap else pk + flatten_pk(value))
+
+        sql, adapter = plan['insert']
+        cursor.executemany(sql, [adapter(x) for x in rows])
+
+    def _get_bulk_m2m_sql(self, attr):
+        # Строка таблицы связей: первичный ключ объекта с атрибутом attr,
+        # потом первичный ключ связанного объекта
+        if attr.symmetric:
+            columns = attr.columns + attr.reverse_columns
+        else:
+            columns = attr.reverse.columns + attr.columns
+        converters = list(attr.entity._pk_converters_) + list(attr.converters)
+        params = [['PARAM', (i, None, None), converter] for i, converter in enumerate(converters)]
+        return self.db._ast2sql(['INSERT', attr.table, columns, params])
+
+    def _get_bulk_update_sql(self, entity, attr):
+        converters = list(attr.converters)
+        params = [['PARAM', (i, None, None), converter] for i, converter in enumerate(converters)]
+        where_list = ['WHERE']
+        populate_criteria_list(where_list, entity._pk_columns_, entity._pk_converters_, repeat('EQ'), len(params))
+        return self.db._ast2sql(['UPDATE', entity._table_, list(zip(attr.columns, params)), where_list])
+
     def walk_all_paths(self, paths):
         '''Вспомогательный метод. Возвращает множество файлов, найденных
         по указанным путям (разрешаются файлы и каталоги, всё вложенное тоже
@@ -1090,6 +1406,47 @@ class PonyDump(object):
         return filelist
 
 
+def parse_json_datetime(value):
+    '''Дата и время в дампе: объект datetime (без tzinfo, интерпретируется
+    как UTC), UNIX-время или строка в формате ``%Y-%m-%dT%H:%M:%S.%fZ``.
+    '''
+
+    if isinstance(value, (int, float)):
+        return datetime.utcfromtimestamp(value)
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str) and len(value) == 27 and value[10] == 'T' and value[-1] == 'Z':
+        # Формат, в котором пишет JSONEncoder; fromisoformat в разы
+        # быстрее strptime, что заметно на миллионах строк
+        try:
+            return datetime.fromisoformat(value[:-1])
+        except ValueError:
+            pass
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def flatten_pk(value):
+    # Ключ из дампа (возможно, составной и вложенный) → плоский кортеж
+    # значений столбцов, как у Entity._get_raw_pkval_()
+    if not isinstance(value, (list, tuple)):
+        return (value,)
+    result = []
+    for x in value:
+        result.extend(flatten_pk(x))
+    return tuple(result)
+
+
+_worker_dump = None
+
+
+def _dump_entity_worker(job):
+    # Выполняется в дочернем процессе, возвращает последний статус дампа модели
+    progress = None
+    for progress in _worker_dump._dump_entity_to_file(*job):
+        pass
+    return progress
+
+
 def get_entities_dict(entities):
     '''Возвращает словарь имя:модель для запрашиваемых моделей.
 
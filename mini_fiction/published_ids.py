@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import random
+from array import array
+from typing import List
+
+import redis
+from flask import current_app
+from pony import orm
+
+
+def load_published_story_ids() -> List[int]:
+    from mini_fiction.models import Story
+    return list(orm.select(x.id for x in Story if x.approved and not x.draft))
+
+
+class BasePublishedStoryIds:
+    '''Множество id опубликованных рассказов, из которого выбираются
+    случайные рассказы. Обновляется по одному id при публикации, снятии
+    с публикации и удалении рассказа, чтобы не пересчитывать его целиком.
+    '''
+
+    def __init__(self, app):
+        pass
+
+    def sample(self, count: int) -> List[int]:
+        '''Возвращает до count случайных различных id опубликованных рассказов.'''
+        raise NotImplementedError
+
+    def add(self, story_id: int) -> None:
+        raise NotImplementedError
+
+    def remove(self, story_id: int) -> None:
+        raise NotImplementedError
+
+    def rebuild(self) -> int:
+        '''Заново заполняет множество из базы данных; возвращает число id.'''
+        raise NotImplementedError
+
+    def set_published(self, story_id: int, published: bool) -> None:
+        if published:
+            self.add(story_id)
+        else:
+            self.remove(story_id)
+
+
+class CachePublishedStoryIds(BasePublishedStoryIds):
+    # Хранит id в кэше одной строкой байт (array('I')): её распаковка
+    # намного дешевле, чем unpickle списка из сотен тысяч объектов int.
+    # Рядом лежит счётчик изменений, который увеличивается атомарным inc
+    # при каждом add/remove; строка хранится вместе со значением счётчика,
+    # при котором она собрана. Изменение применяется к строке на месте,
+    # только если между ним и предыдущим ничего не вклинилось и счётчик
+    # не сдвинулся за время записи, иначе строка удаляется и пересобирается
+    # при следующем чтении
+
+    cache_key = 'published_story_ids'
+    generation_key = 'published_story_ids_gen'
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._timeout = app.config['PUBLISHED_STORY_IDS_CACHE_TIME']
+
+    def _get_ids(self) -> array:
+        entry, generation = current_app.cache.get_many(self.cache_key, self.generation_key)
+        generation = generation or 0
+        ids = array('I')
+        if entry is not None and entry[0] == generation:
+            ids.frombytes(entry[1])
+            return ids
+        ids.extend(load_published_story_ids())
+        current_app.cache.set(self.cache_key, (generation, ids.tobytes()), self._timeout)
+        return ids
+
+    def _update(self, story_id: int, published: bool) -> None:
+        generation = current_app.cache.inc(self.generation_key)
+        entry = current_app.cache.get(self.cache_key)
+        if generation is None or entry is None or entry[0] != generation - 1:
+            # Строки нет или её успели изменить параллельно
+            current_app.cache.delete(self.cache_key)
+            return
+
+        ids = array('I')
+        ids.frombytes(entry[1])
+        if published and story_id not in ids:
+            ids.append(story_id)
+        elif not published and story_id in ids:
+            ids.remove(story_id)
+        current_app.cache.set(self.cache_key, (generation, ids.tobytes()), self._timeout)
+        if current_app.cache.get(self.generation_key) != generation:
+            # Параллельное изменение могло удалить строку до нашей записи
+            current_app.cache.delete(self.cache_key)
+
+    def sample(self, count):
+        ids = self._get_ids()
+        if len(ids) <= count:
+            return list(ids)
+        return [ids[i] for i in random.sample(range(len(ids)), count)]
+
+    def add(self, story_id):
+        self._update(story_id, True)
+
+    def remove(self, story_id):
+        self._update(story_id, False)
+
+    def rebuild(self):
+        current_app.cache.delete(self.cache_key)
+        return len(self._get_ids())
+
+
+class RedisPublishedStoryIds(BasePublishedStoryIds):
+    # Хранит id в множестве Redis: SRANDMEMBER выбирает случайные элементы
+    # за O(count) без передачи всего множества. Ключ built отмечает, что
+    # множество заполнено (пустое множество в Redis не отличить от
+    # отсутствующего); у него есть срок жизни, после которого множество
+    # пересобирается из базы на случай, если оно разошлось с ней
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._redis = redis.Redis(**app.config['PUBLISHED_STORY_IDS_BACKEND'])
+        self._prefix = app.config.get('PUBLISHED_STORY_IDS_PREFIX') or ''
+        self._timeout = app.config['PUBLISHED_STORY_IDS_CACHE_TIME']
+
+    def _key(self, key):
+        return self._prefix + key
+
+    def sample(self, count):
+        if not self._redis.exists(self._key('built')):
+            self.rebuild()
+        return [int(x) for x in self._redis.srandmember(self._key('ids'), count)]
+
+    def add(self, story_id):
+        self._redis.sadd(self._key('ids'), story_id)
+
+    def remove(self, story_id):
+        self._redis.srem(self._key('ids'), story_id)
+
+    def rebuild(self):
+        ids = load_published_story_ids()
+        tmp_key = self._key('ids_tmp')
+
+        pipe = self._redis.pipeline()
+        pipe.delete(tmp_key)
+        for i in range(0, len(ids), 10000):
+            pipe.sadd(tmp_key, *ids[i:i + 10000])
+        if ids:
+            pipe.rename(tmp_key, self._key('ids'))
+        else:
+            pipe.delete(self._key('ids'))
+        pipe.set(self._key('built'), 1, ex=self._timeout)
+        pipe.execute()
+        return len(ids)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Optional, Set
+
+import redis
+from flask import current_app
+
+
+@dataclass
+class SearchQueueBatch:
+    # {story_id: набор изменённых полей или None для полной переиндексации}
+    stories: Dict[int, Optional[Set[str]]] = field(default_factory=dict)
+    # {chapter_id: нужно ли обновить число слов у рассказа}
+    chapters: Dict[int, bool] = field(default_factory=dict)
+    # Сколько раз вызывались push_* для попавших в пачку изменений
+    pushed: int = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.stories or self.chapters)
+
+
+class BaseSearchQueue:
+    '''Очередь изменений для поискового индекса. Вместо отдельной задачи
+    Celery на каждое изменение рассказа или главы изменения копятся
+    в очереди и периодически применяются одной пачкой задачей
+    sphinx_flush_queue; повторные изменения одного и того же рассказа
+    при этом схлопываются в одно.
+    '''
+
+    def __init__(self, app):
+        pass
+
+    def push_story(self, story_id: int, update_fields: Optional[Iterable[str]] = None) -> None:
+        raise NotImplementedError
+
+    def push_chapter(self, chapter_id: int, update_story_words: bool = True) -> None:
+        raise NotImplementedError
+
+    def pop(self) -> Optional[SearchQueueBatch]:
+        '''Забирает из очереди все накопившиеся изменения. Возвращает None,
+        если очередь не копит изменения и применять нечего.
+        '''
+        raise NotImplementedError
+
+    def requeue(self, batch: SearchQueueBatch) -> None:
+        '''Возвращает в очередь изменения, которые не удалось применить.'''
+        raise NotImplementedError
+
+    def add_stats(self, pushed: int, applied: int, statements: int) -> None:
+        pass
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'pushed': 0, 'applied': 0, 'coalesced': 0, 'statements': 0}
+
+
+class NullSearchQueue(BaseSearchQueue):
+    # Ничего не копит, каждое изменение сразу отправляет отдельной задачей
+
+    def push_story(self, story_id, update_fields=None):
+        if update_fields is not None:
+            update_fields = tuple(update_fields)
+        current_app.tasks['sphinx_update_story'].delay(story_id, update_fields)
+
+    def push_chapter(self, chapter_id, update_story_words=True):
+        current_app.tasks['sphinx_update_chapter'].delay(chapter_id, update_story_words=update_story_words)
+
+    def pop(self):
+        return None
+
+    def requeue(self, batch):
+        for story_id, update_fields in batch.stories.items():
+            self.push_story(story_id, update_fields)
+        for chapter_id, update_story_words in batch.chapters.items():
+            self.push_chapter(chapter_id, update_story_words)
+
+
+class RedisSearchQueue(BaseSearchQueue):
+    # Ключи: множество id рассказов (stories), для каждого рассказа
+    # множество изменённых полей (story_<id>, '*' — переиндексировать всё),
+    # множество id глав (chapters) и глав с обновлением числа слов рассказа
+    # (chapters_words). Добавление в очередь атомарно вместе
+    # с увеличением счётчика pushed, а pop забирает всё одной транзакцией
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._redis = redis.Redis(**app.config['SEARCH_QUEUE_BACKEND'])
+        self._prefix = app.config.get('SEARCH_QUEUE_PREFIX') or ''
+
+    def _key(self, key):
+        return self._prefix + key
+
+    def push_story(self, story_id, update_fields=None):
+        fields = ['*'] if update_fields is None else list(update_fields)
+        if not fields:
+            return
+
+        pipe = self._redis.pipeline()
+        pipe.sadd(self._key('story_{}'.format(story_id)), *fields)
+        pipe.sadd(self._key('stories'), story_id)
+        pipe.incr(self._key('pushed'))
+        pipe.execute()
+
+    def push_chapter(self, chapter_id, update_story_words=True):
+        pipe = self._redis.pipeline()
+        pipe.sadd(self._key('chapters'), chapter_id)
+        if update_story_words:
+            pipe.sadd(self._key('chapters_words'), chapter_id)
+        pipe.incr(self._key('pushed'))
+        pipe.execute()
+
+    def pop(self):
+        pipe = self._redis.pipeline()
+        pipe.smembers(self._key('stories'))
+        pipe.smembers(self._key('chapters'))
+        pipe.smembers(self._key('chapters_words'))
+        pipe.getset(self._key('pushed'), 0)
+        pipe.delete(self._key('stories'), self._key('chapters'), self._key('chapters_words'))
+        story_ids, chapter_ids, words_chapter_ids, pushed, _ = pipe.execute()
+
+        batch = SearchQueueBatch(pushed=int(pushed or 0))
+
+        story_ids = sorted(int(x) for x in story_ids)
+        if story_ids:
+            pipe = self._redis.pipeline()
+            for story_id in story_ids:
+                pipe.smembers(self._key('story_{}'.format(story_id)))
+            pipe.delete(*[self._key('story_{}'.format(x)) for x in story_ids])
+            story_fields = pipe.execute()[:-1]
+
+            for story_id, fields in zip(story_ids, story_fields):
+                fields = {x.decode('utf-8') for x in fields}
+                if not fields:
+                    # Поля уже забрал предыдущий pop, пока рассказ добавлялся в очередь
+                    continue
+                batch.stories[story_id] = None if '*' in fields else fields
+
+        words_chapter_ids = {int(x) for x in words_chapter_ids}
+        for chapter_id in sorted(int(x) for x in chapter_ids):
+            batch.chapters[chapter_id] = chapter_id in words_chapter_ids
+
+        return batch
+
+    def requeue(self, batch):
+        pipe = self._redis.pipeline()
+        for story_id, update_fields in batch.stories.items():
+            pipe.sadd(self._key('story_{}'.format(story_id)), *(['*'] if update_fields is None else update_fields))
+            pipe.sadd(self._key('stories'), story_id)
+        for chapter_id, update_story_words in batch.chapters.items():
+            pipe.sadd(self._key('chapters'), chapter_id)
+            if update_story_words:
+                pipe.sadd(self._key('chapters_words'), chapter_id)
+        pipe.incrby(self._key('pushed'), batch.pushed)
+        pipe.execute()
+
+    def add_stats(self, pushed, applied, statements):
+        pipe = self._redis.pipeline()
+        pipe.incrby(self._key('stats_pushed'), pushed)
+        pipe.incrby(self._key('stats_applied'), applied)
+        pipe.incrby(self._key('stats_statements'), statements)
+        pipe.execute()
+
+    def get_stats(self):
+        pushed, applied, statements = (
+            int(x or 0) for x in self._redis.mget(
+                self._key('stats_pushed'),
+                self._key('stats_applied'),
+                self._key('stats_statements'),
+            )
+        )
+        return {
+            'pushed': pushed,
+            'applied': applied,
+            'coalesced': max(0, pushed - applied),
+            'statements': statements,
+        }
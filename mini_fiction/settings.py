@@ -58,6 +58,57 @@ class Config(object):
     # }
     RATE_LIMIT_PREFIX = 'mf_rate_limit_'
 
+    # Очередь изменений для поискового индекса: если указана, изменения
+    # рассказов и глав копятся в Redis и применяются пачкой задачей
+    # sphinx_flush_queue раз в SEARCH_QUEUE_INTERVAL секунд (нужен celery beat,
+    # задача добавляется в расписание, только если очередь указана);
+    # иначе на каждое изменение сразу ставится отдельная задача
+    SEARCH_QUEUE_BACKEND = None
+    # SEARCH_QUEUE_BACKEND = {
+    #     'host': 'localhost',
+    #     'port': 6379,
+    #     'db': 0,
+    # }
+    SEARCH_QUEUE_PREFIX = 'mf_search_queue_'
+    SEARCH_QUEUE_INTERVAL = 10
+
+    # Очередь просмотров глав и рассказов: если указана, просмотры
+    # копятся в Redis и записываются в базу (StoryView, Activity и счётчики
+    # просмотров) пачкой задачей flush_view_queue раз в VIEW_QUEUE_INTERVAL
+    # секунд (нужен celery beat, задача добавляется в расписание, только
+    # если очередь указана); иначе записываются прямо в запросе
+    VIEW_QUEUE_BACKEND = None
+    # VIEW_QUEUE_BACKEND = {
+    #     'host': 'localhost',
+    #     'port': 6379,
+    #     'db': 0,
+    # }
+    VIEW_QUEUE_PREFIX = 'mf_view_queue_'
+    VIEW_QUEUE_INTERVAL = 10
+
+    # Множество id опубликованных рассказов для блока случайных рассказов:
+    # если указан Redis, случайные id выбираются в нём через SRANDMEMBER,
+    # иначе все id хранятся в кэше одной упакованной строкой. Обновляется
+    # при публикации и удалении рассказов, а раз в PUBLISHED_STORY_IDS_CACHE_TIME
+    # секунд на всякий случай пересобирается из базы
+    PUBLISHED_STORY_IDS_BACKEND = None
+    # PUBLISHED_STORY_IDS_BACKEND = {
+    #     'host': 'localhost',
+    #     'port': 6379,
+    #     'db': 0,
+    # }
+    PUBLISHED_STORY_IDS_PREFIX = 'mf_published_story_ids_'
+    PUBLISHED_STORY_IDS_CACHE_TIME = 3600
+
+    # Топы рассказов (/story/top/ и /feed/stories/top) за эти периоды в днях
+    # (0 — за всё время) хранятся в кэше готовыми списками первых
+    # STORY_TOP_SIZE id и пересобираются раз в STORY_TOP_REFRESH_INTERVAL
+    # секунд, а также при изменении рейтинга попадающих в них рассказов;
+    # остальные периоды приводятся к ближайшему из этих
+    STORY_TOP_PERIODS = [7, 30, 365, 0]
+    STORY_TOP_SIZE = 1000
+    STORY_TOP_REFRESH_INTERVAL = 300
+
     RATE_LIMITS = {
         # max 10 comments per 6 hours
         'comment_newuser': (10, 3600 * 6),
@@ -78,6 +129,11 @@ class Config(object):
     CHAPTER_OLD_HTML_BACKEND_CACHE_TIME = 1800  # seconds
     CHAPTER_NEW_AGE = 3600 * 24 * 7  # seconds
     CHAPTER_HTML_FRONTEND_CACHE_TIME = 600  # seconds
+    COMMENT_HTML_CACHE_TIME = 3600 * 24 * 7  # seconds
+    USER_STORY_STATE_CACHE_TIME = 600  # seconds
+    # Sphinx search results (ids, weights and meta); reset on index updates except
+    # vote and comment counters, which may lag behind for this long
+    SEARCH_RESULTS_CACHE_TIME = 60  # seconds
 
     JSON_AS_ASCII = False
     MAX_CONTENT_LENGTH = 4 * 1024 * 1024
@@ -172,13 +228,26 @@ class Config(object):
     MEDIA_URL = '/media'
 
     FRONTEND_MANIFESTS_AUTO_RELOAD = False
+    # How often (in seconds) to check manifest files for changes; None means
+    # only at startup and on SIGHUP (if FRONTEND_MANIFESTS_RELOAD_ON_SIGHUP)
+    FRONTEND_MANIFESTS_CHECK_INTERVAL: Optional[float] = 60
+    FRONTEND_MANIFESTS_RELOAD_ON_SIGHUP = False
+    XSLT_AUTO_RELOAD = False
 
     LOCALTEMPLATES = None
 
     SPHINX_DISABLED = False
+    # 'sphinx' (Manticore via SphinxQL) or 'fts5' (SQLite FTS5 for development and small installs;
+    # no morphology, words are matched by prefix; initsphinx fills it as usual)
+    SEARCH_BACKEND = 'sphinx'
+    FTS5_SEARCH_CONFIG = {'path': os.path.join(os.getcwd(), 'search.sqlite3')}
     SPHINX_ROOT = os.path.join(os.getcwd(), 'sphinx')
     SPHINX_CONFIG = {
         'connection_params': {'unix_socket': '/tmp/sphinx_fanfics.socket', 'charset': 'utf8mb4'},
+        # ping_interval: ping only connections idle longer than this (0 = on every checkout);
+        # idle_timeout: close connections idle longer than this (None = never);
+        # checkout_timeout: max seconds to wait for a free connection (None = forever)
+        'pool': {'max_conns': 5, 'ping_interval': 0, 'idle_timeout': None, 'checkout_timeout': None},
         'excerpts_opts': {'chunk_separator': '…', 'limit': 2048, 'around': 20, 'html_strip_mode': 'strip'},
 
         'stories_rt_mem_limit': '128M',
@@ -188,6 +257,12 @@ class Config(object):
         'weights_chapters': {'text': 100, 'title': 50, 'notes': 25},
 
         'limit': 20,
+        'max_batch_bytes': 4 * 1024 * 1024,  # for initsphinx
+        # How chapter search snippets are built: 'full' sends whole chapter texts,
+        # 'window' sends only snippets_window chars around the first match,
+        # 'stored' uses text stored in the index (requires sphinxconf and reindex)
+        'snippets_mode': 'full',
+        'snippets_window': 16384,
         'select_options': {
             'ranker': 'sph04',
             'max_matches': 5000,
@@ -240,6 +315,7 @@ class Config(object):
     NEWS_COMMENTS_BY_GUEST = False
     COMMENT_SPOILER_THRESHOLD = -5
     COMMENTS_TREE_MAXDEPTH = 4
+    COMMENTS_TREE_CACHE_TIME = 3600 * 24  # seconds
 
     CHAPTER_MAX_LENGTH = 500000
 
@@ -271,6 +347,8 @@ class Config(object):
     EMAIL_DONT_EDIT_SUBJECT_ON_REDIRECT = False
     EMAIL_GENERATE_MESSAGE_ID = False
     EMAIL_MESSAGE_ID_DOMAIN: Optional[str] = None
+    # Notifications for subscribers are inserted with one executemany per this many rows
+    NOTIFICATION_BATCH_SIZE = 500
 
     ACCOUNT_ACTIVATION_DAYS = 5
     REGISTRATION_AUTO_LOGIN = True
@@ -348,6 +426,16 @@ class Config(object):
     )))
 
     STORY_DOWNLOAD_SLUGIFY_FILENAMES = False
+    # Render download files in Celery after chapters are published or edited
+    STORY_DOWNLOADS_PREBUILD = True
+    # How long a request waits for another process rendering the same missing file (seconds)
+    STORY_DOWNLOAD_RENDER_WAIT = 30
+    # Story JSONL dumps are streamed: rows are loaded in batches of this size
+    STORY_DUMP_BATCH_SIZE = 1000
+    # and sent to the client in chunks of about this many bytes
+    STORY_DUMP_CHUNK_SIZE = 64 * 1024
+    # gzip level for clients accepting gzip encoding (0 disables compression)
+    STORY_DUMP_GZIP_LEVEL = 6
 
     ACCEL_REDIRECT_HEADER = None  # set 'X-Accel-Redirect' if you use nginx
 
@@ -412,7 +500,7 @@ class Config(object):
             'daily_zip_dump': {
                 'task': 'zip_dump',
                 'schedule': crontab(hour=2, minute=0),
-            }
+            },
         }
     }
 
@@ -472,6 +560,7 @@ class Development(Config):
     CELERY_CONFIG = dict(Config.CELERY_CONFIG)
     CELERY_CONFIG['task_always_eager'] = True
     FRONTEND_MANIFESTS_AUTO_RELOAD = True
+    XSLT_AUTO_RELOAD = True
 
 
 class Test(Config):
@@ -488,6 +577,7 @@ class Test(Config):
     SQL_DEBUG = False
     CACHE_TYPE = 'null'
     SPHINX_DISABLED = True  # TODO: test it
+    STORY_DOWNLOADS_PREBUILD = False
     MINIMUM_VOTES_FOR_VIEW = 3
     PUBLISH_SIZE_LIMIT = 20
     CELERY_CONFIG = dict(Config.CELERY_CONFIG)
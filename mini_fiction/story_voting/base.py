@@ -53,6 +53,20 @@ class BaseVoting:
 
         raise NotImplementedError
 
+    def apply_vote_changes(self, story, changes):
+        '''Обновляет рейтинг рассказа после изменения отдельных оценок. Если
+        реализация хранит агрегаты в ``vote_extra``, она может обновить их
+        без пересчёта всех оценок; по умолчанию просто вызывает
+        ``update_rating``.
+
+        :param story: обновляемый рассказ (объект Story)
+        :param changes: список пар ``(старая оценка, новая оценка)``; None
+          вместо старой оценки означает новый голос, вместо новой — отзыв
+          голоса
+        '''
+
+        self.update_rating(story)
+
     def vote_view_html(self, story, user=None, full=False):
         '''Возвращает HTML-код для отображения средней оценки рассказа возле
         его заголовка.
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import json
-from statistics import mean, pstdev
+import math
+from fractions import Fraction
 
 from pony import orm
 from flask import current_app, render_template
@@ -28,6 +29,7 @@ class StarVoting(BaseVoting):
         extra = {
             'average': round(current_app.config['VOTING_MAX_VALUE'] / 2.0 + 0.1),
             'stddev': 0.0,
+            'histogram': [0] * current_app.config['VOTING_MAX_VALUE'],
         }
         return json.dumps(extra, ensure_ascii=False, sort_keys=True)
 
@@ -37,15 +39,57 @@ class StarVoting(BaseVoting):
     def update_rating(self, story):
         from mini_fiction.models import Vote
 
-        votes = orm.select(x.vote_value for x in Vote if x.story == story and x.revoked_at is None).without_distinct()
-        votes = [min(x, current_app.config['VOTING_MAX_VALUE']) for x in votes]
-        votes = [max(1, x) for x in votes]
-        m = mean(votes) if votes else 3.0
+        # Полный пересчёт: число оценок каждого значения считает база данных
+        histogram = [0] * current_app.config['VOTING_MAX_VALUE']
+        votes = orm.select(
+            (x.vote_value, orm.count()) for x in Vote if x.story == story and x.revoked_at is None
+        ).without_distinct()
+        for value, count in votes:
+            histogram[self._clamp(value) - 1] += count
+
+        self._set_rating(story, json.loads(story.vote_extra), histogram)
+
+    def apply_vote_changes(self, story, changes):
+        extra = json.loads(story.vote_extra)
+        histogram = extra.get('histogram')
+        if not isinstance(histogram, list) or len(histogram) != current_app.config['VOTING_MAX_VALUE']:
+            # Рассказ ещё без гистограммы (или поменялось число звёзд)
+            self.update_rating(story)
+            return
+
+        for old_value, new_value in changes:
+            if old_value is not None:
+                histogram[self._clamp(old_value) - 1] -= 1
+            if new_value is not None:
+                histogram[self._clamp(new_value) - 1] += 1
+
+        if min(histogram) < 0:
+            # Гистограмма разошлась с оценками; пусть их пересчитает база
+            self.update_rating(story)
+            return
+
+        self._set_rating(story, extra, histogram)
+
+    def _clamp(self, value):
+        return max(1, min(value, current_app.config['VOTING_MAX_VALUE']))
+
+    def _set_rating(self, story, extra, histogram):
+        # Всё считается по гистограмме оценок (число оценок каждого
+        # значения), поэтому не зависит от числа голосов
+        count = sum(histogram)
+        if count:
+            total = sum(c * v for v, c in enumerate(histogram, 1))
+            m = total / count
+            # Как statistics.pstdev: дисперсия считается точно, в дробях
+            variance = sum(c * (v - Fraction(total, count)) ** 2 for v, c in enumerate(histogram, 1) if c) / count
+            stddev = math.sqrt(variance)
+        else:
+            m = 3.0
+            stddev = 0.0
 
         # Это называют алгоритмом Томаса Байеса https://i.imgur.com/z0bRn9a.gif
         n = current_app.config['MINIMUM_VOTES_FOR_VIEW']
         votes_mid = current_app.config['VOTES_MID']
-        count = len(votes)
 
         v1 = count / (count + n) * m
         v2 = n / (count + n) * votes_mid
@@ -53,9 +97,9 @@ class StarVoting(BaseVoting):
 
         story.vote_total = count
 
-        extra = json.loads(story.vote_extra)
         extra['average'] = round(float(m), 6)
-        extra['stddev'] = round(pstdev(votes, m) if votes else 0.0, 6)
+        extra['stddev'] = round(stddev, 6)
+        extra['histogram'] = histogram
         story.vote_extra = json.dumps(extra, ensure_ascii=False, sort_keys=True)
 
     # templates
@@ -2,6 +2,7 @@ from functools import wraps
 
 import json
 import time
+from datetime import datetime
 from pathlib import Path
 
 from flask import current_app, url_for
@@ -12,6 +13,7 @@ from mini_fiction import models
 from mini_fiction.bl.migration import enrich_story
 from mini_fiction.models import Story, Chapter
 from mini_fiction.utils.misc import render_nonrequest_template, ping_sitemap
+from mini_fiction.view_queue import apply_view_queue_batch
 
 
 tasks = {}
@@ -87,6 +89,123 @@ def sphinx_update_comments_count(story_id):
     story.bl.search_update(('comments_count',))
 
 
+@task()
+@db_session
+def sphinx_flush_queue():
+    from mini_fiction.apis.amsphinxql import is_transient_error
+
+    queue = current_app.search_queue
+    batch = queue.pop()
+    if not batch:
+        return None
+
+    try:
+        applied, statements = _apply_search_queue_batch(batch)
+    except Exception as exc:
+        if is_transient_error(exc):
+            # Повторять задачу смысла нет: она и так периодическая, поэтому
+            # просто возвращаем изменения в очередь до следующего запуска
+            queue.requeue(batch)
+        else:
+            # Иначе пачка падала бы при каждом запуске, и новые изменения
+            # копились бы за ней бесконечно
+            current_app.logger.error(
+                'Search queue batch dropped: stories %s, chapters %s',
+                sorted(batch.stories), sorted(batch.chapters),
+            )
+        raise
+
+    queue.add_stats(batch.pushed, applied, statements)
+    current_app.logger.info(
+        'Search queue flushed: %d pushed, %d applied (%d coalesced), %d queries',
+        batch.pushed, applied, max(0, batch.pushed - applied), statements,
+    )
+    return {'pushed': batch.pushed, 'applied': applied, 'statements': statements}
+
+
+def _apply_search_queue_batch(batch):
+    story_updates = dict(batch.stories)
+    full_reindex_ids = {story_id for story_id, fields in story_updates.items() if fields is None}
+    statements = 0
+
+    # Главы рассказов, которые и так переиндексируются целиком, пропускаем
+    chapters = []
+    if batch.chapters:
+        chapter_ids = list(batch.chapters)
+        chapters = [
+            x for x in Chapter.select(lambda x: x.id in chapter_ids).prefetch(
+                Chapter.text,
+                Chapter.notes,
+                Chapter.story,
+                Story.contributors,
+                Story.characters,
+                Story.tags,
+            )
+            if x.story.id not in full_reindex_ids
+        ]
+    if chapters:
+        statements += Chapter.bl.add_chapters_to_search(
+            chapters,
+            update_story_words=False,
+            max_batch_bytes=current_app.config['SPHINX_CONFIG'].get('max_batch_bytes'),
+        )
+        # Число слов рассказа обновляется вместе с остальными его полями
+        for chapter in chapters:
+            if batch.chapters[chapter.id]:
+                story_id = chapter.story.id
+                if story_id not in story_updates:
+                    story_updates[story_id] = {'words'}
+                elif story_updates[story_id] is not None:
+                    story_updates[story_id] = story_updates[story_id] | {'words'}
+
+    stories = {}
+    if story_updates:
+        story_ids = list(story_updates)
+        for story in Story.select(lambda x: x.id in story_ids).prefetch(
+            Story.contributors,
+            Story.characters,
+            Story.tags,
+        ):
+            stories[story] = story_updates[story.id]
+    if stories:
+        statements += Story.bl.update_stories_in_search(stories)
+
+    return len(stories) + len(chapters), statements
+
+
+@task()
+@db_session
+def flush_view_queue():
+    queue = current_app.view_queue
+    batch = queue.pop()
+    if not batch:
+        return None
+
+    try:
+        applied = apply_view_queue_batch(batch)
+        orm.commit()
+    except Exception:
+        # Как и с очередью поиска, просто ждём следующего запуска
+        orm.rollback()
+        queue.requeue(batch)
+        raise
+
+    queue.add_stats(batch.pushed, applied)
+    current_app.logger.info(
+        'View queue flushed: %d pushed, %d applied (%d coalesced)',
+        batch.pushed, applied, max(0, batch.pushed - applied),
+    )
+    return {'pushed': batch.pushed, 'applied': applied}
+
+
+@task()
+@db_session
+def rebuild_story_top():
+    sizes = current_app.leaderboards.rebuild()
+    current_app.logger.info('Story top rebuilt: %s', ', '.join('{}: {}'.format(k, v) for k, v in sizes.items()))
+    return sizes
+
+
 @task_sphinx_retrying
 def sphinx_delete_story(story_id):
     Story.bl.delete_stories_from_search((story_id,))
@@ -120,23 +239,71 @@ def _sendmail_notify(to, typ, ctx):
 
 
 def _notify(to, typ, target, by=None, extra=None):
+    """Создаёт уведомления типа typ пользователю или списку пользователей
+    to об объекте target (или о каждом объекте из списка target).
+    Уведомления вставляются в базу напрямую, пачками по
+    NOTIFICATION_BATCH_SIZE строк, а кэш колокольчика сбрасывается одним
+    delete_many на пачку. Возвращает число созданных уведомлений.
+    """
+
     if not to:
-        return []
+        return 0
     if not isinstance(to, (list, set, tuple)):
         to = [to]
-
-    result = []
-    for x in to:
-        result.append(models.Notification(
-            user=x,
-            type=typ,
-            target_id=target.id,
-            caused_by_user=by,
-            extra=json.dumps(extra or {}, ensure_ascii=False, sort_keys=True),
+    targets = target if isinstance(target, (list, tuple)) else [target]
+
+    now = datetime.utcnow()
+    by_id = by.id if by else None
+    extra = json.dumps(extra or {}, ensure_ascii=False, sort_keys=True)
+    rows = [(x.id, now, typ, t.id, by_id, extra) for x in to for t in targets]
+    if not rows:
+        return 0
+
+    sql, adapter = _get_notification_insert_sql()
+    batch_size = current_app.config['NOTIFICATION_BATCH_SIZE']
+    orm.flush()
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        cursor = models.Notification._database_.get_connection().cursor()
+        cursor.executemany(sql, [adapter(x) for x in batch])
+
+        user_ids = {x[0] for x in batch}
+        current_app.cache.delete_many(*(
+            key.format(user_id) for user_id in user_ids for key in ('bell_{}', 'bell_content_{}')
         ))
-        current_app.cache.delete('bell_{}'.format(x.id))
-        current_app.cache.delete('bell_content_{}'.format(x.id))
-    return result
+
+    # Pony о вставленных строках не знает: если у кого-то из пользователей
+    # список уведомлений уже загружен в этой сессии, он больше не полный
+    for user in list(to) + ([by] if by else []):
+        for attr in (models.Notification.user.reverse, models.Notification.caused_by_user.reverse):
+            setdata = user._vals_.get(attr)
+            if setdata is not None:
+                setdata.is_fully_loaded = False
+                setdata.count = None
+
+    return len(rows)
+
+
+def _get_notification_insert_sql():
+    Notification = models.Notification
+    attrs = [
+        Notification.user, Notification.created_at, Notification.type,
+        Notification.target_id, Notification.caused_by_user, Notification.extra,
+    ]
+    converters = [attr.converters[0] for attr in attrs]
+    params = [['PARAM', (i, None, None), converter] for i, converter in enumerate(converters)]
+    columns = [attr.columns[0] for attr in attrs]
+    return Notification._database_._ast2sql(['INSERT', Notification._table_, columns, params])
+
+
+def _get_subscribers(typ, target_id):
+    """Подписки на события типа typ у объекта с указанным id вместе с
+    пользователями (одним запросом, а не по запросу на подписку).
+    """
+
+    return list(models.Subscription.select(
+        lambda x: x.type == typ and x.target_id == target_id
+    ).prefetch(models.Subscription.user))
 
 
 @task()
@@ -265,8 +432,11 @@ def notify_author_story(story_id, publisher_user_id=None):
     author_ids = [x.id for x in story.bl.get_authors()]
 
     # Получаем подписчиков, ждущих новые рассказы автора
-    subs = list(models.Subscription.select(lambda x: x.type == 'author_story' and x.target_id in author_ids))
+    subs = list(models.Subscription.select(
+        lambda x: x.type == 'author_story' and x.target_id in author_ids
+    ).prefetch(models.Subscription.user))
 
+    notify_users = {}  # Кому создать уведомления (подписок на разных соавторов может быть несколько)
     sendto = set()  # Список почт для отправки
 
     # Перебираем все подписки
@@ -282,12 +452,14 @@ def notify_author_story(story_id, publisher_user_id=None):
 
         # Если есть подписка на сайте, создаём уведомление
         if sub.to_tracker:
-            _notify(user, 'author_story', story)
+            notify_users[user.id] = user
 
         # Если есть подписка на почту, забираем адрес для последующей отправки
         if sub.to_email and user.email:
             sendto.add(user.email)
 
+    _notify(list(notify_users.values()), 'author_story', story)
+
     # Отправляем письмо по собранным адресам
     _sendmail_notify(sendto, 'author_story', {'story': story})
 
@@ -306,8 +478,9 @@ def notify_story_chapters(chapter_ids, publisher_user_id=None):
     chapters.sort(key=lambda x: x.order)
 
     # Получаем подписчиков, ждущих главы
-    subs = list(models.Subscription.select(lambda x: x.type == 'story_chapter' and x.target_id == story.id))
+    subs = _get_subscribers('story_chapter', story.id)
 
+    notify_users = []
     sendto = set()  # Список почт для отправки
 
     # Перебираем все подписки
@@ -322,13 +495,14 @@ def notify_story_chapters(chapter_ids, publisher_user_id=None):
 
         # Если есть подписка на сайте, создаём уведомление
         if sub.to_tracker:
-            for c in chapters:
-                _notify(user, 'story_chapter', c)
+            notify_users.append(user)
 
         # Если есть подписка на почту, забираем адрес для последующей отправки
         if sub.to_email and user.email:
             sendto.add(user.email)
 
+    _notify(notify_users, 'story_chapter', chapters)
+
     # Отправляем письмо по собранным адресам
     _sendmail_notify(sendto, 'story_chapter', {'story': story, 'chapters': chapters})
 
@@ -360,26 +534,30 @@ def notify_story_comment(comment_id):
                 reply_sent_email = True
 
     # Уведомляем остальных подписчиков о появлении нового комментария
-    subs = list(models.Subscription.select(lambda x: x.type == 'story_comment' and x.target_id == story.id))
+    subs = [
+        sub for sub in _get_subscribers('story_comment', story.id)
+        if not comment.author or sub.user.id != comment.author.id
+    ]
+
+    # Не забываем про проверку доступа
+    allowed_ids = {x.id for x in story.bl.filter_users_with_access(sub.user for sub in subs)}
 
+    notify_users = []
     sendto = set()
     for sub in subs:
         user = sub.user
-        if comment.author and user.id == comment.author.id:
-            continue
-
-        # Не забываем про проверку доступа
-        if not story.bl.has_access(user):
+        if user.id not in allowed_ids:
             continue
 
         if sub.to_tracker:
             if not parent or not parent.author or parent.author.id != user.id or not reply_sent_tracker:
-                _notify(user, 'story_comment', comment, by=comment.author)
+                notify_users.append(user)
 
         if sub.to_email and user.email:
             if not parent or not parent.author or parent.author.id != user.id or not reply_sent_email:
                 sendto.add(user.email)
 
+    _notify(notify_users, 'story_comment', comment, by=comment.author)
     _sendmail_notify(sendto, 'story_comment', ctx)
 
 
@@ -420,8 +598,10 @@ def notify_story_lcomment(comment_id):
                 reply_sent_email = True
 
     # Уведомляем остальных подписчиков о появлении нового комментария
-    subs = list(models.Subscription.select(lambda x: x.type == 'story_lcomment' and x.target_id == story.id))
+    subs = _get_subscribers('story_lcomment', story.id)
+    contributor_ids = {x.user.id for x in story.bl.get_contributors()}
 
+    notify_users = []
     sendto = set()
     for sub in subs:
         user = sub.user
@@ -429,17 +609,18 @@ def notify_story_lcomment(comment_id):
             continue
 
         # Не забываем про проверку доступа
-        if not user.is_staff and not story.bl.is_contributor(user):
+        if not user.is_staff and user.id not in contributor_ids:
             continue
 
         if sub.to_tracker:
             if not parent or not parent.author or parent.author.id != user.id or not reply_sent_tracker:
-                _notify(user, 'story_lcomment', comment, by=comment.author, extra=extra)
+                notify_users.append(user)
 
         if sub.to_email and user.email:
             if not parent or not parent.author or parent.author.id != user.id or not reply_sent_email:
                 sendto.add(user.email)
 
+    _notify(notify_users, 'story_lcomment', comment, by=comment.author, extra=extra)
     _sendmail_notify(sendto, 'story_lcomment', ctx)
 
 
@@ -468,8 +649,9 @@ def notify_news_comment(comment_id):
             reply_sent_email = True
 
     # Уведомляем остальных подписчиков о появлении нового комментария
-    subs = list(models.Subscription.select(lambda x: x.type == 'news_comment' and x.target_id == newsitem.id))
+    subs = _get_subscribers('news_comment', newsitem.id)
 
+    notify_users = []
     sendto = set()
     for sub in subs:
         user = sub.user
@@ -478,12 +660,13 @@ def notify_news_comment(comment_id):
 
         if sub.to_tracker:
             if not parent or not parent.author or parent.author.id != user.id or not reply_sent_tracker:
-                _notify(user, 'news_comment', comment, by=comment.author)
+                notify_users.append(user)
 
         if sub.to_email and user.email:
             if not parent or not parent.author or parent.author.id != user.id or not reply_sent_email:
                 sendto.add(user.email)
 
+    _notify(notify_users, 'news_comment', comment, by=comment.author)
     _sendmail_notify(sendto, 'news_comment', ctx)
 
 
@@ -516,6 +699,18 @@ def zip_dump():
     tmp_path.rename(path)
 
 
+@task()
+@db_session
+def build_story_downloads(story_id):
+    from mini_fiction.downloads.artifacts import build_story_artifacts
+
+    story = Story.get(id=story_id)
+    if not story or not story.published or not story.published_chapters_count:
+        return
+
+    build_story_artifacts(story)
+
+
 @task()
 def sitemap_ping_story(story_id):
     if not current_app.config.get('SITEMAP_PING_URLS'):
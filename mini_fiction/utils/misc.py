@@ -4,6 +4,7 @@ import json
 import hmac
 import math
 import time
+from contextlib import contextmanager
 from datetime import timedelta
 from html import escape
 from urllib.request import Request, urlopen
@@ -311,10 +312,7 @@ def diff2html(s, diff, show_newlines=False):
     return ''.join(result)
 
 
-def render_nonrequest_template(*args, **kwargs):
-    '''Обёртка над flask.request_template, просто добавляет некоторые нужные
-    переменные в ``flask.g``.
-    '''
+def _prepare_nonrequest_globals():
     if not hasattr(g, 'locale'):
         g.locale = Locale.parse(get_babel().default_locale)
     if not hasattr(g, 'timezone'):
@@ -325,14 +323,31 @@ def render_nonrequest_template(*args, **kwargs):
         from mini_fiction.models import ANON
         g.current_user = ANON
 
+
+@contextmanager
+def nonrequest_context():
+    '''Готовит всё нужное для рендеринга шаблонов вне запроса (в задачах
+    Celery и командах): переменные в ``flask.g`` и контекст запроса.
+    '''
     if has_request_context():
-        # Эта строка выполняется, когда есть контекст запроса
-        return render_template(*args, **kwargs)
+        # Эта ветка выполняется, когда есть контекст запроса
+        _prepare_nonrequest_globals()
+        yield
+        return
 
     # Похоже, Flask 3+ не позволяет временно убрать контекст запроса, поэтому,
     # когда настоящего запроса нет, создаём фейковый запрос для единообразия
-    # со строчкой выше и для более предсказуемого поведения url_for, например
+    # с веткой выше и для более предсказуемого поведения url_for, например
     with current_app.test_request_context("/"):
+        _prepare_nonrequest_globals()
+        yield
+
+
+def render_nonrequest_template(*args, **kwargs):
+    '''Обёртка над flask.request_template, просто добавляет некоторые нужные
+    переменные в ``flask.g``.
+    '''
+    with nonrequest_context():
         return render_template(*args, **kwargs)
 
 
@@ -547,6 +562,53 @@ def normalize_text_for_search_query(s: str, query_mode: str = "extended") -> str
     return SphinxConnection.escape_match(result)
 
 
+def trim_text_around_match(text: str, query: str, window: int) -> str:
+    '''Вырезает из HTML-текста кусок длиной около window символов вокруг
+    первого вхождения какого-нибудь слова из поискового запроса, чтобы
+    не отправлять Sphinx весь текст ради одного сниппета.
+
+    Морфологию Sphinx здесь не повторить, поэтому слова ищутся по началу
+    (без последних двух букв). Если ничего не нашлось, возвращается весь
+    текст, чтобы Sphinx сам нашёл совпадения.
+    '''
+
+    if len(text) <= window:
+        return text
+
+    min_word_len = current_app.config['SPHINX_INDEX_OPTIONS']['min_word_len']
+    prefixes = set()
+    for word in re.findall(r'\w+', query.lower()):
+        if len(word) >= min_word_len:
+            prefixes.add(word[:max(3, len(word) - 2)])
+    if not prefixes:
+        return text
+
+    # Без \b регулярка работает в несколько раз быстрее, а начало слова
+    # проверяется вручную только для найденных совпадений
+    pattern = re.compile(
+        '|'.join(re.escape(x) for x in sorted(prefixes, key=len, reverse=True)),
+        flags=re.IGNORECASE,
+    )
+    for match in pattern.finditer(text):
+        if match.start() == 0 or not (text[match.start() - 1].isalnum() or text[match.start() - 1] == '_'):
+            break
+    else:
+        return text
+
+    # Совпадение ближе к началу окна: сниппет обычно захватывает текст после него
+    start = max(0, match.start() - window // 4)
+    end = min(len(text), start + window)
+
+    # Не режем посреди HTML-тега
+    if text.rfind('<', 0, start) > text.rfind('>', 0, start):
+        tag_end = text.find('>', start)
+        start = tag_end + 1 if 0 <= tag_end < match.start() else start
+    if text.rfind('<', start, end) > text.rfind('>', start, end):
+        end = text.rfind('<', start, end)
+
+    return text[start:end]
+
+
 def htmlcrop(text, length, end='...', spaces=' \t\r\n\xa0', max_overflow=300, strip=True):
     '''Безопасная обрезалка текста, которая не разрежет посреди HTML-тега
     (но валидацию кода не проводит и корректный результат не обещает).
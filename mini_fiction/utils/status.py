@@ -89,6 +89,7 @@ class ProjectStatus(Status):
         'localstatic_root': 'Custom static files directory',
         'localtemplates': 'Custom templates directory',
         'sphinx': 'Sphinx search',
+        'sphinx_pool': 'Sphinx connection pool',
         'celery': 'Celery',
         'diff': 'fast-diff-match-patch',
         'linter': 'Chapter linter',
@@ -271,6 +272,16 @@ class ProjectStatus(Status):
 
         return self._ok('sphinx', 'working')
 
+    def sphinx_pool(self):
+        if self.app.config['SPHINX_DISABLED']:
+            return self._ok('sphinx_pool', 'disabled')
+
+        stats = self.app.sphinx.get_stats()
+        return self._ok('sphinx_pool', (
+            '{in_use}/{total} in use (max {max_conns}), {checkouts} checkouts, '
+            '{waits} waits ({wait_time:.3f}s), {reconnects} reconnects, {evicted} evicted'
+        ).format(**stats))
+
     def celery(self):
         insp = self.app.celery.control.inspect(timeout=1.5)
 
@@ -408,6 +419,7 @@ class ProjectStatus(Status):
         yield self.localstatic_root()
         yield self.localtemplates()
         yield self.sphinx()
+        yield self.sphinx_pool()
         yield self.celery()
         yield self.diff()
         yield self.linter()
@@ -64,17 +64,24 @@ def cached_lists(
         if chapter_view_dates:
             data['chapter_view_dates'] = {}
     else:
+        states = models.Story.bl.get_user_stories_state(current_user, story_ids)
         data.update({
-            'favorited_ids': list(orm.select(x.story.id for x in models.Favorites if x.author == current_user and x.story.id in story_ids)),
-            'bookmarked_ids': list(orm.select(x.story.id for x in models.Bookmark if x.author == current_user and x.story.id in story_ids)),
+            'favorited_ids': [x for x in story_ids if x in states and states[x].favorited],
+            'bookmarked_ids': [x for x in story_ids if x in states and states[x].bookmarked],
         })
         if unread_chapters_count:
-            data['unread_chapters_count'] = models.Story.bl.get_unread_chapters_count(current_user, story_ids)
+            data['unread_chapters_count'] = {
+                x: states[x].unread_chapters_count if x in states else 0 for x in story_ids
+            }
         if unread_comments_count:
-            data['unread_comments_count'] = models.Story.bl.get_unread_comments_count(current_user, story_ids)
+            data['unread_comments_count'] = {
+                x: states[x].unread_comments_count if x in states else 0 for x in story_ids
+            }
         if chapter_view_dates:
-            viewed_chapters = models.StoryView.select(lambda x: x.author == current_user and x.story.id in story_ids)
-            data['chapter_view_dates'] = {x.chapter.id: x.date for x in viewed_chapters if x.chapter}
+            data['chapter_view_dates'] = {}
+            for x in story_ids:
+                if x in states:
+                    data['chapter_view_dates'].update(states[x].chapter_view_dates)
     return data
 
 
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+import redis
+from flask import current_app, g
+from pony import orm
+
+
+@dataclass
+class ViewQueueBatch:
+    # {(user_id, chapter_id): (story_id, время первого просмотра)}
+    chapters: Dict[Tuple[int, int], Tuple[int, datetime]] = field(default_factory=dict)
+    # {(user_id, story_id): (время последнего просмотра, число просмотров
+    # рассказа и число комментариев на этот момент)}
+    stories: Dict[Tuple[int, int], Tuple[datetime, int, int]] = field(default_factory=dict)
+    # Сколько раз вызывались push_* для попавших в пачку просмотров
+    pushed: int = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.chapters or self.stories)
+
+
+class BaseViewQueue:
+    '''Очередь просмотров глав и рассказов авторизованными пользователями.
+    Вместо записи StoryView, Activity и счётчиков просмотров прямо в запросе
+    (это UPDATE одной и той же строки рассказа на каждый просмотр
+    популярной главы) просмотры копятся в очереди, повторные просмотры
+    схлопываются, а задача flush_view_queue периодически применяет их одной
+    транзакцией. Ещё не применённые просмотры можно прибавить к счётчикам
+    при отображении (см. get_pending_views).
+    '''
+
+    def __init__(self, app):
+        pass
+
+    def push_chapter_view(self, user_id: int, story_id: int, chapter_id: int, tm: datetime, new_story_view: bool = False) -> None:
+        '''Добавляет просмотр главы. Если пользователь уже смотрел эту
+        главу, при применении просмотр будет пропущен.
+
+        :param bool new_story_view: пользователь, судя по всему, ещё
+          не смотрел ни одной главы рассказа (влияет только на число
+          ожидающих просмотров рассказа)
+        '''
+        raise NotImplementedError
+
+    def push_story_view(self, user_id: int, story_id: int, tm: datetime, views: int, comments_count: int) -> None:
+        '''Добавляет просмотр страницы рассказа (обновление Activity).'''
+        raise NotImplementedError
+
+    def pop(self) -> Optional[ViewQueueBatch]:
+        '''Забирает из очереди все накопившиеся просмотры. Возвращает None,
+        если очередь не копит просмотры и применять нечего.
+        '''
+        raise NotImplementedError
+
+    def requeue(self, batch: ViewQueueBatch) -> None:
+        '''Возвращает в очередь просмотры, которые не удалось применить.'''
+        raise NotImplementedError
+
+    def get_pending(self, kind: str, ids: Iterable[int]) -> Dict[int, int]:
+        '''Возвращает число ещё не применённых новых просмотров рассказов
+        (kind='story') или глав (kind='chapter'); нули можно не возвращать.
+        '''
+        return {}
+
+    def add_stats(self, pushed: int, applied: int) -> None:
+        pass
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'pushed': 0, 'applied': 0, 'coalesced': 0}
+
+
+class NullViewQueue(BaseViewQueue):
+    # Ничего не копит, каждый просмотр сразу записывается в текущей транзакции
+
+    def push_chapter_view(self, user_id, story_id, chapter_id, tm, new_story_view=False):
+        apply_view_queue_batch(ViewQueueBatch(chapters={(user_id, chapter_id): (story_id, tm)}, pushed=1))
+
+    def push_story_view(self, user_id, story_id, tm, views, comments_count):
+        apply_view_queue_batch(ViewQueueBatch(stories={(user_id, story_id): (tm, views, comments_count)}, pushed=1))
+
+    def pop(self):
+        return None
+
+    def requeue(self, batch):
+        apply_view_queue_batch(batch)
+
+
+class RedisViewQueue(BaseViewQueue):
+    # Ключи: хэш chapters ("user_id:chapter_id" → "story_id:время", при
+    # повторных просмотрах остаётся первый), хэш stories ("user_id:story_id"
+    # → JSON, остаётся последний), хэши pending_stories и pending_chapters
+    # с числом новых просмотров для отображения и счётчик pushed
+
+    # Просмотр главы считается новым для отображения, только если его ещё
+    # нет в очереди; всё атомарно, чтобы pop не забрал половину
+    _push_chapter_script = '''
+        if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+            redis.call('HINCRBY', KEYS[2], ARGV[3], 1)
+            if ARGV[5] == '1' then
+                redis.call('HINCRBY', KEYS[3], ARGV[4], 1)
+            end
+        end
+        return redis.call('INCR', KEYS[4])
+    '''
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._redis = redis.Redis(**app.config['VIEW_QUEUE_BACKEND'])
+        self._prefix = app.config.get('VIEW_QUEUE_PREFIX') or ''
+        self._push_chapter = self._redis.register_script(self._push_chapter_script)
+
+    def _key(self, key):
+        return self._prefix + key
+
+    def push_chapter_view(self, user_id, story_id, chapter_id, tm, new_story_view=False):
+        self._push_chapter(
+            keys=[self._key('chapters'), self._key('pending_chapters'), self._key('pending_stories'), self._key('pushed')],
+            args=[
+                '{}:{}'.format(user_id, chapter_id),
+                '{}:{}'.format(story_id, _timestamp(tm)),
+                chapter_id,
+                story_id,
+                '1' if new_story_view else '0',
+            ],
+        )
+
+    def push_story_view(self, user_id, story_id, tm, views, comments_count):
+        pipe = self._redis.pipeline()
+        pipe.hset(self._key('stories'), '{}:{}'.format(user_id, story_id), json.dumps([_timestamp(tm), views, comments_count]))
+        pipe.incr(self._key('pushed'))
+        pipe.execute()
+
+    def pop(self):
+        pipe = self._redis.pipeline()
+        pipe.hgetall(self._key('chapters'))
+        pipe.hgetall(self._key('stories'))
+        pipe.getset(self._key('pushed'), 0)
+        pipe.delete(
+            self._key('chapters'), self._key('stories'),
+            self._key('pending_chapters'), self._key('pending_stories'),
+        )
+        chapters, stories, pushed, _ = pipe.execute()
+
+        batch = ViewQueueBatch(pushed=int(pushed or 0))
+        for key, value in chapters.items():
+            user_id, chapter_id = (int(x) for x in key.split(b':'))
+            story_id, tm = value.split(b':')
+            batch.chapters[(user_id, chapter_id)] = (int(story_id), datetime.utcfromtimestamp(float(tm)))
+        for key, value in stories.items():
+            user_id, story_id = (int(x) for x in key.split(b':'))
+            tm, views, comments_count = json.loads(value.decode('utf-8'))
+            batch.stories[(user_id, story_id)] = (datetime.utcfromtimestamp(tm), views, comments_count)
+        return batch
+
+    def requeue(self, batch):
+        pipe = self._redis.pipeline()
+        for (user_id, chapter_id), (story_id, tm) in batch.chapters.items():
+            pipe.hsetnx(self._key('chapters'), '{}:{}'.format(user_id, chapter_id), '{}:{}'.format(story_id, _timestamp(tm)))
+        for (user_id, story_id), (tm, views, comments_count) in batch.stories.items():
+            # Более свежий просмотр из очереди не перезаписываем
+            pipe.hsetnx(self._key('stories'), '{}:{}'.format(user_id, story_id), json.dumps([_timestamp(tm), views, comments_count]))
+        pipe.incrby(self._key('pushed'), batch.pushed)
+        pipe.execute()
+
+    def get_pending(self, kind, ids):
+        ids = list(ids)
+        if not ids:
+            return {}
+        values = self._redis.hmget(self._key('pending_chapters' if kind == 'chapter' else 'pending_stories'), ids)
+        return {x: int(v) for x, v in zip(ids, values) if v}
+
+    def add_stats(self, pushed, applied):
+        pipe = self._redis.pipeline()
+        pipe.incrby(self._key('stats_pushed'), pushed)
+        pipe.incrby(self._key('stats_applied'), applied)
+        pipe.execute()
+
+    def get_stats(self):
+        pushed, applied = (
+            int(x or 0) for x in self._redis.mget(self._key('stats_pushed'), self._key('stats_applied'))
+        )
+        return {'pushed': pushed, 'applied': applied, 'coalesced': max(0, pushed - applied)}
+
+
+def _timestamp(tm):
+    # Все даты в базе в UTC без tzinfo
+    return tm.replace(tzinfo=timezone.utc).timestamp()
+
+
+def get_pending_views(kind, ids):
+    '''Число ещё не применённых просмотров рассказов или глав из очереди
+    просмотров; запоминается до конца запроса.
+
+    :param str kind: 'story' или 'chapter'
+    :param ids: id рассказов или глав
+    :rtype: dict
+    '''
+
+    memo = g.setdefault('pending_views', {})
+    missing = [x for x in ids if (kind, x) not in memo]
+    if missing:
+        pending = current_app.view_queue.get_pending(kind, missing)
+        for x in missing:
+            memo[(kind, x)] = pending.get(x, 0)
+    return {x: memo[(kind, x)] for x in ids}
+
+
+def apply_view_queue_batch(batch):
+    '''Записывает в базу данных просмотры из пачки: создаёт недостающие
+    StoryView, прибавляет счётчики просмотров глав и рассказов и обновляет
+    Activity. Просмотры удалённых глав, рассказов и пользователей
+    пропускаются.
+
+    :param ViewQueueBatch batch: пачка просмотров
+    :return: число записанных в базу просмотров
+    '''
+
+    from mini_fiction.models import Activity, Author, Chapter, Story, StoryComment, StoryView
+
+    user_ids = list({x[0] for x in batch.chapters} | {x[0] for x in batch.stories})
+    chapter_ids = list({x[1] for x in batch.chapters})
+    story_ids = list({x[1] for x in batch.stories})
+    if not user_ids:
+        return 0
+
+    users = {x.id: x for x in Author.select(lambda x: x.id in user_ids)}
+    chapters = {x.id: x for x in Chapter.select(lambda x: x.id in chapter_ids).prefetch(Chapter.story)}
+    stories = {x.id: x for x in Story.select(lambda x: x.id in story_ids)}
+    stories.update((x.story.id, x.story) for x in chapters.values())
+    applied = 0
+
+    # 1) Просмотры глав
+    if batch.chapters:
+        all_story_ids = [x.story.id for x in chapters.values()]
+        viewed_chapters = set(orm.select(
+            (v.author.id, v.chapter.id) for v in StoryView
+            if v.author.id in user_ids and v.chapter.id in chapter_ids
+        ).without_distinct())
+        viewed_stories = set(orm.select(
+            (v.author.id, v.story.id) for v in StoryView
+            if v.author.id in user_ids and v.story.id in all_story_ids
+        ))
+
+        # Сначала ранние просмотры, чтобы просмотр рассказа засчитался по первой главе
+        for (user_id, chapter_id), (_, tm) in sorted(batch.chapters.items(), key=lambda x: x[1][1]):
+            user = users.get(user_id)
+            chapter = chapters.get(chapter_id)
+            if user is None or chapter is None or (user_id, chapter_id) in viewed_chapters:
+                continue
+            story = chapter.story
+            StoryView(story=story, chapter=chapter, author=user, date=tm)
+            viewed_chapters.add((user_id, chapter_id))
+            chapter.views += 1
+            if (user_id, story.id) not in viewed_stories:
+                viewed_stories.add((user_id, story.id))
+                story.views += 1
+            applied += 1
+
+    # 2) Просмотры рассказов
+    if batch.stories:
+        # Последний комментарий на момент просмотра: комментарии, написанные
+        # раньше всех просмотров из пачки, и комментарии после них отдельно
+        min_tm = min(x[0] for x in batch.stories.values())
+        last_comment_ids = dict(orm.select(
+            (c.story.id, orm.max(c.id)) for c in StoryComment
+            if c.story.id in story_ids and c.date <= min_tm
+        ))
+        recent_comments = list(orm.select(
+            (c.story.id, c.id, c.date) for c in StoryComment
+            if c.story.id in story_ids and c.date > min_tm
+        ).without_distinct())
+
+        acts = {}
+        for act in Activity.select(lambda x: x.author.id in user_ids and x.story.id in story_ids).order_by(Activity.id):
+            key = (act.author.id, act.story.id)
+            if key in acts:
+                # Если по каким-то причинам сайт лаганул и насоздавал активитей, то удаляем лишнее
+                act.delete()
+            else:
+                acts[key] = act
+
+        for (user_id, story_id), (tm, views, comments_count) in batch.stories.items():
+            user = users.get(user_id)
+            story = stories.get(story_id)
+            if user is None or story is None:
+                continue
+
+            last_comment_id = last_comment_ids.get(story_id) or 0
+            for comment_story_id, comment_id, comment_date in recent_comments:
+                if comment_story_id == story_id and comment_date <= tm:
+                    last_comment_id = max(last_comment_id, comment_id)
+
+            data = {
+                'last_views': views,
+                'last_comments': comments_count,
+                'last_comment_id': last_comment_id,
+            }
+            act = acts.get((user_id, story_id))
+            if act is None:
+                acts[(user_id, story_id)] = Activity(story=story, author=user, date=tm, **data)
+            else:
+                for k, v in data.items():
+                    setattr(act, k, v)
+            applied += 1
+
+    orm.flush()
+    return applied
@@ -3,7 +3,7 @@
 
 from datetime import datetime, timedelta
 
-from flask import Blueprint, render_template, url_for, current_app
+from flask import Blueprint, render_template, url_for, current_app, jsonify
 from flask_babel import gettext
 from pony.orm import db_session, desc
 
@@ -46,3 +46,16 @@ def index():
     ctx['registrationprofile_last'] = models.RegistrationProfile.select().sort_by(desc(models.RegistrationProfile.id)).first()
 
     return render_template('admin/index.html', **ctx)
+
+
+@bp.route('/metrics.json')
+@admin_required
+def metrics():
+    data = {
+        'search_queue': current_app.search_queue.get_stats(),
+        'view_queue': current_app.view_queue.get_stats(),
+        'sphinx_pool': None,
+    }
+    if not current_app.config['SPHINX_DISABLED']:
+        data['sphinx_pool'] = current_app.sphinx.get_stats()
+    return jsonify(data)
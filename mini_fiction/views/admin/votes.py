@@ -7,7 +7,7 @@ from flask import Blueprint, current_app, render_template, abort, request, redir
 from flask_login import current_user
 from pony.orm import db_session, select, desc
 
-from mini_fiction.models import Author, Vote
+from mini_fiction.models import Author, Story, Vote
 from mini_fiction.utils.misc import Paginator
 
 bp = Blueprint('admin_votes', __name__)
@@ -83,17 +83,19 @@ def manyupdate():
 
     act = request.form.get('act')
 
-    update_stories_rating = set()
+    update_stories_rating = {}
     for vote in all_votes:
         if act == 'revoke' and not vote.revoked_at:
             vote.revoked_at = datetime.utcnow()
-            update_stories_rating.add(vote.story)
+            update_stories_rating.setdefault(vote.story, []).append((vote.vote_value, None))
         if act == 'restore' and vote.revoked_at:
             vote.revoked_at = None
-            update_stories_rating.add(vote.story)
+            update_stories_rating.setdefault(vote.story, []).append((None, vote.vote_value))
         vote.flush()
 
-    for story in update_stories_rating:
-        story.bl.update_rating()
+    for story, changes in update_stories_rating.items():
+        # Блокируем рассказ, чтобы не потерять одновременные голоса
+        story = Story.get_for_update(id=story.id)
+        story.bl.update_rating(changes)
 
     return redirect(return_path)
@@ -101,6 +101,7 @@ def info(user_id=None, comments_page=1):
     comments = paged.slice(comments_list)
     if not comments and comments_page != 1:
         abort(404)
+    StoryComment.bl.prefetch_html(comments)
 
     enrich_stories(stories + (contributing_stories or []))
 
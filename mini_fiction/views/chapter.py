@@ -59,6 +59,7 @@ def view(story_id, chapter_order=None):
             .order_by(Chapter.order, Chapter.id)
         )
         page_title = story.title + ' – все главы'
+        Chapter.bl.prefetch_html(chapters)
         if current_user.is_authenticated:
             for c in chapters:
                 c.bl.viewed(current_user)
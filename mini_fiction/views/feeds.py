@@ -73,6 +73,7 @@ def feed_stories_top():
         period = int(period)
     except ValueError:
         period = 0
+    ids, period = Story.bl.get_top(period)
 
     if period == 7:
         title = gettext('Top stories for the week')
@@ -92,7 +93,7 @@ def feed_stories_top():
     feed.link(href=request.url, rel='self')
 
     count = current_app.config['RSS'].get('stories', 20)
-    stories = Story.bl.select_top(period)[:count]
+    stories = Story.bl.get_published_by_ids(ids[:count])
     last_update = _add_stories_to_feed(feed, stories)
 
     feed.updated(pytz.UTC.fromutc(last_update))
@@ -130,17 +130,21 @@ def top(page):
     else:
         period = 0
 
-    objects = Story.bl.select_top(period)
-    objects = objects.prefetch(Story.characters, Story.contributors, StoryContributor.user, Story.tags, StoryTag.tag, Tag.category)
+    # Топ берётся из заранее собранного списка id (см. leaderboards),
+    # поэтому произвольный период заменяется ближайшим стандартным
+    ids, period = Story.bl.get_top(period)
 
     page_obj = Paginator(
         page,
-        objects.count(),
+        len(ids),
         per_page=current_app.config['STORIES_COUNT']['lists'],
         view_args={'period': period} if period > 0 else None,
     )
 
-    stories = page_obj.slice_or_404(objects)
+    stories = Story.bl.get_published_by_ids(
+        page_obj.slice_or_404(ids),
+        prefetch=(Story.characters, Story.contributors, StoryContributor.user, Story.tags, StoryTag.tag, Tag.category),
+    )
     enrich_stories(stories)
 
     if period == 7:
@@ -157,7 +161,7 @@ def top(page):
     data = dict(
         stories=stories,
         page_obj=page_obj,
-        count=objects.count(),
+        count=len(ids),
         page_title=page_title,
         period=period,
     )
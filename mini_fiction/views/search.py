@@ -35,8 +35,14 @@ def search_form(*, form: Optional[SearchForm] = None):
     return render_template('search.html', **data)
 
 
+def search_unavailable(data, postform):
+    # Все соединения со Sphinx заняты, и дождаться свободного не удалось
+    data.update({'form': postform, 'page_title': gettext('Search of stories'), 'error': 'Поиск временно недоступен, попробуйте позже', 'error_type': 'unavailable'})
+    return render_template('search.html', **data), 503
+
+
 def search_action(postform):
-    from mini_fiction.apis.amsphinxql import SphinxError
+    from mini_fiction.apis.amsphinxql import SphinxError, SphinxPoolTimeout
 
     if not postform.validate():
         return search_form(form=postform)
@@ -83,6 +89,8 @@ def search_action(postform):
                 max_words=postform.data['max_words'],
                 min_vote_total=current_app.config['MINIMUM_VOTES_FOR_VIEW'] if int(sort_type) == 3 else None,
             )
+        except SphinxPoolTimeout:
+            return search_unavailable(data, postform)
         except SphinxError as exc:
             data.update({'form': postform, 'page_title': gettext('Search of stories'), 'error': 'Кажется, есть синтаксическая ошибка в запросе', 'error_type': 'syntax'})
             if current_app.config['DEBUG'] or current_user.is_superuser:
@@ -113,6 +121,8 @@ def search_action(postform):
                 max_words=postform.data['max_words'],
                 min_vote_total=current_app.config['MINIMUM_VOTES_FOR_VIEW'] if int(sort_type) == 3 else None,
             )
+        except SphinxPoolTimeout:
+            return search_unavailable(data, postform)
         except SphinxError as exc:
             data.update({'form': postform, 'page_title': gettext('Search of stories'), 'error': 'Кажется, есть синтаксическая ошибка в запросе', 'error_type': 'syntax'})
             if current_app.config['DEBUG'] or current_user.is_superuser:
@@ -71,9 +71,11 @@ def chapters_updates(params):
 
     # Число непрочитанных глав у текущего пользователя
     if current_user.is_authenticated:
-        unread_chapters_count = Story.bl.get_unread_chapters_count(
-            current_user, [x['story']['id'] for x in chapters]
-        )
+        states = Story.bl.get_user_stories_state(current_user, [x['story']['id'] for x in chapters])
+        unread_chapters_count = {
+            x['story']['id']: states[x['story']['id']].unread_chapters_count if x['story']['id'] in states else 0
+            for x in chapters
+        }
     else:
         unread_chapters_count = {x['story']['id']: 0 for x in chapters}
 
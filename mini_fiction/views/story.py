@@ -1,11 +1,11 @@
-from io import StringIO
+import zlib
 from datetime import datetime
 from pathlib import Path
 
-from flask import Blueprint, Response, current_app, request, render_template, abort, redirect, url_for, send_file, jsonify, g
+from flask import Blueprint, Response, current_app, request, render_template, abort, redirect, url_for, send_file, jsonify, g, stream_with_context
 from flask_babel import gettext
 from flask_login import current_user, login_required
-from pony.orm import db_session, desc
+from pony.orm import db_session, desc, commit
 
 from mini_fiction.bl.migration import enrich_story
 from mini_fiction.forms.story import StoryForm
@@ -93,6 +93,7 @@ def view(pk, comments_page):
         'local_comments_count': local_comments_count,
         'new_local_comments_count': new_local_comments_count,
         'chapters': chapters,
+        'chapters_views': story.bl.get_chapters_views_count(chapters),
         'show_first_chapter': show_first_chapter,
         'page_title': story.title,
         'comment_form': CommentForm(),
@@ -250,6 +251,11 @@ def favorite(pk, action):
     elif action == 'add':
         story = get_story(pk)  # проверка доступа
         f = Favorites(author=current_user, story=story)
+
+    def update_state(state):
+        state.favorited = f is not None
+
+    Story.bl.invalidate_cached_user_state(current_user, pk, update_state)
     if g.is_ajax:
         return jsonify({
             'success': True,
@@ -274,6 +280,11 @@ def bookmark(pk, action):
     elif action == 'add':
         story = get_story(pk)  # проверка доступа
         b = Bookmark(author=current_user, story=story)
+
+    def update_state(state):
+        state.bookmarked = b is not None
+
+    Story.bl.invalidate_cached_user_state(current_user, pk, update_state)
     if g.is_ajax:
         return jsonify({
             'success': True,
@@ -618,6 +629,7 @@ def download(story_id, filename):
     filename, extension = full_filename.split('.', 1)
 
     from ..downloads import get_format
+    from ..downloads.artifacts import get_artifact
 
     debug = current_app.config['DEBUG'] and request.args.get('debug')
 
@@ -630,25 +642,14 @@ def download(story_id, filename):
 
     if full_filename != fmt.filename(story):
         return redirect(fmt.url(story))
-    filepath = 'stories/%s/%s.%s' % (story_id, filename, extension)
 
-    storage_path: Path = current_app.config['MEDIA_ROOT'] / filepath
-
-    if (
-        not storage_path.exists() or
-        datetime.utcfromtimestamp(storage_path.stat().st_mtime) < story.updated or
-        debug
-    ):
+    if debug:
         data = fmt.render(
             story=story,
             debug=debug,
         )
-
-        if not debug:
-            if storage_path.exists():
-                storage_path.unlink()
-            storage_path.parent.mkdir(parents=True, exist_ok=True)
-            storage_path.write_bytes(data)
+    else:
+        storage_path: Path = get_artifact(story, fmt)
 
     # TODO: delete file if story was deleted
     if not debug:
@@ -669,44 +670,74 @@ def download(story_id, filename):
     return response
 
 
-@bp.route('/<int:story_id>_dump.jsonl', methods=('GET',))
-@db_session
-def download_json(story_id):
+def stream_story_dump(story_id, dump_method, **kwargs):
+    '''Отдаёт выгрузку рассказа в JSONL по частям, не собирая её в памяти.
+    Кэш db_session по ходу выгрузки сбрасывается, поэтому права доступа
+    должны быть проверены до вызова, а изменения, сделанные запросом до
+    начала выгрузки, сохраняются заранее.
+    '''
+
     from mini_fiction.ponydump import JSONEncoder
 
-    story = get_story(story_id)
+    chunk_size = current_app.config['STORY_DUMP_CHUNK_SIZE']
+    gzip_level = current_app.config['STORY_DUMP_GZIP_LEVEL']
+    use_gzip = bool(gzip_level) and 'gzip' in request.accept_encodings
+
+    def generate():
+        je = JSONEncoder(ensure_ascii=False, sort_keys=True)
+        compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if use_gzip else None
+        lines = []
+        size = 0
+
+        with db_session:
+            commit()
+            story = Story[story_id]
+            for x in getattr(story.bl, dump_method)(release_cache=True, **kwargs):
+                line = (je.encode(x) + '\n').encode('utf-8')
+                lines.append(line)
+                size += len(line)
+                if size < chunk_size:
+                    continue
+                data = b''.join(lines)
+                lines = []
+                size = 0
+                if compressor is not None:
+                    data = compressor.compress(data)
+                if data:
+                    yield data
+
+        data = b''.join(lines)
+        if compressor is not None:
+            data = compressor.compress(data) + compressor.flush()
+        if data:
+            yield data
+
+    response = Response(stream_with_context(generate()), mimetype='application/json-l')
+    response.headers['X-Robots-Tag'] = 'noindex'
+    response.vary.add('Accept-Encoding')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
-    je = JSONEncoder(ensure_ascii=False, sort_keys=True)
-    result = StringIO()
 
-    for x in story.bl.dump_only_public(
+@bp.route('/<int:story_id>_dump.jsonl', methods=('GET',))
+@db_session
+def download_json(story_id):
+    get_story(story_id)
+    return stream_story_dump(
+        story_id,
+        'dump_only_public',
         with_chapters=True,
         with_favorites=False,
-        with_comments=False
-    ):
-        result.write(je.encode(x) + '\n')
-
-    response = Response(result.getvalue(), mimetype='application/json-l')
-    response.headers['X-Robots-Tag'] = 'noindex'
-    return response
+        with_comments=False,
+    )
 
 
 @bp.route('/<int:story_id>_full_dump.jsonl', methods=('GET',))
 @db_session
 def download_json_full(story_id):
-    from mini_fiction.ponydump import JSONEncoder
-
     if not current_user.is_superuser:
         abort(403)
 
-    story = get_story(story_id)
-
-    je = JSONEncoder(ensure_ascii=False, sort_keys=True)
-    result = StringIO()
-
-    for x in story.bl.dump_full():
-        result.write(je.encode(x) + '\n')
-
-    response = Response(result.getvalue(), mimetype='application/json-l')
-    response.headers['X-Robots-Tag'] = 'noindex'
-    return response
+    get_story(story_id)
+    return stream_story_dump(story_id, 'dump_full')
@@ -100,6 +100,7 @@ def comments(page):
         view_args=view_args,
     )
     objects = [('story', x) for x in page_obj.slice_or_404(objects)]
+    StoryComment.bl.prefetch_html([x[1] for x in objects])
 
     comment_votes_cache = Story.bl.select_comment_votes(
         current_user,
@@ -145,6 +146,7 @@ def storylocalcomments(page):
         view_args=view_args,
     )
     objects = [('local', x) for x in page_obj.slice_or_404(objects)]
+    StoryLocalComment.bl.prefetch_html([x[1] for x in objects])
 
     comment_votes_cache = {}  # FIXME: здесь пересечение айдишников с айдшниками комментов к рассказам
 
@@ -183,6 +185,7 @@ def newscomments(page):
         view_args=view_args,
     )
     objects = [('news', x) for x in page_obj.slice_or_404(objects)]
+    NewsComment.bl.prefetch_html([x[1] for x in objects])
 
     comment_votes_cache = {}  # FIXME: здесь пересечение айдишников с айдшниками комментов к рассказам
 
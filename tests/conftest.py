@@ -6,6 +6,7 @@ import time
 import shutil
 
 import pytest
+from cachelib.simple import SimpleCache
 from pony.orm import db_session
 
 from mini_fiction import database, fixtures
@@ -63,6 +64,13 @@ def factories():
     return factories_module
 
 
+@pytest.fixture
+def simple_cache(app, monkeypatch):
+    cache = SimpleCache()
+    monkeypatch.setattr(app, 'cache', cache)
+    return cache
+
+
 @pytest.fixture
 def testdir():
     return flask_app.config['TESTING_DIRECTORY']
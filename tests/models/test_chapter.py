@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+from mini_fiction import models
+from mini_fiction.bl.stories import create_chapters_html_render_pool
+
+
+def test_chapters_html_prefetch(factories, simple_cache):
+    story = factories.StoryFactory()
+    chapters = [factories.ChapterFactory(story=story, text='Глава {}'.format(i), notes='') for i in range(3)]
+    c0 = chapters[0]
+    simple_cache.set('chapter_text_html_{}'.format(c0.id), (c0.updated, c0.text_md5, 'from cache'))
+
+    models.Chapter.bl.prefetch_html(chapters)
+    assert [str(c.text_as_html) for c in chapters] == ['from cache', '<p>Глава 1</p>', '<p>Глава 2</p>']
+    assert [str(c.notes_as_html) for c in chapters] == ['', '', '']
+
+    c2 = chapters[2]
+    assert simple_cache.get('chapter_text_html_{}'.format(c2.id)) == (c2.updated, c2.text_md5, '<p>Глава 2</p>')
+    assert simple_cache.get('chapter_notes_html_{}'.format(c2.id)) == (c2.updated, '')
+
+
+def test_chapters_html_prefetch_in_processes(factories, simple_cache):
+    story = factories.StoryFactory()
+    chapters = [factories.ChapterFactory(story=story, text='Глава {}'.format(i), notes='*') for i in range(3)]
+
+    executor = create_chapters_html_render_pool(2)
+    try:
+        models.Chapter.bl.prefetch_html(chapters, executor=executor)
+    finally:
+        executor.shutdown()
+    assert [str(c.text_as_html) for c in chapters] == ['<p>Глава 0</p>', '<p>Глава 1</p>', '<p>Глава 2</p>']
+    assert [str(c.notes_as_html) for c in chapters] == ['<p>*</p>'] * 3
+
+
+class FakeSnippetsConnection:
+    def __init__(self):
+        self.snippets_calls = []
+        self.highlights_calls = []
+
+    def call_snippets(self, index, texts, query, **options):
+        self.snippets_calls.append((index, list(texts), query))
+        return ['snippet: ' + x[:10] for x in texts]
+
+    def select_highlights(self, index, ids, query, field='text', **options):
+        self.highlights_calls.append((index, list(ids), query, field))
+        return {i: 'highlight {}'.format(i) for i in ids[1:]}
+
+
+def test_chapter_search_excerpts_batched(app, factories, monkeypatch):
+    story = factories.StoryFactory()
+    texts = ['начало ' + 'слово ' * 1000 + 'единорог ' + 'слово ' * 1000, 'про единорогов', 'без совпадений']
+    chapters = [factories.ChapterFactory(story=story, text=text) for text in texts]
+    conn = FakeSnippetsConnection()
+
+    # Один запрос на все найденные главы
+    monkeypatch.setitem(app.config['SPHINX_CONFIG'], 'snippets_mode', 'full')
+    excerpts = models.Chapter.bl._get_search_excerpts(conn, chapters, 'единороги')  # pylint: disable=protected-access
+    assert len(conn.snippets_calls) == 1
+    assert conn.snippets_calls[0][1] == texts
+    assert excerpts == ['snippet: ' + x[:10] for x in texts]
+
+    # В режиме window длинный текст обрезается вокруг совпадения
+    monkeypatch.setitem(app.config['SPHINX_CONFIG'], 'snippets_mode', 'window')
+    monkeypatch.setitem(app.config['SPHINX_CONFIG'], 'snippets_window', 400)
+    models.Chapter.bl._get_search_excerpts(conn, chapters, 'единороги')  # pylint: disable=protected-access
+    sent_texts = conn.snippets_calls[1][1]
+    assert len(sent_texts[0]) <= 400
+    assert 'единорог' in sent_texts[0]
+    assert sent_texts[1:] == texts[1:]
+
+    # В режиме stored тексты не отправляются вовсе
+    monkeypatch.setitem(app.config['SPHINX_CONFIG'], 'snippets_mode', 'stored')
+    excerpts = models.Chapter.bl._get_search_excerpts(conn, chapters, 'единороги')  # pylint: disable=protected-access
+    assert conn.highlights_calls == [('chapters', [x.id for x in chapters], 'единороги', 'text')]
+    assert excerpts == ['', 'highlight {}'.format(chapters[1].id), 'highlight {}'.format(chapters[2].id)]
+    assert len(conn.snippets_calls) == 2
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+from mini_fiction import models
+
+
+def _create_comment(factories, text):
+    author = factories.AuthorFactory()
+    story = factories.StoryFactory(authors=[author])
+    c = models.StoryComment(
+        local_id=1, author=author, author_username=author.username,
+        story=story, text=text, root_id=0,
+        story_published=story.published, tree_depth=0,
+    )
+    c.flush()
+    c.root_id = c.id
+    return c
+
+
+def test_comment_html_is_cached(factories, simple_cache):
+    c = _create_comment(factories, 'Прекрасный <strong>рассказ</strong>!')
+    html = '<p>Прекрасный <strong>рассказ</strong>!</p>'
+    assert str(c.text_as_html) == html
+    assert simple_cache.get('storycomment_html_{}'.format(c.id)) == (0, html, html)
+
+    # Рендеринг не повторяется, пока не изменится edits_count
+    simple_cache.set('storycomment_html_{}'.format(c.id), (0, 'from cache', 'brief from cache'))
+    c2 = models.StoryComment.get(id=c.id)
+    del c2._html_cache  # pylint: disable=protected-access
+    assert str(c2.text_as_html) == 'from cache'
+    assert str(c2.brief_text_as_html) == 'brief from cache'
+
+    c2.text = 'Новый текст'
+    c2.edits_count += 1
+    assert str(c2.text_as_html) == '<p>Новый текст</p>'
+
+
+def test_comment_html_prefetch(factories, simple_cache):
+    comments = [_create_comment(factories, 'Комментарий {}'.format(i)) for i in range(3)]
+    simple_cache.set('storycomment_html_{}'.format(comments[0].id), (0, 'from cache', 'brief from cache'))
+
+    models.StoryComment.bl.prefetch_html(comments)
+    assert [str(c.text_as_html) for c in comments] == ['from cache', '<p>Комментарий 1</p>', '<p>Комментарий 2</p>']
+    for c in comments[1:]:
+        assert simple_cache.get('storycomment_html_{}'.format(c.id))[1] == str(c.text_as_html)
+
+
+def test_comments_tree_index_incremental(factories, simple_cache):
+    author = factories.AuthorFactory(is_staff=True)
+    story = factories.StoryFactory(authors=[author])
+
+    c1 = story.bl.create_comment(author, '127.0.0.1', {'text': 'Первый'})
+    c2 = story.bl.create_comment(author, '127.0.0.1', {'text': 'Ответ', 'parent': c1.local_id})
+    c3 = story.bl.create_comment(author, '127.0.0.1', {'text': 'Второй'})
+    tree_index = story.bl.get_comments_tree_index()
+    assert tree_index == {'count': 3, 'root_ids': [c1.id, c3.id]}
+
+    # Закэшированная структура обновляется при создании комментов
+    c4 = story.bl.create_comment(author, '127.0.0.1', {'text': 'Ответ 2', 'parent': c3.local_id})
+    key = story.bl.get_comments_tree_cache_key()
+    assert simple_cache.get(key) == story.bl.build_comments_tree_index()
+
+    assert c2.bl.get_page_number(per_page=1) == 1
+    assert c4.bl.get_page_number(per_page=1) == 2
+
+    comments_count, paged, comments_tree_list = story.bl.paginate_comments(2, per_page=1)
+    assert comments_count == 4
+    assert paged.num_pages == 2
+    assert [x[0].id for x in comments_tree_list] == [c3.id, c4.id]
+
+
+def test_comments_tree_index_rebuilds_on_count_mismatch(factories, simple_cache):
+    author = factories.AuthorFactory(is_staff=True)
+    story = factories.StoryFactory(authors=[author])
+    c1 = story.bl.create_comment(author, '127.0.0.1', {'text': 'Первый'})
+
+    key = story.bl.get_comments_tree_cache_key()
+    simple_cache.set(key, {'count': 5, 'root_ids': []})
+    assert story.bl.get_comments_tree_index()['root_ids'] == [c1.id]
+
+
+def test_news_comment_html_keeps_original_rendering(factories, simple_cache):
+    from mini_fiction.filters import filter_html, filtered_html_property
+
+    author = factories.AuthorFactory()
+    newsitem = models.NewsItem(name='news', author=author, title='Новость', content='')
+    c = models.NewsComment(
+        local_id=1, author=author, author_username=author.username,
+        newsitem=newsitem, text='Текст <b>новости</b>', root_id=0, tree_depth=0,
+    )
+    c.flush()
+
+    # Комментарии к новостям (и в редакторской) рендерятся как раньше,
+    # без очистки текста, которую делает text2html
+    assert c.text_as_html == filtered_html_property('text', filter_html).fget(c)
+    assert simple_cache.get('newscomment_html_{}'.format(c.id))[1] == '<p>Текст новости</p>'
+
+    c.text = 'Текст\x01'
+    c.edits_count += 1
+    assert c.text_as_html == filtered_html_property('text', filter_html).fget(c) == '#ERROR#'
+    assert c.bl.text2html(c.text) == '<p>Текст</p>'
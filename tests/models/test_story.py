@@ -192,3 +192,219 @@ def test_story_deletion_full(app, factories):
                 models.Author.select(lambda x: x.id >= 0).delete()
         except Exception as exc:
             print('Cannot clean authors: {}'.format(exc))
+
+
+def test_random_stories_from_published_ids(app, factories, simple_cache, monkeypatch):
+    from mini_fiction import published_ids
+
+    published = [factories.StoryFactory() for _ in range(5)]
+    draft = factories.DraftStoryFactory()
+    orm.flush()
+
+    ids = app.published_story_ids
+    assert sorted(ids.sample(10)) == sorted(x.id for x in published)
+    sample = ids.sample(3)
+    assert len(sample) == len(set(sample)) == 3
+    assert set(sample) <= {x.id for x in published}
+
+    stories = models.Story.bl.get_random(count=2)
+    assert len(stories) == 2
+    assert {x.id for x in stories} <= {x.id for x in published}
+
+    # Публикация и снятие с публикации изменяют закэшированные id на месте
+    load_calls = []
+    load = published_ids.load_published_story_ids
+    monkeypatch.setattr(published_ids, 'load_published_story_ids', lambda: load_calls.append(1) or load())
+
+    ids.set_published(draft.id, True)
+    assert draft.id in ids.sample(10)
+    ids.set_published(published[0].id, False)
+    assert sorted(ids.sample(10)) == sorted([x.id for x in published[1:]] + [draft.id])
+    assert not load_calls
+
+    # Если изменение вклинилось между двумя другими, id пересобираются из базы
+    app.cache.inc(ids.generation_key)
+    ids.set_published(published[0].id, True)
+    assert sorted(ids.sample(10)) == sorted(x.id for x in published)
+    assert load_calls == [1]
+
+    # Черновик, оставшийся в множестве id, в случайные рассказы не попадает
+    ids.set_published(draft.id, True)
+    assert draft.id in ids.sample(10)
+    assert sorted(x.id for x in models.Story.bl.get_random(count=10)) == sorted(x.id for x in published)
+
+
+def test_user_stories_state(factories):
+    user = factories.AuthorFactory()
+    story1 = factories.StoryFactory(published_chapters_count=3, comments_count=5)
+    story2 = factories.StoryFactory(published_chapters_count=2, comments_count=4)
+    draft = factories.DraftStoryFactory(published_chapters_count=1, comments_count=1)
+    chapters1 = [factories.ChapterFactory(story=story1) for _ in range(3)]
+    draft_chapter = factories.ChapterFactory(story=draft)
+
+    models.Favorites(author=user, story=story1)
+    models.Bookmark(author=user, story=story2)
+    view = models.StoryView(author=user, story=story1, chapter=chapters1[0])
+    models.StoryView(author=user, story=draft, chapter=draft_chapter)
+    models.Activity(author=user, story=story2, last_comments=1)
+    models.Activity(author=user, story=draft, last_comments=0)
+    orm.flush()
+
+    story_ids = [story1.id, story2.id, draft.id, 10 ** 9]
+    states = models.Story.bl.get_user_stories_state(user, story_ids)
+    assert set(states) == {story1.id, story2.id, draft.id}
+
+    assert states[story1.id].favorited and not states[story1.id].bookmarked
+    assert states[story2.id].bookmarked and not states[story2.id].favorited
+    assert states[story1.id].chapter_view_dates == {chapters1[0].id: view.date}
+    assert states[story2.id].chapter_view_dates == {}
+
+    # Должно совпадать со старыми отдельными запросами
+    unread_chapters = models.Story.bl.get_unread_chapters_count(user, story_ids)
+    unread_comments = models.Story.bl.get_unread_comments_count(user, story_ids)
+    for story_id, state in states.items():
+        assert state.unread_chapters_count == unread_chapters[story_id]
+        assert state.unread_comments_count == unread_comments[story_id]
+    assert states[story1.id].unread_chapters_count == 2
+    assert states[story2.id].unread_comments_count == 3
+    assert states[draft.id].unread_chapters_count == 0
+
+
+def test_user_stories_state_cache(app, factories, simple_cache, monkeypatch):
+    from flask import g
+    from mini_fiction.utils.misc import call_after_request_callbacks
+
+    user = factories.AuthorFactory()
+    story = factories.StoryFactory(published_chapters_count=2)
+    chapter1 = factories.ChapterFactory(story=story)
+    chapter2 = factories.ChapterFactory(story=story)
+    models.StoryView(author=user, story=story, chapter=chapter1)
+    orm.flush()
+
+    def get_state():
+        g.pop('user_stories_state', None)
+        return story.bl.get_user_state(user)
+
+    state = get_state()
+    assert not state.favorited
+    assert state.unread_chapters_count == 1
+
+    # Изменения в базе в обход BL не видны, пока состояние в кэше
+    models.Favorites(author=user, story=story)
+    orm.flush()
+    assert not get_state().favorited
+
+    # Избранное меняет состояние в текущем запросе сразу, а кэш
+    # сбрасывается только после коммита
+    def update_state(state):
+        state.favorited = True
+
+    story.bl.get_user_state(user)
+    story.bl.invalidate_cached_user_state(user, story.id, update_state)
+    assert story.bl.get_user_state(user).favorited
+    assert not get_state().favorited
+    call_after_request_callbacks()
+    assert get_state().favorited
+
+    chapter2.bl.viewed(user)
+    orm.flush()
+    state = get_state()
+    assert state.unread_chapters_count == 0
+    assert set(state.chapter_view_dates) == {chapter1.id, chapter2.id}
+    assert chapter2.bl.is_viewed_by(user) is not None
+
+    # Новая глава сбрасывает состояние у всех пользователей
+    models.Bookmark(author=user, story=story)
+    story.published_chapters_count = 3
+    orm.flush()
+    story.bl.reset_users_state(story.id)
+    state = get_state()
+    assert state.bookmarked
+    assert state.unread_chapters_count == 1
+
+
+def test_search_results_cache(app, factories, simple_cache, monkeypatch):
+    from mini_fiction.apis.amsphinxql import SphinxConnection, SphinxSearchResult
+
+    story1 = factories.StoryFactory()
+    story2 = factories.StoryFactory()
+    orm.flush()
+
+    class FakeSphinxConnection(SphinxConnection):
+        def __init__(self):  # pylint: disable=super-init-not-called
+            self._with_level = 0
+            self.searches = []
+            self.queries = []
+
+        def search(self, index, query, **kwargs):
+            self.searches.append((index, query, kwargs))
+            return SphinxSearchResult(
+                matches=[{'id': story2.id, 'weight': 2}, {'id': story1.id, 'weight': 1}],
+                meta={'total_found': '2', 'max_matches': 5000},
+            )
+
+        def _execute(self, sql, args=None):
+            self.queries.append((sql, args))
+
+        def commit(self):
+            pass
+
+        def rollback(self):
+            pass
+
+    conn = FakeSphinxConnection()
+    monkeypatch.setitem(app.config, 'SPHINX_DISABLED', False)
+    monkeypatch.setattr(app, 'sphinx', conn, raising=False)
+
+    def search(**filters):
+        return models.Story.bl.search('пони', 20, 1, **filters)
+
+    result = search(character=[2, 1])
+    assert [x.id for x in result.stories] == [story2.id, story1.id]
+    assert result.total == 2
+
+    # Тот же запрос (порядок значений фильтров не важен) берётся из кэша
+    result = search(character=[1, 2])
+    assert [x.id for x in result.stories] == [story2.id, story1.id]
+    assert len(conn.searches) == 1
+
+    # Другие параметры — другой ключ
+    search(character=[1, 2], only_published=False)
+    assert len(conn.searches) == 2
+
+    # Изменение счётчиков кэш не сбрасывает, а изменение остальных полей сбрасывает
+    models.Story.bl.update_stories_in_search({story1: ('vote_total',)}, with_chapters=False)
+    search(character=[1, 2])
+    assert len(conn.searches) == 2
+    models.Story.bl.update_stories_in_search({story1: ('finished',)}, with_chapters=False)
+    search(character=[1, 2])
+    assert len(conn.searches) == 3
+    search(character=[1, 2])
+    assert len(conn.searches) == 3
+
+
+def test_story_vote_incremental_rating(app, factories):
+    import json
+    from statistics import mean, pstdev
+
+    story = factories.StoryFactory()
+    users = [factories.AuthorFactory() for _ in range(7)]
+    values = [5, 4, 4, 1, 3, 5, 2]
+    votes = [story.bl.vote(user, value, ip='127.0.0.1') for user, value in zip(users, values)]
+
+    # Повторный голос с другой оценкой и отзыв голоса модератором
+    votes[0] = story.bl.vote(users[0], 2, ip='127.0.0.1')
+    votes[3].revoked_at = votes[3].updated
+    story.bl.update_rating([(votes[3].vote_value, None)])
+    values = [2, 4, 4, 3, 5, 2]
+
+    extra = json.loads(story.vote_extra)
+    assert extra['histogram'] == [0, 2, 1, 2, 1]
+    assert story.vote_total == 6
+    assert extra['average'] == round(mean(values), 6)
+    assert extra['stddev'] == round(pstdev(values), 6)
+
+    # Полный пересчёт (как в checkstoryvoting) даёт то же самое
+    incremental = (story.vote_total, story.vote_value, story.vote_extra)
+    story.bl.update_rating()
+    assert (story.vote_total, story.vote_value, story.vote_extra) == incremental
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+import gzip
+import json
+
+import pytest
+from flask import url_for
+
+from mini_fiction.models import Favorites
+
+
+@pytest.fixture
+def story(app, factories, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORY_DUMP_BATCH_SIZE', 2)
+    monkeypatch.setitem(app.config, 'STORY_DUMP_CHUNK_SIZE', 100)
+
+    story = factories.StoryFactory(title='Dumped story', published_chapters_count=2)
+    factories.ChapterFactory(story=story, order=1, text='<p>First</p>')
+    factories.ChapterFactory(story=story, order=2, text='<p>Second</p>')
+    for _ in range(5):
+        Favorites(story=story, author=factories.AuthorFactory())
+    story.flush()
+    return story
+
+
+def test_story_dump_streaming(client, story):
+    res = client.get(url_for('story.download_json', story_id=story.id))
+    assert res.status_code == 200
+    assert res.is_streamed
+    assert 'Content-Encoding' not in res.headers
+    lines = [json.loads(x) for x in res.data.decode('utf-8').splitlines()]
+    res.close()
+
+    assert lines[0]['_entity'] == 'story'
+    assert lines[0]['title'] == 'Dumped story'
+    assert [x['_entity'] for x in lines].count('chapter') == 2
+
+
+def test_story_full_dump_gzip(client, factories, story):
+    admin = factories.AuthorFactory(is_staff=True, is_superuser=True)
+    admin.flush()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = admin.get_id()
+
+    res = client.get(url_for('story.download_json_full', story_id=story.id), headers={'Accept-Encoding': 'gzip'})
+    assert res.status_code == 200
+    assert res.headers['Content-Encoding'] == 'gzip'
+    lines = [json.loads(x) for x in gzip.decompress(res.data).decode('utf-8').splitlines()]
+    res.close()
+
+    assert lines[0]['_entity'] == 'story'
+    assert [x['_entity'] for x in lines].count('chapter') == 2
+    # Избранное выгружается пачками по STORY_DUMP_BATCH_SIZE
+    assert [x['_entity'] for x in lines].count('favorites') == 5
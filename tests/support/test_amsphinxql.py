@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+import pytest
+
+from mini_fiction.apis import amsphinxql
+from mini_fiction.apis.amsphinxql import SphinxConnection, estimate_item_size
+
+
+class FakeSphinxConnection(SphinxConnection):
+    # Без подключения к настоящему Manticore: просто запоминаем запросы
+    def __init__(self):  # pylint: disable=super-init-not-called
+        self._with_level = 0
+        self.queries = []
+
+    def _execute(self, sql, args=None):
+        self.queries.append((sql, args))
+
+
+def test_add_batched_splits_by_size():
+    conn = FakeSphinxConnection()
+    items = [{'id': i, 'text': 'x' * 100, 'tag': [1, 2]} for i in range(10)]
+    item_size = estimate_item_size(items[0])
+
+    statements = conn.add_batched('chapters', items, max_bytes=item_size * 3)
+    assert statements == 4
+    assert len(conn.queries) == 4
+    assert all(q[0].startswith('replace into `chapters` (`id`, `text`, `tag`) values ') for q in conn.queries)
+    assert [q[1][0] for q in conn.queries] == [0, 3, 6, 9]
+
+
+def test_add_batched_sends_huge_item_alone():
+    conn = FakeSphinxConnection()
+    items = [{'id': 1, 'text': 'x'}, {'id': 2, 'text': 'x' * 1000}, {'id': 3, 'text': 'x'}]
+
+    assert conn.add_batched('chapters', items, max_bytes=100) == 3
+    assert conn.add_batched('chapters', [], max_bytes=100) == 0
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_select_highlights():
+    conn = FakeSphinxConnection()
+    conn._execute = lambda sql, args=None: conn.queries.append((sql, args)) or FakeCursor([(2, 'b'), (1, 'a')])
+
+    assert conn.select_highlights('chapters', [1, 2], 'query', limit=100) == {1: 'a', 2: 'b'}
+    assert conn.queries == [(
+        'select id, highlight({limit=%s}, %s) from `chapters` where match(%s) and id in (%s, %s) limit 2',
+        [100, 'text', 'query', 1, 2],
+    )]
+    assert conn.select_highlights('chapters', [], 'query') == {}
+    assert len(conn.queries) == 1
+
+
+class PoolConnection:
+    created = []
+
+    def __init__(self, conn):
+        self.pings = 0
+        self.closed = False
+        self.broken = False
+        PoolConnection.created.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        pass
+
+    def ping(self):
+        self.pings += 1
+        if self.broken:
+            raise RuntimeError('broken')
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool_connection(monkeypatch):
+    PoolConnection.created = []
+    monkeypatch.setattr(amsphinxql, 'SphinxConnection', PoolConnection)
+    return PoolConnection
+
+
+def test_pool_pings_only_idle_connections(pool_connection, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(amsphinxql.time, 'monotonic', lambda: now[0])
+    pool = amsphinxql.SphinxPool({}, max_conns=2, ping_interval=30)
+
+    with pool as conn1:
+        pass
+    assert conn1.pings == 0
+
+    now[0] += 10
+    with pool as conn:
+        assert conn is conn1
+    assert conn1.pings == 0
+
+    now[0] += 60
+    with pool as conn:
+        assert conn is conn1
+    assert conn1.pings == 1
+
+    stats = pool.get_stats()
+    assert stats['checkouts'] == 3
+    assert stats['created'] == 1
+    assert stats['pings'] == 1
+    assert stats['total'] == 1
+    assert stats['in_use'] == 0
+
+
+def test_pool_evicts_idle_connections(pool_connection, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(amsphinxql.time, 'monotonic', lambda: now[0])
+    pool = amsphinxql.SphinxPool({}, max_conns=3, idle_timeout=60)
+
+    with pool as conn1:
+        # Вложенный with в том же потоке использует то же соединение,
+        # поэтому второе берём напрямую
+        conn2 = pool._get_connection_from_pool()  # pylint: disable=protected-access
+        pool._release_connection(conn2)  # pylint: disable=protected-access
+    assert pool.get_stats()['total'] == 2
+
+    now[0] += 45
+    with pool as conn:
+        assert conn is conn1
+    # Возврат соединения в пул простаивающие соединения не трогает
+    assert pool.get_stats()['total'] == 2
+
+    now[0] += 30
+    # conn2 лежит на дне LIFO-очереди и не выдаётся, но простаивал
+    # 75 секунд и закрывается при очередной выдаче соединения
+    with pool as conn:
+        assert conn is conn1
+    assert conn2.closed and not conn1.closed
+
+    stats = pool.get_stats()
+    assert stats['total'] == 1
+    assert stats['evicted'] == 1
+
+
+def test_pool_checkout_timeout(pool_connection):
+    pool = amsphinxql.SphinxPool({}, max_conns=1, checkout_timeout=0.01)
+
+    with pool:
+        with pytest.raises(amsphinxql.SphinxPoolTimeout):
+            pool._get_connection_from_pool()  # pylint: disable=protected-access
+
+    stats = pool.get_stats()
+    assert stats['waits'] == 1
+    assert stats['wait_time'] > 0
+    assert stats['total'] == 1
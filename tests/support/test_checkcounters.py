@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+from pony import orm
+
+from mini_fiction import models
+from mini_fiction.management.commands.checkcounters import check_all_counters_set_based
+
+
+def _fill(factories):
+    author = factories.AuthorFactory()
+    reader = factories.AuthorFactory()
+    tag = factories.TagFactory()
+    story = factories.StoryFactory(authors=[author])
+    draft = factories.StoryFactory(authors=[author], draft=True)
+    models.StoryTag(story=story, tag=tag)
+    models.StoryTag(story=draft, tag=tag)
+    chapter1 = factories.ChapterFactory(story=story, order=1)
+    chapter2 = factories.ChapterFactory(story=story, order=2, draft=True)
+    for user in (author, reader, reader, None):
+        models.StoryView(story=story, chapter=chapter1, author=user)
+    models.StoryComment(
+        local_id=1, author=reader, author_username=reader.username,
+        story=story, text='Комментарий', root_id=0,
+        story_published=True, tree_depth=0,
+    )
+    orm.flush()
+
+    # Портим все счётчики
+    for obj in (author, reader):
+        obj.published_stories_count = 10
+        obj.all_story_comments_count = 10
+    tag.stories_count = tag.published_stories_count = 10
+    story.all_chapters_count = story.published_chapters_count = story.views = 10
+    chapter1.views = chapter2.views = 10
+    orm.flush()
+
+    return author, reader, tag, story, chapter1, chapter2
+
+
+def test_checkcounters_set_based(app, factories, capsys):
+    author, reader, tag, story, chapter1, chapter2 = _fill(factories)
+    check_all_counters_set_based(verbosity=1, batch_size=2)
+
+    # Сущности в кэше Pony не обновлены, поэтому смотрим в базу запросами
+    Author, Tag, Story, Chapter = models.Author, models.Tag, models.Story, models.Chapter
+    authors = orm.select(
+        (x.id, x.published_stories_count, x.all_story_comments_count) for x in Author if x.id in (author.id, reader.id)
+    )
+    assert sorted(authors) == [(author.id, 1, 0), (reader.id, 0, 1)]
+    assert orm.select((x.stories_count, x.published_stories_count) for x in Tag if x.id == tag.id)[:] == [(2, 1)]
+    assert orm.select(
+        (x.all_chapters_count, x.published_chapters_count, x.views) for x in Story if x.id == story.id
+    )[:] == [(2, 1, 3)]
+    chapters = dict(orm.select((x.id, x.views) for x in Chapter if x.story.id == story.id))
+    assert chapters == {chapter1.id: 3, chapter2.id: 0}
+
+    err = capsys.readouterr().err
+    assert 'Story {} views: 10 -> 3'.format(story.id) in err
+    assert '1 tags available, 1 tags changed' in err
+
+
+def test_checkcounters_set_based_dry_run(app, factories, capsys):
+    author, reader, tag, story, chapter1, chapter2 = _fill(factories)
+    check_all_counters_set_based(verbosity=1, dry_run=True)
+
+    assert orm.select(x.views for x in models.Story if x.id == story.id)[:] == [10]
+    assert 'Chapter {}/1 ({}) views: 10 -> 3'.format(story.id, chapter1.id) in capsys.readouterr().err
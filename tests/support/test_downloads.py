@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+import io
+import os
+import zipfile
+
+import pytest
+import lxml.etree as etree
+
+from mini_fiction import tasks
+from mini_fiction.downloads import list_formats
+from mini_fiction.downloads import artifacts
+from mini_fiction.downloads.fb2 import FB2Download
+from mini_fiction.filters import fb2
+from mini_fiction.utils.misc import nonrequest_context
+
+
+@pytest.fixture
+def media_root(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'MEDIA_ROOT', tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def story(factories):
+    story = factories.StoryFactory(title='Story for download', published_chapters_count=1)
+    factories.ChapterFactory(story=story, text='<p>Some text</p>')
+    story.flush()
+    return story
+
+
+def test_build_story_artifacts(media_root, story):
+    paths = artifacts.build_story_artifacts(story)
+    assert sorted(paths) == sorted(artifacts.get_artifact_path(story, fmt) for fmt in list_formats())
+    assert all(artifacts.is_artifact_fresh(x, story) for x in paths)
+    # Временные файлы не остаются
+    assert not [x for x in os.listdir(paths[0].parent) if x.endswith('.tmp')]
+
+    # Всё актуально — повторно ничего не рендерится
+    assert artifacts.build_story_artifacts(story) == []
+
+    # Рассказ обновился после рендеринга файлов — задача рендерит их заново
+    for path in paths:
+        os.utime(path, (0, 0))
+    assert not any(artifacts.is_artifact_fresh(x, story) for x in paths)
+    tasks.build_story_downloads(story.id)
+    assert all(artifacts.is_artifact_fresh(x, story) for x in paths)
+
+
+def test_get_artifact_serves_previous_file_while_locked(media_root, story):
+    fmt = list_formats()[0]
+    path = artifacts.get_artifact(story, fmt)
+    data = path.read_bytes()
+    os.utime(path, (0, 0))
+    assert not artifacts.is_artifact_fresh(path, story)
+
+    # Другой процесс уже рендерит файл: отдаём предыдущую версию, не дожидаясь
+    with artifacts.render_lock(story, fmt, timeout=0) as acquired:
+        assert acquired
+        assert artifacts.get_artifact(story, fmt) == path
+        assert not artifacts.is_artifact_fresh(path, story)
+
+    assert artifacts.get_artifact(story, fmt) == path
+    assert artifacts.is_artifact_fresh(path, story)
+    assert path.read_bytes() == data
+
+
+def test_get_artifact_waits_for_missing_file(app, media_root, story, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORY_DOWNLOAD_RENDER_WAIT', 0.2)
+    fmt = list_formats()[0]
+
+    with artifacts.render_lock(story, fmt, timeout=0):
+        # Предыдущей версии нет, блокировку так и не отпустили — рендерим сами
+        path = artifacts.get_artifact(story, fmt)
+    assert artifacts.is_artifact_fresh(path, story)
+
+
+def test_fb2_streaming_matches_joined_document(factories):
+    story = factories.StoryFactory(title='Story for FB2', published_chapters_count=2)
+    factories.ChapterFactory(story=story, order=1, text='<p>First <footnote id="1">note one</footnote></p>')
+    factories.ChapterFactory(story=story, order=2, title='Second', text='<p>Second <footnote id="1">note two</footnote></p>')
+    story.flush()
+
+    fmt = FB2Download()
+    with nonrequest_context():
+        streamed = fmt.render(story=story)
+
+        # Так FB2 собирался раньше: все главы в памяти и склейка через XSLT
+        chapters = story.chapters.select().order_by(lambda x: x.order)
+        joined = fb2.join_fb2_docs(
+            [fmt._get_annotation_doc(story)] +  # pylint: disable=protected-access
+            [fb2.html_to_fb2(c.get_fb2_chapter_text(), title=c.autotitle) for c in chapters],
+            title=story.title,
+            author_name=story.authors[0].username,
+            date=(story.first_published_at or story.date).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        )
+
+    assert streamed.startswith(b"<?xml version='1.0' encoding='UTF-8'?>")
+    assert b'doc3_' in streamed
+    assert etree.tostring(etree.fromstring(streamed), method='c14n') == etree.tostring(joined, method='c14n')
+
+
+def test_zip_streaming_to_file(media_root, story):
+    for fmt in list_formats():
+        if not fmt.extension.endswith('.zip'):
+            continue
+        path = artifacts.build_artifact(story, fmt)
+        with nonrequest_context():
+            data = fmt.render(story=story)
+        with zipfile.ZipFile(str(path)) as streamed, zipfile.ZipFile(io.BytesIO(data)) as rendered:
+            assert streamed.namelist() == rendered.namelist()
+            assert streamed.testzip() is None
+            for name in streamed.namelist():
+                assert streamed.read(name) == rendered.read(name)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+import os
+
+from lxml import etree
+
+from mini_fiction.filters import base
+from mini_fiction.filters.html import normalize_html
+
+
+XSLT_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:template match="/"><result>{}</result></xsl:template>
+</xsl:stylesheet>
+'''
+
+
+def test_xslt_registry_compiles_once(tmp_path):
+    xslt_path = str(tmp_path / 'test.xslt')
+    with open(xslt_path, 'w', encoding='utf-8') as fp:
+        fp.write(XSLT_TEMPLATE.format('foo'))
+
+    transform = base.get_xslt_transform(xslt_path)
+    assert base.get_xslt_transform(xslt_path) is transform
+    assert str(transform(etree.XML('<a/>'))).strip().endswith('<result>foo</result>')
+
+
+def test_xslt_registry_auto_reload(tmp_path):
+    xslt_path = str(tmp_path / 'test.xslt')
+    with open(xslt_path, 'w', encoding='utf-8') as fp:
+        fp.write(XSLT_TEMPLATE.format('foo'))
+    transform = base.get_xslt_transform(xslt_path)
+
+    with open(xslt_path, 'w', encoding='utf-8') as fp:
+        fp.write(XSLT_TEMPLATE.format('bar'))
+    st = os.stat(xslt_path)
+    os.utime(xslt_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+    # Без auto_reload изменения файла не замечаются
+    assert base.get_xslt_transform(xslt_path) is transform
+
+    new_transform = base.get_xslt_transform(xslt_path, auto_reload=True)
+    assert new_transform is not transform
+    assert str(new_transform(etree.XML('<a/>'))).strip().endswith('<result>bar</result>')
+
+
+def test_normalize_html_uses_registry():
+    base.clear_xslt_registry()
+    assert base.html_doc_to_string(normalize_html('<p>foo</p>')) == '<p>foo</p>'
+    assert len(base._xslt_registry) == 2  # pylint: disable=protected-access
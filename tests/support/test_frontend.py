@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+import os
+import json
+
+import pytest
+from flask import g
+
+from mini_fiction.logic import frontend
+
+
+def write_manifest(path, assets, mtime=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({
+        name: {'src': src, 'integrity': 'sha384-test'} for name, src in assets.items()
+    }), encoding='utf-8')
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.fixture
+def static_root(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app.settings, 'STATIC_ROOT', str(tmp_path))
+    monkeypatch.setattr(app.settings, 'LOCALSTATIC_ROOT', None)
+    monkeypatch.setattr(app.settings, 'FRONTEND_MANIFESTS_AUTO_RELOAD', False)
+    monkeypatch.setattr(app.settings, 'FRONTEND_MANIFESTS_CHECK_INTERVAL', None)
+    frontend.clear_manifests_registry()
+    yield tmp_path
+    frontend.clear_manifests_registry()
+
+
+def get_urls(app):
+    with app.test_request_context('/'):
+        g.pop('frontend_assets', None)
+        return [x.url for x in frontend.scripts()]
+
+
+def test_manifests_registry_revalidation(app, static_root):
+    manifest_path = static_root / 'main' / 'manifest.json'
+    write_manifest(manifest_path, {'index.js': 'index.1.js'}, mtime=10 ** 18)
+    assert get_urls(app) == ['/static/main/index.1.js']
+
+    # Без проверки изменений манифест не перечитывается
+    write_manifest(manifest_path, {'index.js': 'index.2.js'}, mtime=2 * 10 ** 18)
+    write_manifest(static_root / 'other' / 'manifest.json', {'other.js': 'other.1.js'})
+    assert get_urls(app) == ['/static/main/index.1.js']
+
+    # ...пока кто-нибудь (например, обработчик SIGHUP) не попросит проверить
+    frontend.invalidate_manifests_registry()
+    assert get_urls(app) == ['/static/main/index.2.js', '/static/other/other.1.js']
+
+    (static_root / 'other' / 'manifest.json').unlink()
+    frontend.invalidate_manifests_registry()
+    assert get_urls(app) == ['/static/main/index.2.js']
+
+
+def test_manifests_auto_reload(app, static_root, monkeypatch):
+    monkeypatch.setattr(app.settings, 'FRONTEND_MANIFESTS_AUTO_RELOAD', True)
+
+    manifest_path = static_root / 'main' / 'manifest.json'
+    write_manifest(manifest_path, {'index.js': 'index.1.js'}, mtime=10 ** 18)
+    assert get_urls(app) == ['/static/main/index.1.js']
+
+    write_manifest(manifest_path, {'index.js': 'index.2.js'}, mtime=2 * 10 ** 18)
+    assert get_urls(app) == ['/static/main/index.2.js']
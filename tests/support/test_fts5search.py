@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+import pytest
+
+from mini_fiction import models
+from mini_fiction.apis.fts5search import FTS5SearchConnection, FTS5SearchPool, build_snippet, parse_query
+
+
+def story_item(story_id, title, **fields):
+    item = {
+        'id': story_id, 'title': title, 'summary': '', 'notes': '', 'match_author': 'author',
+        'original_title': '', 'original_author': '',
+        'first_published_at': story_id * 100, 'words': 1000, 'rating_id': 1,
+        'vote_total': 0, 'vote_value': 0, 'comments_count': 0,
+        'finished': False, 'original': True, 'freezed': False, 'draft': False, 'approved': True,
+        'character': [], 'tag': [], 'author': [1],
+    }
+    item.update(fields)
+    return item
+
+
+@pytest.fixture
+def fts(tmp_path):
+    conn = FTS5SearchConnection({'path': str(tmp_path / 'search.sqlite3')})
+    with conn:
+        conn.add('stories', [
+            story_item(1, 'Единорог и радуга', character=[1, 2], tag=[10], words=500),
+            story_item(2, 'Единороги в замке', character=[2], tag=[10, 11], words=3000),
+            story_item(3, 'Про драконов', character=[1, 3], tag=[11], words=2000, draft=True),
+        ])
+    yield conn
+    conn.close()
+
+
+def ids(result):
+    return [x['id'] for x in result.matches]
+
+
+def test_parse_query():
+    groups, exclude, prefixes = parse_query('единороги -драконы "белый замок" | башня', 2)
+    assert groups == [['"единоро"*'], ['"белый замок"', '"баш"*']]
+    assert exclude == ['"драко"*']
+    assert prefixes == {'единоро', 'драко', 'белый', 'замок', 'баш'}
+
+
+def test_search_query_and_filters(fts):
+    assert sorted(ids(fts.search('stories', 'единороги'))) == [1, 2]
+    assert ids(fts.search('stories', 'единороги -замок')) == [1]
+    assert sorted(ids(fts.search('stories', 'радуга | драконы'))) == [1, 3]
+
+    # Пустой запрос ищет по одним фильтрам
+    assert ids(fts.search('stories', '', sort_by='first_published_at DESC', draft=0)) == [2, 1]
+    assert ids(fts.search('stories', '', sort_by='words DESC')) == [2, 3, 1]
+    assert ids(fts.search('stories', '', words__gte=1000, sort_by='words DESC')) == [2, 3]
+
+    # Многозначные атрибуты
+    assert sorted(ids(fts.search('stories', '', character__in_all=[1, 2]))) == [1]
+    assert sorted(ids(fts.search('stories', '', character__in_any=[1, 2]))) == [1, 2, 3]
+    assert sorted(ids(fts.search('stories', '', tag__not_in=[11]))) == [1]
+
+    result = fts.search('stories', '', sort_by='id DESC', limit=(1, 1))
+    assert ids(result) == [2]
+    assert result.meta['total_found'] == 3
+
+
+def test_update_and_delete(fts):
+    with fts:
+        fts.update('stories', {'draft': 0, 'tag': [12]}, id__in=[3])
+    assert ids(fts.search('stories', 'драконы', draft=0)) == [3]
+    assert ids(fts.search('stories', '', tag__in_any=[12])) == [3]
+    assert sorted(ids(fts.search('stories', '', tag__in_any=[11]))) == [2]
+
+    with fts:
+        fts.add('stories', [story_item(3, 'Про рыцарей', draft=False)])
+    assert ids(fts.search('stories', 'драконы')) == []
+    assert ids(fts.search('stories', 'рыцари')) == [3]
+
+    with fts:
+        fts.delete('stories', id__in=[1, 2])
+    assert ids(fts.search('stories', '')) == [3]
+
+
+def test_build_snippet():
+    text = '<p>Жил-был единорог. ' + 'слово ' * 20 + 'Другие единороги &amp; пони.</p>'
+    snippet = build_snippet(text, {'единор'}, limit=200, around=2, chunk_separator='…')
+    assert snippet == 'Жил-был <b>единорог</b>. слово слово…слово Другие <b>единороги</b> &amp; пони.'
+    assert build_snippet('<p>ничего нет</p>', {'единор'}) == 'ничего нет'
+
+
+def test_story_search_with_fts5_backend(app, factories, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'SPHINX_DISABLED', False)
+    monkeypatch.setattr(app, 'sphinx', FTS5SearchPool({'path': str(tmp_path / 'search.sqlite3')}), raising=False)
+
+    story1 = factories.StoryFactory(title='Единорог и радуга')
+    story2 = factories.StoryFactory(title='Драконы')
+    chapter = factories.ChapterFactory(story=story1, text='<p>Однажды единорог нашёл радугу.</p>')
+    story1.flush()
+    assert models.Story.bl.add_stories_to_search([story1, story2]) > 0
+
+    result = models.Story.bl.search('единороги', 10)
+    assert [x.id for x in result.stories] == [story1.id]
+    assert result.total == 1
+
+    result = models.Chapter.bl.search('радуги', 10)
+    assert [x[0].id for x in result.chapters] == [chapter.id]
+    assert '<b>радугу</b>' in result.chapters[0][1]
+
+    story1.bl.delete_stories_from_search([story1.id])
+    assert models.Story.bl.search('единороги', 10).total == 0
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+from datetime import datetime, timedelta
+
+from flask import url_for
+from pony import orm
+
+from mini_fiction import tasks
+from mini_fiction.leaderboards import bucket_period
+from mini_fiction.models import Story
+from mini_fiction.utils.misc import call_after_request_callbacks
+
+
+def test_bucket_period():
+    periods = [7, 30, 365, 0]
+    assert bucket_period(0, periods) == 0
+    assert bucket_period(30, periods) == 30
+    assert bucket_period(1, periods) == 7
+    assert bucket_period(10, periods) == 7
+    assert bucket_period(20, periods) == 30
+    assert bucket_period(200, periods) == 365
+    assert bucket_period(1000, periods) == 0
+    assert bucket_period(1000, [7, 30]) == 30
+    assert bucket_period(0, [7, 30]) == 30
+
+
+def test_story_top_periods_and_order(app, factories, simple_cache):
+    now = datetime.utcnow()
+    old = factories.StoryFactory(vote_total=10, vote_value=500, first_published_at=now - timedelta(days=100))
+    new = factories.StoryFactory(vote_total=10, vote_value=300, first_published_at=now - timedelta(days=2))
+    tied = factories.StoryFactory(vote_total=10, vote_value=300, first_published_at=now - timedelta(days=20))
+    factories.StoryFactory(vote_total=1, vote_value=900)  # Мало голосов
+    factories.StoryFactory(vote_total=10, vote_value=900, draft=True)
+    orm.flush()
+
+    assert Story.bl.get_top(0) == ([old.id, tied.id, new.id], 0)
+    assert Story.bl.get_top(10) == ([new.id], 7)
+    assert Story.bl.get_top(30) == ([tied.id, new.id], 30)
+
+    # Топ берётся из кэша, а не из базы
+    new.vote_value = 1000
+    orm.flush()
+    assert Story.bl.get_top(0)[0] == [old.id, tied.id, new.id]
+
+    assert tasks.rebuild_story_top() == {7: 1, 30: 2, 365: 3, 0: 3}
+    assert Story.bl.get_top(0)[0] == [new.id, old.id, tied.id]
+
+
+def test_story_top_invalidated_on_vote(app, factories, simple_cache, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORY_TOP_SIZE', 2)
+    stories = [factories.StoryFactory(vote_total=10, vote_value=100 * (i + 1)) for i in range(3)]
+    story = factories.StoryFactory()
+    orm.flush()
+    monkeypatch.setattr(app, 'leaderboards', type(app.leaderboards)(app))
+
+    assert Story.bl.get_top(0)[0] == [stories[2].id, stories[1].id]
+
+    # Голоса за рассказ, который до топа не дотягивает, топ не сбрасывают
+    users = [factories.AuthorFactory() for _ in range(3)]
+    story.bl.vote(users[0], 1, ip='127.0.0.1')
+    call_after_request_callbacks()
+    assert simple_cache.get('story_top_0') is not None
+
+    for user in users[1:]:
+        story.bl.vote(user, 5, ip='127.0.0.1')
+    call_after_request_callbacks()
+    assert simple_cache.get('story_top_0') is None
+    assert Story.bl.get_top(0)[0] == [story.id, stories[2].id]
+
+
+def test_story_top_view(app, factories, simple_cache, client):
+    stories = [factories.StoryFactory(title='Top story {}'.format(i), vote_total=10, vote_value=100 * i) for i in range(3)]
+    orm.flush()
+    assert len(Story.bl.get_top(0)[0]) == 3
+    stories[2].draft = True
+    orm.flush()
+
+    # Рассказ, снятый с публикации после сборки топа, не показывается
+    res = client.get(url_for('object_lists.top', period=20))
+    assert res.status_code == 200
+    html = res.data.decode('utf-8')
+    assert 'Top story 1' in html
+    assert 'Top story 0' in html
+    assert 'Top story 2' not in html
+
+    res = client.get(url_for('feeds.top', period=3))
+    assert res.status_code == 200
+    assert 'Top story 1' in res.data.decode('utf-8')
+
+
+def test_story_top_rebuild_interval_from_config(app, monkeypatch):
+    from mini_fiction.application import get_celery_beat_schedule
+
+    monkeypatch.setitem(app.config, 'STORY_TOP_REFRESH_INTERVAL', 60)
+    assert get_celery_beat_schedule(app.config)['rebuild_story_top'] == {'task': 'rebuild_story_top', 'schedule': 60.0}
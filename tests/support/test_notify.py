@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+from pony import orm
+
+from mini_fiction import models, tasks
+
+
+def _subscribe(users, typ, target_id):
+    for user in users:
+        models.Subscription(user=user, type=typ, target_id=target_id, to_email=False, to_tracker=True)
+
+
+def _notified(typ):
+    return sorted(orm.select((x.user.id, x.target_id) for x in models.Notification if x.type == typ)[:])
+
+
+def test_notify_story_comment_checks_access(app, factories, simple_cache):
+    author = factories.AuthorFactory()
+    staff = factories.AuthorFactory(is_staff=True)
+    readers = [factories.AuthorFactory() for _ in range(3)]
+    story = factories.StoryFactory(authors=[author], draft=True)
+    comment = models.StoryComment(
+        local_id=1, author=readers[0], author_username=readers[0].username,
+        story=story, text='Комментарий', root_id=0,
+        story_published=False, tree_depth=0,
+    )
+    _subscribe([author, staff] + readers, 'story_comment', story.id)
+    orm.flush()
+
+    for user in [author, staff] + readers:
+        simple_cache.set('bell_{}'.format(user.id), 0)
+
+    # Черновик видят только соавторы и модераторы, автор комментария
+    # уведомление о своём же комментарии не получает
+    tasks.notify_story_comment(comment.id)
+    assert _notified('story_comment') == sorted([(author.id, comment.id), (staff.id, comment.id)])
+    assert simple_cache.get('bell_{}'.format(author.id)) is None
+    assert simple_cache.get('bell_{}'.format(readers[1].id)) == 0
+
+    # Опубликованный рассказ доступен всем
+    story.draft = False
+    orm.flush()
+    tasks.notify_story_comment(comment.id)
+    assert models.Notification.select(lambda x: x.type == 'story_comment').count() == 2 + 4
+
+
+def test_notify_story_chapters_in_batches(app, factories, simple_cache, monkeypatch):
+    monkeypatch.setitem(app.config, 'NOTIFICATION_BATCH_SIZE', 2)
+    author = factories.AuthorFactory()
+    readers = [factories.AuthorFactory() for _ in range(3)]
+    story = factories.StoryFactory(authors=[author])
+    chapters = [factories.ChapterFactory(story=story, order=i + 1) for i in range(2)]
+    _subscribe([author] + readers, 'story_chapter', story.id)
+    orm.flush()
+
+    tasks.notify_story_chapters([x.id for x in chapters], publisher_user_id=author.id)
+    assert _notified('story_chapter') == sorted((u.id, c.id) for u in readers for c in chapters)
+
+    bell = readers[0].bl.get_notifications()
+    assert [x['type'] for x in bell] == ['story_chapter', 'story_chapter']
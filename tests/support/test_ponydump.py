@@ -6,6 +6,7 @@
 import io
 import os
 import gzip
+import json
 import uuid
 import shutil
 from datetime import datetime
@@ -185,7 +186,6 @@ def test_dump_to_directory_full(use_testdb, dumpdir, gzip_compression):
         {'current': 2, 'count': 2, 'pk': (2,), 'entity': 'many2', 'chunk_size': 250},
         {'current': 2, 'count': 2, 'pk': None, 'entity': 'many2', 'chunk_size': 250},
 
-        {'current': 1, 'count': 3, 'pk': (1, 2, 3), 'entity': 'pdtest1', 'chunk_size': 250},
         {'current': 1, 'count': 3, 'pk': (1, 2, 3), 'entity': 'pdtest1', 'chunk_size': 250},
         {'current': 3, 'count': 3, 'pk': (4, 5, 5), 'entity': 'pdtest1', 'chunk_size': 250},
         {'current': 3, 'count': 3, 'pk': None, 'entity': 'pdtest1', 'chunk_size': 250},
@@ -218,6 +218,8 @@ def test_dump_to_directory_full(use_testdb, dumpdir, gzip_compression):
     # Проверка информацирования о процессе дампа
     for status in pd.dump_to_directory(dumpdir, gzip_compression=gzip_compression):
         path = status.pop('path')
+        if path is not None:
+            assert status.pop('elapsed') >= 0
 
         if path is not None:
             assert path.name in filenames
@@ -288,6 +290,8 @@ def test_dump_to_directory_one_entity(use_testdb, dumpdir):
 
     for status in pd.dump_to_directory(dumpdir, entities=['many1']):
         path = status.pop('path')
+        if path is not None:
+            assert status.pop('elapsed') >= 0
 
         if path is not None:
             assert path.name in filenames
@@ -321,6 +325,52 @@ def test_dump_to_directory_exclude_attrs(use_testdb, dumpdir):
     ])
 
 
+@pytest.mark.nodbcleaner
+def test_dump_to_directory_parallel_keyset(app, tmp_path):
+    # Для дампа в нескольких процессах нужна база в файле, а не в памяти
+    db = orm.Database()
+
+    class KeysetTest1(db.Entity):
+        k1 = orm.Required(int)
+        k2 = orm.Required(str)
+        text = orm.Optional(orm.LongStr)
+        orm.PrimaryKey(k1, k2)
+
+    class KeysetTest2(db.Entity):
+        value = orm.Required(int)
+
+    db.bind('sqlite', str(tmp_path / 'keyset.sqlite3'), create_db=True)
+    db.generate_mapping(create_tables=True)
+    with orm.db_session:
+        for i in range(40):
+            KeysetTest1(k1=i % 3, k2='k{:02d}'.format(i), text='text {}'.format(i))
+            KeysetTest2(value=i)
+
+    pd = PonyDump(db, chunk_sizes={'keysettest1': 7, 'keysettest2': 5})
+    statuses = list(pd.dump_to_directory(tmp_path / 'seq'))
+    assert [x['current'] for x in statuses if x['entity'] == 'keysettest1'][-1] == 40
+
+    parallel_statuses = list(pd.dump_to_directory(tmp_path / 'par', processes=2))
+    assert parallel_statuses[-1]['entity'] is None
+    assert sorted((x['entity'], x['current'], x['pk']) for x in parallel_statuses[:-1]) == [
+        ('keysettest1', 40, None),
+        ('keysettest2', 40, None),
+    ]
+
+    for name in ('keysettest1_dump.jsonl', 'keysettest2_dump.jsonl'):
+        data = (tmp_path / 'seq' / name).read_bytes()
+        assert data == (tmp_path / 'par' / name).read_bytes()
+        assert data.count(b'\n') == 40
+
+    # Объекты отсортированы по первичному ключу, пачки стыкуются без пропусков
+    lines = (tmp_path / 'seq' / 'keysettest1_dump.jsonl').read_text('utf-8').splitlines()
+    keys = [(x['k1'], x['k2']) for x in map(json.loads, lines)]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == 40
+
+    db.disconnect()
+
+
 # loaddb tests
 
 
@@ -584,6 +634,86 @@ def test_load_from_files_relations_all_orders(use_testdb, dumpdir, lines):
     assert many2.many1.select()[:] == [many1]
 
 
+@pytest.mark.nodbcleaner
+@pytest.mark.parametrize('batch_size', [1, 1000])
+def test_bulk_load_from_files_roundtrip(use_testdb, dumpdir, batch_size):
+    pd = PonyDump(testdb)
+    with orm.db_session:
+        _fill_testdb()
+    for _ in pd.dump_to_directory(dumpdir / 'before'):
+        pass
+
+    with orm.db_session:
+        testdb.execute('DELETE FROM {}'.format(Many1.many2.table))
+        for entity in (PDTest2, PDTest3, PDTest1, Many1, Many2):
+            entity.select().delete(bulk=True)
+
+    statuses = list(pd.bulk_load_from_files([dumpdir / 'before'], batch_size=batch_size))
+    assert statuses[-1]['stage'] is None
+    # Файлы загружаются в порядке зависимостей, откладывать нечего
+    assert not [x for x in statuses if x['stage'] == 'update']
+    assert [x['current'] for x in statuses if x['stage'] == 'm2m'][-1] == 4
+    inserted = {x['path'].name: x['current'] for x in statuses if x['stage'] == 'insert'}
+    assert sum(inserted.values()) == 11
+
+    for _ in pd.dump_to_directory(dumpdir / 'after'):
+        pass
+    for path in (dumpdir / 'before').iterdir():
+        assert path.read_bytes() == (dumpdir / 'after' / path.name).read_bytes()
+
+    with orm.db_session:
+        test1 = PDTest1.get(k1=1, k2=2, k3=3)
+        assert test1.test2.id == 1
+        assert test1.test3.count() == 2
+
+    # Загружать можно только в пустые таблицы
+    with pytest.raises(ValueError) as excinfo:
+        list(pd.bulk_load_from_files([dumpdir / 'before']))
+    assert 'pdtest1' in str(excinfo.value)
+
+
+@pytest.mark.nodbcleaner
+def test_bulk_load_from_files_deferred_optional(use_testdb, dumpdir):
+    dumpdir.mkdir(parents=True)
+
+    # В файле без имени модели порядок зависимостей неизвестен, поэтому
+    # опциональная ссылка на PDTest1 проставляется вторым проходом
+    with (dumpdir / 'some_dump.jsonl').open('w', encoding='utf-8') as fp:
+        fp.write('{"_entity": "pdtest3", "foo_datetime": 0, "foo_float": 0.5, "foo_int": 1, "foo_longstr": "l", "foo_string": "s", "foo_uuid": "8e8cdc11-0785-43a8-8203-66c148c3f57c", "id": 5, "test1": [1, 2, 3]}\n')
+        fp.write('{"_entity": "pdtest1", "k1": 1, "k2": 2, "k3": 3, "test3": [5]}\n')
+        fp.write('{"_entity": "many2", "id": 20, "many1": [10]}\n')
+        fp.write('{"_entity": "many1", "id": 10}\n')
+
+    pd = PonyDump(testdb)
+    statuses = list(pd.bulk_load_from_files([dumpdir]))
+    assert [(x['stage'], x['entity'], x['current']) for x in statuses] == [
+        ('insert', None, 4),
+        ('update', 'pdtest3', 1),
+        ('m2m', 'many1', 1),
+        (None, None, 0),
+    ]
+
+    with orm.db_session:
+        test3 = PDTest3[5]
+        assert test3.test1.get_pk() == (1, 2, 3)
+        assert test3.foo_bool is None
+        assert test3.foo_datetime == datetime(1970, 1, 1)
+        assert Many1[10].many2.select()[:] == [Many2[20]]
+
+
+@pytest.mark.nodbcleaner
+def test_bulk_load_from_files_fail_invalid_json(use_testdb, dumpdir):
+    dumpdir.mkdir(parents=True)
+    with (dumpdir / 'many1_dump.jsonl').open('w', encoding='utf-8') as fp:
+        fp.write('{"_entity": "many1", "id": 1}\n')
+        fp.write('{"_entity": "many1", "id": 2\n')
+
+    pd = PonyDump(testdb)
+    with pytest.raises(ValueError) as excinfo:
+        list(pd.bulk_load_from_files([dumpdir], batch_size=1))
+    assert str(excinfo.value).startswith('Invalid JSON on line 2: ')
+
+
 @pytest.mark.nodbcleaner
 @orm.db_session
 def test_json2obj_ok_entity_case_insensitive(use_testdb):
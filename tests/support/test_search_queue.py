@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+import pytest
+
+from mini_fiction import tasks
+from mini_fiction.apis.amsphinxql import SphinxConnection, SphinxPoolTimeout
+from mini_fiction.bl.stories import StoryBL
+from mini_fiction.search_queue import BaseSearchQueue, SearchQueueBatch
+
+
+class FakeSphinxConnection(SphinxConnection):
+    def __init__(self):  # pylint: disable=super-init-not-called
+        self._with_level = 0
+        self.queries = []
+
+    def _execute(self, sql, args=None):
+        self.queries.append((sql, args))
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class MemorySearchQueue(BaseSearchQueue):
+    def __init__(self, app):
+        super().__init__(app)
+        self.batch = SearchQueueBatch()
+        self.stats = []
+
+    def push_story(self, story_id, update_fields=None):
+        self.batch.pushed += 1
+        if update_fields is None or self.batch.stories.get(story_id, set()) is None:
+            self.batch.stories[story_id] = None
+        else:
+            self.batch.stories[story_id] = self.batch.stories.get(story_id, set()) | set(update_fields)
+
+    def push_chapter(self, chapter_id, update_story_words=True):
+        self.batch.pushed += 1
+        self.batch.chapters[chapter_id] = self.batch.chapters.get(chapter_id, False) or update_story_words
+
+    def pop(self):
+        batch, self.batch = self.batch, SearchQueueBatch()
+        return batch
+
+    def requeue(self, batch):
+        self.batch = batch
+
+    def add_stats(self, pushed, applied, statements):
+        self.stats.append((pushed, applied, statements))
+
+
+@pytest.fixture
+def fake_sphinx(app, monkeypatch):
+    conn = FakeSphinxConnection()
+    monkeypatch.setitem(app.config, 'SPHINX_DISABLED', False)
+    monkeypatch.setattr(app, 'sphinx', conn, raising=False)
+    monkeypatch.setattr(app, 'search_queue', MemorySearchQueue(app))
+    return conn
+
+
+def test_flush_queue_coalesces_story_updates(app, factories, fake_sphinx):
+    story1 = factories.StoryFactory()
+    story2 = factories.StoryFactory()
+    chapter1 = factories.ChapterFactory(story=story1)
+    chapter2 = factories.ChapterFactory(story=story2)
+    story1.flush()
+    story2.flush()
+
+    queue = app.search_queue
+    for _ in range(10):
+        queue.push_story(story1.id, ('comments_count',))
+        queue.push_story(story2.id, ('comments_count',))
+    queue.push_story(story1.id, ('vote_total',))
+    queue.push_story(story2.id, ('vote_total',))
+
+    result = tasks.sphinx_flush_queue()
+    assert result == {'pushed': 22, 'applied': 2, 'statements': 2}
+    assert queue.stats == [(22, 2, 2)]
+
+    # У обоих рассказов одинаковые значения полей: по одному запросу
+    # на все рассказы и на все их главы
+    assert len(fake_sphinx.queries) == 2
+    stories_sql, stories_args = fake_sphinx.queries[0]
+    chapters_sql, chapters_args = fake_sphinx.queries[1]
+    assert stories_sql.startswith('update `stories` set ')
+    assert tuple(stories_args[-2:]) == (story1.id, story2.id)
+    assert chapters_sql.startswith('update `chapters` set ')
+    assert sorted(chapters_args[-2:]) == sorted([chapter1.id, chapter2.id])
+
+    # Очередь пуста, повторно ничего не отправляется
+    assert tasks.sphinx_flush_queue() is None
+    assert len(fake_sphinx.queries) == 2
+
+
+def test_flush_queue_skips_chapters_of_reindexed_stories(app, factories, fake_sphinx):
+    story = factories.StoryFactory()
+    chapter = factories.ChapterFactory(story=story)
+    story.flush()
+
+    queue = app.search_queue
+    queue.push_chapter(chapter.id)
+    queue.push_story(story.id, ('vote_total',))
+    queue.push_story(story.id)
+    queue.push_chapter(chapter.id)
+
+    result = tasks.sphinx_flush_queue()
+    assert result['pushed'] == 4
+    assert result['applied'] == 1
+    assert not any(sql.startswith('update ') for sql, _ in fake_sphinx.queries)
+    assert [sql.split(' (')[0] for sql, _ in fake_sphinx.queries] == [
+        'replace into `stories`',
+        'replace into `chapters`',
+    ]
+
+
+def test_flush_queue_requeues_on_connection_error(app, factories, fake_sphinx, monkeypatch):
+    story = factories.StoryFactory()
+    story.flush()
+
+    def broken_update(self, updates, with_chapters=True):
+        raise SphinxPoolTimeout('Sphinx is busy')
+
+    monkeypatch.setattr(StoryBL, 'update_stories_in_search', broken_update)
+
+    queue = app.search_queue
+    queue.push_story(story.id, ('vote_total',))
+    with pytest.raises(SphinxPoolTimeout):
+        tasks.sphinx_flush_queue()
+
+    assert queue.batch.stories == {story.id: {'vote_total'}}
+    assert queue.batch.pushed == 1
+    assert queue.stats == []
+
+
+def test_flush_queue_drops_batch_on_other_errors(app, factories, fake_sphinx, monkeypatch):
+    story = factories.StoryFactory()
+    story.flush()
+
+    def broken_update(self, updates, with_chapters=True):
+        raise RuntimeError('bad document')
+
+    monkeypatch.setattr(StoryBL, 'update_stories_in_search', broken_update)
+
+    queue = app.search_queue
+    queue.push_story(story.id, ('vote_total',))
+    with pytest.raises(RuntimeError):
+        tasks.sphinx_flush_queue()
+
+    assert not queue.batch
+    assert queue.stats == []
+
+
+def test_counter_updates_keep_search_cache(app, factories, fake_sphinx, simple_cache, monkeypatch):
+    story = factories.StoryFactory()
+    factories.ChapterFactory(story=story)
+    story.flush()
+
+    app.cache.set('search_version_stories', 1)
+    app.cache.set('search_version_chapters', 1)
+
+    story.bl.search_update(('vote_total', 'vote_value', 'comments_count'))
+    assert app.cache.get('search_version_stories') == 1
+    assert app.cache.get('search_version_chapters') == 1
+
+    story.bl.search_update(('finished',))
+    assert app.cache.get('search_version_stories') != 1
+    assert app.cache.get('search_version_chapters') != 1
+
+
+def test_flush_search_queue_scheduled_only_with_backend(app, monkeypatch):
+    from mini_fiction.application import get_celery_beat_schedule
+
+    assert 'flush_search_queue' not in get_celery_beat_schedule(app.config)
+
+    monkeypatch.setitem(app.config, 'SEARCH_QUEUE_BACKEND', {'host': 'localhost'})
+    monkeypatch.setitem(app.config, 'SEARCH_QUEUE_INTERVAL', 3)
+    schedule = get_celery_beat_schedule(app.config)
+    assert schedule['flush_search_queue'] == {'task': 'sphinx_flush_queue', 'schedule': 3.0}
+    assert 'daily_zip_dump' in schedule
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylint: disable=redefined-outer-name,unused-variable
+
+from datetime import datetime, timedelta
+
+import pytest
+from pony import orm
+
+from mini_fiction import models, tasks
+from mini_fiction.view_queue import BaseViewQueue, NullViewQueue, ViewQueueBatch
+
+
+class MemoryViewQueue(BaseViewQueue):
+    def __init__(self, app):
+        super().__init__(app)
+        self.batch = ViewQueueBatch()
+        self.pending = {'story': {}, 'chapter': {}}
+        self.stats = []
+
+    def push_chapter_view(self, user_id, story_id, chapter_id, tm, new_story_view=False):
+        self.batch.pushed += 1
+        if (user_id, chapter_id) not in self.batch.chapters:
+            self.batch.chapters[(user_id, chapter_id)] = (story_id, tm)
+            self.pending['chapter'][chapter_id] = self.pending['chapter'].get(chapter_id, 0) + 1
+            if new_story_view:
+                self.pending['story'][story_id] = self.pending['story'].get(story_id, 0) + 1
+
+    def push_story_view(self, user_id, story_id, tm, views, comments_count):
+        self.batch.pushed += 1
+        self.batch.stories[(user_id, story_id)] = (tm, views, comments_count)
+
+    def pop(self):
+        batch, self.batch = self.batch, ViewQueueBatch()
+        self.pending = {'story': {}, 'chapter': {}}
+        return batch
+
+    def requeue(self, batch):
+        self.batch = batch
+
+    def get_pending(self, kind, ids):
+        return {x: self.pending[kind][x] for x in ids if x in self.pending[kind]}
+
+    def add_stats(self, pushed, applied):
+        self.stats.append((pushed, applied))
+
+
+@pytest.fixture
+def memory_queue(app, monkeypatch):
+    queue = MemoryViewQueue(app)
+    monkeypatch.setattr(app, 'view_queue', queue)
+    return queue
+
+
+def test_flush_view_queue_coalesces_views(app, factories, memory_queue):
+    story = factories.StoryFactory(published_chapters_count=2)
+    chapter1 = factories.ChapterFactory(story=story, order=1)
+    chapter2 = factories.ChapterFactory(story=story, order=2)
+    users = [factories.AuthorFactory() for _ in range(3)]
+    orm.flush()
+
+    # Третий пользователь уже читал первую главу раньше
+    models.StoryView(story=story, chapter=chapter1, author=users[2])
+    story.views = 1
+    chapter1.views = 1
+    orm.flush()
+
+    for user in users:
+        for _ in range(3):
+            chapter1.bl.viewed(user)
+            story.bl.viewed(user)
+    chapter2.bl.viewed(users[0])
+
+    # Пока очередь не применена, в базе ничего не поменялось, но счётчики
+    # на страницах уже учитывают ожидающие просмотры
+    assert models.StoryView.select().count() == 1
+    assert chapter1.views == 1
+    assert chapter1.bl.get_views_count() == 3
+    assert story.bl.get_views_count() == 3
+    assert chapter1.bl.is_viewed_by(users[0]) is not None
+
+    # Повторные просмотры глав отсекаются ещё до очереди, а повторные
+    # просмотры рассказа схлопываются в ней
+    result = tasks.flush_view_queue()
+    assert result == {'pushed': 12, 'applied': 6}
+    assert memory_queue.stats == [(12, 6)]
+
+    assert chapter1.views == 3
+    assert chapter2.views == 1
+    assert story.views == 3
+    assert models.StoryView.select(lambda x: x.chapter == chapter1).count() == 3
+    assert models.StoryView.select(lambda x: x.chapter == chapter2).count() == 1
+
+    acts = list(models.Activity.select(lambda x: x.story == story))
+    assert sorted(x.author.id for x in acts) == sorted(x.id for x in users)
+    assert all(x.last_comments == story.comments_count for x in acts)
+
+    assert not memory_queue.batch
+    assert tasks.flush_view_queue() is None
+
+
+def test_flush_view_queue_skips_deleted_chapters(app, factories, memory_queue):
+    story = factories.StoryFactory(published_chapters_count=1)
+    chapter = factories.ChapterFactory(story=story, order=1)
+    user = factories.AuthorFactory()
+    orm.flush()
+
+    memory_queue.push_chapter_view(user.id, story.id, 10 ** 9, datetime.utcnow())
+    memory_queue.push_chapter_view(user.id, story.id, chapter.id, datetime.utcnow() - timedelta(seconds=5))
+    assert tasks.flush_view_queue() == {'pushed': 2, 'applied': 1}
+    assert chapter.views == 1
+    assert story.views == 1
+
+
+def test_chapters_views_count_in_one_request(app, factories, memory_queue, monkeypatch):
+    user = factories.AuthorFactory()
+    story = factories.StoryFactory()
+    chapters = [factories.ChapterFactory(story=story, order=i + 1, views=i) for i in range(3)]
+    orm.flush()
+    memory_queue.push_chapter_view(user.id, story.id, chapters[1].id, datetime.utcnow())
+
+    calls = []
+    get_pending = memory_queue.get_pending
+    monkeypatch.setattr(memory_queue, 'get_pending', lambda kind, ids: calls.append((kind, sorted(ids))) or get_pending(kind, ids))
+
+    assert story.bl.get_chapters_views_count(chapters) == {chapters[0].id: 0, chapters[1].id: 2, chapters[2].id: 2}
+    assert [x.bl.get_views_count() for x in chapters] == [0, 2, 2]
+    assert calls == [('chapter', sorted(x.id for x in chapters))]
+
+
+def test_null_view_queue_writes_immediately(app, factories, monkeypatch):
+    monkeypatch.setattr(app, 'view_queue', NullViewQueue(app))
+    story = factories.StoryFactory(published_chapters_count=1)
+    chapter = factories.ChapterFactory(story=story, order=1)
+    user = factories.AuthorFactory()
+    orm.flush()
+
+    chapter.bl.viewed(user)
+    chapter.bl.viewed(user)
+    story.bl.viewed(user)
+
+    assert models.StoryView.select(lambda x: x.chapter == chapter and x.author == user).count() == 1
+    assert chapter.views == 1
+    assert story.views == 1
+    assert story.bl.get_views_count() == 1
+    assert story.bl.get_activity(user).last_views == 1
+
+
+def test_flush_view_queue_scheduled_only_with_backend(app, monkeypatch):
+    from mini_fiction.application import get_celery_beat_schedule
+
+    assert 'flush_view_queue' not in get_celery_beat_schedule(app.config)
+
+    monkeypatch.setitem(app.config, 'VIEW_QUEUE_BACKEND', {'host': 'localhost'})
+    monkeypatch.setitem(app.config, 'VIEW_QUEUE_INTERVAL', 30)
+    schedule = get_celery_beat_schedule(app.config)
+    assert schedule['flush_view_queue'] == {'task': 'flush_view_queue', 'schedule': 30.0}